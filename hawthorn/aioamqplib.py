@@ -0,0 +1,750 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asyncio-native AMQP transport on aio_pika, an alternative to the pika
+TornadoConnection based amqplib with the same RabbitMQFactory API.
+
+Deliveries were read by async iterators and publishing were awaited instead
+of being queued for the ioloop, the incoming aio_pika message stands in for
+both basic_deliver and properties of the amqplib consumer callbacks, it
+carries delivery_tag, consumer_tag, exchange, routing_key as well as
+correlation_id, reply_to, headers and the other message properties. The channel
+passed to the callbacks is an AioChannelAdapter, so that acking by
+ch.basic_ack(basic_deliver.delivery_tag) works as it does with amqplib.
+"""
+
+import json
+import time
+import uuid
+import socket
+import asyncio
+import functools
+import logging
+from typing import Optional, Dict, List, Any, AsyncIterator
+from tornado.ioloop import IOLoop
+try:
+    import aio_pika
+    import aio_pika.exceptions
+except ImportError:
+    aio_pika = None
+
+from .supports import singleton
+from .utilities import random_string
+from .amqplib import RABBIT_MQ_DEFAULTS, PublishNacked, PublishesResponse
+from .exceptionreporter import ExceptionReporter
+
+LOGGER = logging.getLogger('components.aioamqplib')
+
+# seconds before retrying a failed connecting
+RECONNECT_DELAY = 5
+
+_MESSAGE_PROPERTIES = ('content_type', 'content_encoding', 'headers', 'delivery_mode', 'priority',
+                       'correlation_id', 'reply_to', 'expiration', 'message_id', 'timestamp',
+                       'type', 'user_id', 'app_id')
+
+def build_message(body, properties=None) -> 'aio_pika.Message':
+    """Builds an aio_pika message, properties could be a pika.BasicProperties,
+    a dict or any object carrying the message properties attributes
+
+    :param str|bytes|dict|list body: The message content
+    :param properties: The message properties
+
+    """
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    kwargs = {}
+    if properties is not None:
+        is_dict = isinstance(properties, dict)
+        for name in _MESSAGE_PROPERTIES:
+            value = properties.get(name) if is_dict else getattr(properties, name, None)
+            if value is None:
+                continue
+            if name == 'expiration' and isinstance(value, str):
+                # pika expiration were milliseconds text
+                value = int(value) / 1000.0
+            kwargs[name] = value
+    return aio_pika.Message(body, **kwargs)
+
+class AioChannelAdapter(object):
+    """Stands in for the pika channel of the amqplib consumer callbacks on an
+    aio_pika channel, basic_ack, basic_nack and basic_reject settle the messages
+    being handled by their delivery tags, as aio_pika settles messages rather than
+    tags. Other attributes were those of the aio_pika channel.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._messages: Dict[int, Any] = {}
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    @property
+    def is_open(self) -> bool:
+        return not self.channel.is_closed
+
+    def hold(self, message):
+        """Tracks a message delivered to the callback until it were settled"""
+        self._messages[message.delivery_tag] = message
+
+    def release(self, message) -> bool:
+        """Stops tracking a message, returns False if the callback settled it already"""
+        return self._messages.pop(message.delivery_tag, None) is not None
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, 'ack', multiple=multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._settle(delivery_tag, 'nack', multiple=multiple, requeue=requeue)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._settle(delivery_tag, 'reject', requeue=requeue)
+
+    def _settle(self, delivery_tag, method, **kwargs):
+        message = self._messages.get(delivery_tag)
+        if message is None:
+            LOGGER.warning('Settling message %s failed since it were not being handled or settled already', str(delivery_tag))
+            return
+        tags = [t for t in self._messages if t <= delivery_tag] if kwargs.get('multiple') else [delivery_tag]
+        for tag in tags:
+            self._messages.pop(tag, None)
+        result = getattr(message, method)(**kwargs)
+        # aio_pika 7 and later settles by coroutines
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            asyncio.ensure_future(result).add_done_callback(functools.partial(self._on_settled, delivery_tag))
+
+    def _on_settled(self, delivery_tag, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            LOGGER.warning('Settling message %s failed with error:%s', str(delivery_tag), str(fut.exception()))
+
+class AioWorkerDelegate(object):
+    """A registered consumer or publisher of AioRabbitMQWorker
+    """
+
+    def __init__(self, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, exchange_durable: bool,
+                 callback: Optional[callable], auto_ack: bool = True, prefetch_count: int = 20, max_concurrency: Optional[int] = None):
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.binding_key = binding_key
+        self.queue = queue
+        self.durable = durable
+        self.exchange_durable = exchange_durable
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = max(1, prefetch_count)
+        self.max_concurrency = max(1, max_concurrency or self.prefetch_count)
+        self.task: Optional[asyncio.Task] = None
+        self.inflight = 0
+        self.processed = 0
+        self.failed = 0
+        self.run_total = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'prefetch_count': self.prefetch_count,
+            'max_concurrency': self.max_concurrency,
+            'inflight': self.inflight,
+            'processed': self.processed,
+            'failed': self.failed,
+            'run_avg': (self.run_total / self.processed) if self.processed else 0.0,
+        }
+
+class AioRabbitMQWorker(object):
+    """RabbitMQ connection of a virtual host on aio_pika
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=5672,
+                 virtual_host='/',
+                 username='guest',
+                 password='guest',
+                 socket_timeout=RABBIT_MQ_DEFAULTS.SOCKET_TIMEOUT,
+                 hb_interval=RABBIT_MQ_DEFAULTS.HEARTBEAT_INTERVAL,
+                 rpc_timeout=RABBIT_MQ_DEFAULTS.RPC_TIMEOUT,
+                 publisher_confirms=True):
+        """Constructor
+
+        :param str host: amqp host
+        :param int port: amqp port
+        :param str virtual_host: amqp virtual_host
+        :param str username: amqp user name
+        :param str password: amqp password
+        :param str socket_timeout: amqp connecting socket timeout
+        :param str hb_interval: amqp heartbeat interval
+        :param float rpc_timeout: default seconds to wait for a rpc response
+        :param bool publisher_confirms: publish waits for the broker
+            confirmation of each message
+
+        """
+        if aio_pika is None:
+            raise RuntimeError('The asyncio-native amqp transport requires aio_pika, install it by pip install aio-pika')
+        self._connection_info = 'amqp://%s@%s:%s/%s' % (username, host, str(port), virtual_host)
+        self._connect_params = {
+            'host': host,
+            'port': port,
+            'virtualhost': virtual_host,
+            'login': username,
+            'password': password,
+            'timeout': socket_timeout,
+            'heartbeat': hb_interval,
+        }
+        self.rpc_timeout = rpc_timeout
+        self.publisher_confirms = publisher_confirms
+        self._connection = None
+        self._channel = None
+        self._ready: Optional[asyncio.Event] = None
+        self._closing = False
+        self._consumers: Dict[str, AioWorkerDelegate] = {}
+        self._publishers: Dict[str, AioWorkerDelegate] = {}
+        self._exchanges: Dict[str, Any] = {}
+        self.tracker_queue_name = ''
+        self.tracker_message_content = False
+        self.worker_hostname = str(socket.gethostname())
+        self._rpc_queue_name = 'rpc-%s-%s' % (self.worker_hostname, random_string(8))
+        self._rpc_queue = None
+        self._rpc_futures: Dict[str, asyncio.Future] = {}
+        self._rpc_lock: Optional[asyncio.Lock] = None
+        self._publish_stats = {
+            'published': 0,
+            'nacked': 0,
+            'failed': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    def _ready_event(self) -> asyncio.Event:
+        # created lazily so that the event binds the running loop
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+
+    async def connect(self):
+        """Connects to RabbitMQ, retries until connected, then declares the
+        registered publishers and starts the registered consumers. The robust
+        connection restores the channels and consumers after reconnecting.
+
+        """
+        self._closing = False
+        while not self._closing:
+            try:
+                LOGGER.info('Connecting to %s', self._connection_info)
+                self._connection = await aio_pika.connect_robust(**self._connect_params)
+                break
+            except Exception as e:
+                LOGGER.error('Connecting to %s failed with error:%s, reconnecting', self._connection_info, str(e))
+                await asyncio.sleep(RECONNECT_DELAY)
+        if self._connection is None:
+            return
+        self._channel = await self._connection.channel(publisher_confirms=self.publisher_confirms)
+        LOGGER.info('Connection %s opened', self._connection_info)
+        for spec in list(self._publishers.values()):
+            await self._declare(self._channel, spec)
+        for spec in list(self._consumers.values()):
+            self._start_consumer(spec)
+        self._ready_event().set()
+
+    async def _declare(self, channel, spec: AioWorkerDelegate):
+        exchange = await channel.declare_exchange(spec.exchange, aio_pika.ExchangeType(spec.exchange_type), durable=spec.exchange_durable)
+        # a fanout queue were exclusive to the consumer, the same as amqplib
+        fanout = spec.exchange_type == 'fanout'
+        queue = await channel.declare_queue(None if fanout else spec.queue, durable=spec.durable, auto_delete=fanout, exclusive=fanout)
+        await queue.bind(exchange, routing_key=spec.binding_key)
+        return queue
+
+    def _start_consumer(self, spec: AioWorkerDelegate):
+        if spec.task is None or spec.task.done():
+            spec.task = asyncio.ensure_future(self._consume(spec))
+
+    async def _consume(self, spec: AioWorkerDelegate):
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=spec.prefetch_count)
+        queue = await self._declare(channel, spec)
+        adapter = AioChannelAdapter(channel)
+        slots = asyncio.Semaphore(spec.max_concurrency)
+        tasks = set()
+        try:
+            async with queue.iterator() as deliveries:
+                async for message in deliveries:
+                    await slots.acquire()
+                    spec.inflight += 1
+                    task = asyncio.ensure_future(self._handle(spec, adapter, message, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            # the messages in process were finished and acked before closing
+            if tasks:
+                await asyncio.wait(tasks)
+            if not channel.is_closed:
+                await channel.close()
+
+    async def _handle(self, spec: AioWorkerDelegate, channel: AioChannelAdapter, message, slots: asyncio.Semaphore):
+        started = time.monotonic()
+        channel.hold(message)
+        try:
+            resp = spec.callback(channel, message, message, message.body)
+            # tornado coroutines return asyncio futures as well
+            if asyncio.iscoroutine(resp) or asyncio.isfuture(resp):
+                resp = await resp
+            if resp and message.reply_to and message.correlation_id:
+                if isinstance(resp, (list, dict)):
+                    resp = json.dumps(resp)
+                if isinstance(resp, (str, bytes)):
+                    await self._reply(message, resp)
+        except Exception as e:
+            spec.failed += 1
+            LOGGER.error('Execute consumer callback:%s failed with error:%s', spec.callback.__name__, str(e))
+            if message.reply_to and message.correlation_id:
+                await self._reply(message, json.dumps({'code': 500, 'message': str(e)}))
+            ExceptionReporter().report(key='AMQP-'+str('consume'), typ='AMQP',
+                endpoint='%s|%s|%s' % (str(message.exchange), str(message.routing_key), str(message.consumer_tag)),
+                method='consume',
+                inputs=message.body.decode('utf-8', errors='ignore'),
+                outputs='',
+                content=str(e),
+                level='ERROR',
+                extra={
+                    'worker_host': self.worker_hostname,
+                    'mq_properties': {
+                        'correlation_id': message.correlation_id or '',
+                        'reply_to': message.reply_to or '',
+                        'app_id': message.app_id or '',
+                        'user_id': message.user_id or '',
+                        'message_id': message.message_id or '',
+                    }
+                }
+            )
+        finally:
+            slots.release()
+            spec.inflight -= 1
+            spec.processed += 1
+            spec.run_total += time.monotonic() - started
+            if channel.release(message) and spec.auto_ack:
+                try:
+                    await message.ack()
+                except Exception as e:
+                    LOGGER.warning('Acking message %s failed with error:%s', str(message.delivery_tag), str(e))
+        if self.tracker_queue_name and message.correlation_id:
+            await self._publish_tracker(message)
+
+    async def _reply(self, message, resp):
+        await self._channel.default_exchange.publish(
+            build_message(resp, {'correlation_id': message.correlation_id, 'headers': message.headers,
+                                 'timestamp': int(time.time())}),
+            routing_key=message.reply_to)
+
+    async def _publish_tracker(self, message):
+        try:
+            await self._channel.default_exchange.publish(
+                build_message(message.body if self.tracker_message_content else b'', message),
+                routing_key=self.tracker_queue_name)
+        except Exception as e:
+            LOGGER.warning('Publishing tracker of %s failed with error:%s', str(message.correlation_id), str(e))
+
+    async def deliveries(self, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool,
+                         exchange_durable: Optional[bool] = None, prefetch_count: int = 20) -> AsyncIterator[Any]:
+        """Iterates the deliveries of a queue, the caller acks each message by
+        await message.ack() or by async with message.process()
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, default 20
+
+        """
+        await self._ready_event().wait()
+        spec = AioWorkerDelegate(exchange, exchange_type, binding_key, queue, durable,
+                           durable if exchange_durable is None else exchange_durable,
+                           None, auto_ack=False, prefetch_count=prefetch_count)
+        channel = await self._connection.channel()
+        try:
+            await channel.set_qos(prefetch_count=spec.prefetch_count)
+            amqp_queue = await self._declare(channel, spec)
+            async with amqp_queue.iterator() as iterator:
+                async for message in iterator:
+                    yield message
+        finally:
+            await channel.close()
+
+    def consume(self, exchange, exchange_type, binding_key, queue, durable, callback, auto_ack=True, exchange_durable=None, prefetch_count=20, max_concurrency=None):
+        """Consumes a message, callback(channel, message, message, body) were
+        called the same as the amqplib consumer callbacks, with auto_ack set to
+        False the callback acks by channel.basic_ack(message.delivery_tag) or by
+        await message.ack()
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param callable callback: callback(channel, message, message, body)
+        :param bool auto_ack: Enable manually ack when set to False
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, default 20
+        :param int max_concurrency: callbacks running at once, defaults to prefetch_count
+
+        """
+        key = '%s:%s:%s' % (exchange, binding_key, queue)
+        if key in self._consumers:
+            LOGGER.error('Consumes a queue by exchange:%s binding_key:%s queue:%s while the consumer already registered.', exchange, binding_key, queue)
+            return
+        spec = AioWorkerDelegate(exchange, exchange_type, binding_key, queue, durable,
+                           durable if exchange_durable is None else exchange_durable,
+                           callback, auto_ack=auto_ack, prefetch_count=prefetch_count, max_concurrency=max_concurrency)
+        self._consumers[key] = spec
+        if self._channel is not None:
+            self._start_consumer(spec)
+
+    def initialize_publisher(self, exchange, exchange_type, binding_key, queue, durable, exchange_durable=None):
+        """Initialize a publishing queue and exchange
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param bool exchange_durable: if the exchange is durable
+
+        """
+        key = '%s:%s:%s' % (exchange, binding_key, queue)
+        if key in self._publishers:
+            return
+        spec = AioWorkerDelegate(exchange, exchange_type, binding_key, queue, durable,
+                           durable if exchange_durable is None else exchange_durable, None)
+        self._publishers[key] = spec
+        if self._channel is not None:
+            asyncio.ensure_future(self._declare(self._channel, spec))
+
+    async def _exchange_of(self, exchange: str):
+        if not exchange:
+            return self._channel.default_exchange
+        amqp_exchange = self._exchanges.get(exchange)
+        if amqp_exchange is None:
+            amqp_exchange = await self._channel.get_exchange(exchange, ensure=False)
+            self._exchanges[exchange] = amqp_exchange
+        return amqp_exchange
+
+    async def publish(self, exchange: str, routing_key: str, message, properties=None, mandatory: bool = False) -> bool:
+        """publishing a message, waits for the connection and, with
+        publisher_confirms, for the broker confirmation
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param properties: The rabbitmq message properties
+        :param bool mandatory: Unroutable messages were failed
+
+        :raises PublishNacked: The broker nacked or returned the message
+
+        """
+        await self._ready_event().wait()
+        started = time.monotonic()
+        amqp_exchange = await self._exchange_of(exchange)
+        try:
+            await amqp_exchange.publish(build_message(message, properties), routing_key=routing_key, mandatory=mandatory)
+        except aio_pika.exceptions.DeliveryError as e:
+            self._publish_stats['nacked'] += 1
+            raise PublishNacked('Publishing to %s|%s failed:%s' % (exchange, routing_key, str(e)))
+        stats = self._publish_stats
+        latency = time.monotonic() - started
+        stats['published'] += 1
+        stats['latency_total'] += latency
+        if latency > stats['latency_max']:
+            stats['latency_max'] = latency
+        return True
+
+    def on_published(self, future: asyncio.Future):
+        """Retrieves the outcome of a publishing nobody awaited, the failures
+        were logged and counted
+        """
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is None:
+            return
+        if not isinstance(e, PublishNacked):
+            # nacks were counted by publish
+            self._publish_stats['failed'] += 1
+        LOGGER.error('Publishing on %s failed:%s', self._connection_info, str(e))
+
+    def publish_stats(self) -> Dict[str, Any]:
+        """Returns the publishing metrics, latency were measured from publish
+        to the broker confirmation in seconds
+        """
+        stats = self._publish_stats
+        published = stats['published']
+        return {
+            'published': published,
+            'nacked': stats['nacked'],
+            'failed': stats['failed'],
+            'latency_avg': (stats['latency_total'] / published) if published else 0.0,
+            'latency_max': stats['latency_max'],
+        }
+
+    async def _ensure_rpc_response_queue(self):
+        if self._rpc_lock is None:
+            self._rpc_lock = asyncio.Lock()
+        async with self._rpc_lock:
+            if self._rpc_queue is not None:
+                return
+            queue = await self._channel.declare_queue(self._rpc_queue_name, durable=False, auto_delete=True)
+            await queue.consume(self._rpc_response, no_ack=True)
+            self._rpc_queue = queue
+
+    async def _rpc_response(self, message):
+        future = self._rpc_futures.pop(message.correlation_id, None)
+        if future is None:
+            LOGGER.debug('late rpc response %s dropped', str(message.correlation_id))
+            return
+        if not future.done():
+            future.set_result(PublishesResponse(self._channel, message, message, message.body))
+
+    async def query(self, exchange: str, routing_key: str, message, properties=None, timeout: Optional[float] = None) -> PublishesResponse:
+        """publishing a message and waiting response
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the response, defaults to rpc_timeout
+
+        :return PublishesResponse, raises asyncio.TimeoutError if no response arrived in time
+
+        """
+        await self._ready_event().wait()
+        await self._ensure_rpc_response_queue()
+        amqp_message = build_message(message, properties)
+        if not amqp_message.correlation_id:
+            amqp_message.correlation_id = str(uuid.uuid4())
+        if not amqp_message.message_id:
+            amqp_message.message_id = amqp_message.correlation_id
+        headers = dict(amqp_message.headers or {})
+        headers.setdefault('X-Forward-For', self._rpc_queue_name)
+        amqp_message.headers = headers
+        amqp_message.reply_to = self._rpc_queue_name
+        correlation_id = amqp_message.correlation_id
+        future = asyncio.get_event_loop().create_future()
+        self._rpc_futures[correlation_id] = future
+        try:
+            amqp_exchange = await self._exchange_of(exchange)
+            await amqp_exchange.publish(amqp_message, routing_key=routing_key)
+            return await asyncio.wait_for(future, self.rpc_timeout if timeout is None else timeout)
+        finally:
+            self._rpc_futures.pop(correlation_id, None)
+
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the consuming metrics by worker
+        """
+        return {key: spec.stats() for key, spec in self._consumers.items()}
+
+    async def close(self):
+        """Stops the consumers, finishing the messages in process, then
+        closes the connection
+        """
+        self._closing = True
+        tasks = [spec.task for spec in self._consumers.values() if spec.task is not None and not spec.task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for future in self._rpc_futures.values():
+            if not future.done():
+                future.cancel()
+        self._rpc_futures.clear()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+        self._channel = None
+        self._rpc_queue = None
+        self._exchanges.clear()
+        if self._ready is not None:
+            self._ready.clear()
+        LOGGER.info('Connection %s closed', self._connection_info)
+
+@singleton
+class AioRabbitMQFactory(object):
+
+    def __init__(self):
+        """Constructs a RabbitMQ operation factory on the asyncio-native transport
+
+        """
+        self._instances: Dict[str, AioRabbitMQWorker] = {}
+        self._default_virtual_host = None
+        self._tracker_queue_name: str = ''
+        self._tracker_message_content: bool = False
+
+    def initialize(self, conn_info: Dict[str, Any]):
+        """Initializing a RabbitMQ operation factory
+
+        :param dict conn_info: Connection configurations
+
+        """
+        virtual_host = conn_info.get('virtual_host')
+        if virtual_host in self._instances:
+            return self._instances[virtual_host]
+        amqp_instance = AioRabbitMQWorker(host=conn_info.get('host'),
+                                          port=conn_info.get('port'),
+                                          username=conn_info.get('username'),
+                                          password=conn_info.get('password'),
+                                          virtual_host=virtual_host,
+                                          socket_timeout=conn_info.get('sock_timeout', RABBIT_MQ_DEFAULTS.SOCKET_TIMEOUT),
+                                          hb_interval=conn_info.get('heartbeat', RABBIT_MQ_DEFAULTS.HEARTBEAT_INTERVAL),
+                                          rpc_timeout=conn_info.get('rpc_timeout', RABBIT_MQ_DEFAULTS.RPC_TIMEOUT),
+                                          publisher_confirms=conn_info.get('publisher_confirms', True))
+        amqp_instance.tracker_queue_name = self._tracker_queue_name
+        amqp_instance.tracker_message_content = self._tracker_message_content
+        self._instances[virtual_host] = amqp_instance
+        if not self._default_virtual_host:
+            self._default_virtual_host = virtual_host
+        return amqp_instance
+
+    def set_tracker_queue_name(self, queue_name: str):
+        """Setup global tracker queue name, this would affect all workers
+        """
+        self._tracker_queue_name = queue_name
+        for inst in self._instances.values():
+            inst.tracker_queue_name = self._tracker_queue_name
+
+    def enable_tracker_message_content(self, enabled: bool):
+        """Publishes the message content to the tracker queue, this would
+        affect all workers
+        """
+        self._tracker_message_content = True if enabled else False
+        for inst in self._instances.values():
+            inst.tracker_message_content = self._tracker_message_content
+
+    def consume(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, callback: callable, auto_ack: bool = True, exchange_durable: bool = None, prefetch_count=20, max_concurrency=None):
+        """Consumes a message
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param callable callback: callback(channel, message, message, body)
+        :param bool auto_ack: Enable manually ack when set to False
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, default 20
+        :param int max_concurrency: callbacks running at once, defaults to prefetch_count
+
+        """
+        self._instances[virtual_host].consume(exchange, exchange_type, binding_key, queue, durable, callback, auto_ack, exchange_durable,
+                                              prefetch_count=prefetch_count, max_concurrency=max_concurrency)
+
+    def deliveries(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, exchange_durable: bool = None, prefetch_count=20) -> AsyncIterator[Any]:
+        """Iterates the deliveries of a queue, see AioRabbitMQWorker.deliveries
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, default 20
+
+        """
+        return self._instances[virtual_host].deliveries(exchange, exchange_type, binding_key, queue, durable, exchange_durable, prefetch_count)
+
+    def initialize_publisher(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, exchange_durable: bool = None):
+        """Initialize a publishing queue and exchange
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param bool exchange_durable: if the exchange is durable
+
+        """
+        self._instances[virtual_host].initialize_publisher(exchange, exchange_type, binding_key, queue, durable, exchange_durable)
+
+    def publish(self, virtual_host: str, exchange: str, routing_key: str, message, properties=None, mandatory: bool = False) -> bool:
+        """publishing a message, the publishing were scheduled at once as
+        amqplib queues it, the failures were logged and counted in
+        publish_stats, use publish_async to wait for the outcome instead
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param properties: The rabbitmq message properties
+        :param bool mandatory: Unroutable messages were failed
+
+        :return bool True once the publishing were scheduled
+
+        """
+        amqp_instance = self._instances[virtual_host]
+        future = asyncio.ensure_future(amqp_instance.publish(exchange, routing_key, message, properties, mandatory))
+        future.add_done_callback(amqp_instance.on_published)
+        return True
+
+    async def publish_async(self, virtual_host: str, exchange: str, routing_key: str, message, properties=None, mandatory: bool = False) -> bool:
+        """publishing a message, waits for the connection and, with
+        publisher_confirms, for the broker confirmation
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param properties: The rabbitmq message properties
+        :param bool mandatory: Unroutable messages were failed
+
+        :raises PublishNacked: The broker nacked or returned the message
+
+        """
+        return await self._instances[virtual_host].publish(exchange, routing_key, message, properties, mandatory)
+
+    def publish_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the publishing metrics by virtual host
+        """
+        return {vhost: inst.publish_stats() for vhost, inst in self._instances.items()}
+
+    def query_mq(self, virtual_host: str, exchange: str, routing_key: str, message, properties=None, timeout: Optional[float] = None) -> asyncio.Future:
+        """publishing a message and waiting response
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the response, defaults to the rpc_timeout of the connection
+
+        :return asyncio.Future of PublishesResponse, raises asyncio.TimeoutError
+            if no response arrived in time
+
+        """
+        return asyncio.ensure_future(self._instances[virtual_host].query(exchange, routing_key, message, properties, timeout))
+
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the consuming metrics by virtual host and worker
+        """
+        return {vhost: inst.consumer_stats() for vhost, inst in self._instances.items()}
+
+    def run(self):
+        """Connects every virtual host on the current ioloop
+        """
+        for amqp_instance in self._instances.values():
+            IOLoop.current().add_callback(amqp_instance.connect)
+
+    def stop(self) -> asyncio.Future:
+        """Closes every virtual host, callable without awaiting as the stop of
+        amqplib, the consumers finish the messages in process before closing
+
+        :return asyncio.Future resolved once closed
+
+        """
+        return asyncio.ensure_future(self.close())
+
+    async def close(self):
+        """Closes every virtual host
+        """
+        for amqp_instance in self._instances.values():
+            await amqp_instance.close()
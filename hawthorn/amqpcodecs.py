@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Codecs of AMQP message payloads negotiated by the content_type and
+content_encoding message properties.
+"""
+
+import json
+import time
+import logging
+from typing import Optional, Dict, Any, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .utilities.compression import compress, decompress, is_compression_supported, COMPRESSION_ZLIB, COMPRESSION_ZSTD, COMPRESSION_GZIP
+
+LOG = logging.getLogger('components.amqpcodecs')
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_MSGPACK = 'application/msgpack'
+
+# content_encoding values of the compressed payloads
+_COMPRESSIONS = (COMPRESSION_GZIP, COMPRESSION_ZLIB, COMPRESSION_ZSTD)
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    return str(obj)
+
+class MessageCodec(object):
+    """Serializes message payloads of a content type
+    """
+    content_type = CONTENT_TYPE_JSON
+
+    def serialize(self, obj) -> bytes:
+        return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+    def deserialize(self, data: bytes):
+        return json.loads(data)
+
+class MsgpackMessageCodec(MessageCodec):
+    """Serializes message payloads by msgpack which requires msgpack package"""
+    content_type = CONTENT_TYPE_MSGPACK
+
+    def serialize(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, default=_json_default)
+
+    def deserialize(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+_CODECS: Dict[str, MessageCodec] = {
+    CONTENT_TYPE_JSON: MessageCodec(),
+}
+if msgpack is not None:
+    _CODECS[CONTENT_TYPE_MSGPACK] = MsgpackMessageCodec()
+    _CODECS['application/x-msgpack'] = _CODECS[CONTENT_TYPE_MSGPACK]
+
+def register_codec(codec: MessageCodec, *aliases: str):
+    """Registers a codec by its content type and the alias content types"""
+    _CODECS[codec.content_type] = codec
+    for alias in aliases:
+        _CODECS[alias] = codec
+
+def get_codec(content_type: Optional[str]) -> Optional[MessageCodec]:
+    if not content_type:
+        return None
+    # parameters such as charset were ignored
+    return _CODECS.get(content_type.split(';', 1)[0].strip().lower())
+
+class MessageCodecs(object):
+    """Encodes the published payloads and decodes the consumed ones, objects
+    were serialized by the codec of content_type, payloads of at least
+    compress_threshold bytes were compressed by compression.
+    """
+
+    def __init__(self, content_type: str = CONTENT_TYPE_JSON, compression: Optional[str] = None, compress_threshold: int = 1024):
+        if get_codec(content_type) is None:
+            LOG.warning('amqp codec of content type %s were not registered, uses %s', str(content_type), CONTENT_TYPE_JSON)
+            content_type = CONTENT_TYPE_JSON
+        if compression and not is_compression_supported(compression):
+            LOG.warning('amqp payload compression %s were not supported, disables compression', compression)
+            compression = None
+        self.content_type = content_type
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+    def encode(self, message, content_type: Optional[str] = None, content_encoding: Optional[str] = None, stats: Optional['CodecStats'] = None) -> Tuple[bytes, Optional[str], Optional[str]]:
+        """Encodes a message, returns the payload with the content type and
+        encoding to be set on the message properties, None for those left
+        unchanged. Payloads already carrying a content encoding were kept as
+        they were.
+
+        :param message: dict or list to be serialized, str or bytes payload
+        :param str content_type: preferred content type, such as of the request being replied
+        :param str content_encoding: content encoding of the payload
+        :param CodecStats stats: records the payload sizes and encoding time
+
+        """
+        started = time.perf_counter()
+        new_type = None
+        if isinstance(message, (dict, list, tuple)):
+            codec = get_codec(content_type) or get_codec(self.content_type)
+            message = codec.serialize(message)
+            new_type = codec.content_type
+        elif isinstance(message, str):
+            message = message.encode('utf-8')
+        new_encoding = None
+        plain_bytes = len(message)
+        if self.compression and not content_encoding and plain_bytes >= self.compress_threshold:
+            message = compress(message, self.compression)
+            new_encoding = self.compression
+        if stats is not None:
+            stats.record(len(message), plain_bytes, started, new_encoding is not None)
+        return message, new_type, new_encoding
+
+    def decode(self, body: bytes, content_type: Optional[str], content_encoding: Optional[str], deserialize: bool = False, stats: Optional['CodecStats'] = None):
+        """Decompresses a payload by its content encoding, then deserializes it
+        by its content type if deserialize were set and the content type were
+        registered, otherwise returns the bytes
+
+        """
+        started = time.perf_counter()
+        wire_bytes = len(body)
+        compressed = bool(content_encoding) and content_encoding in _COMPRESSIONS
+        if compressed:
+            body = decompress(body, content_encoding)
+        plain_bytes = len(body)
+        if deserialize:
+            codec = get_codec(content_type)
+            if codec is not None:
+                body = codec.deserialize(body)
+        if stats is not None:
+            stats.record(wire_bytes, plain_bytes, started, compressed)
+        return body
+
+class CodecStats(object):
+    """Payload bytes and codec time of a queue or a publisher
+    """
+    __slots__ = ('messages', 'wire_bytes', 'plain_bytes', 'codec_time', 'compressed')
+
+    def __init__(self):
+        self.messages = 0
+        self.wire_bytes = 0
+        self.plain_bytes = 0
+        self.codec_time = 0.0
+        self.compressed = 0
+
+    def record(self, wire_bytes: int, plain_bytes: int, started: float, compressed: bool):
+        self.messages += 1
+        self.wire_bytes += wire_bytes
+        self.plain_bytes += plain_bytes
+        self.codec_time += time.perf_counter() - started
+        if compressed:
+            self.compressed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'messages': self.messages,
+            'wire_bytes': self.wire_bytes,
+            'plain_bytes': self.plain_bytes,
+            'compression_ratio': (self.wire_bytes / self.plain_bytes) if self.plain_bytes else 1.0,
+            'compressed': self.compressed,
+            'codec_time': self.codec_time,
+        }
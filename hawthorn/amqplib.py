@@ -5,6 +5,7 @@
 RabbitMQ With Tornado Connection
 """
 
+import os
 import sys
 import logging
 import pika
@@ -18,11 +19,20 @@ import uuid
 import socket
 import json
 import time
+import datetime
 import copy
+import zlib
+import base64
+import hashlib
 # import gevent
 import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import tornado.locks
 from .supports import singleton, Constant
 from .utilities import random_string
+from .utilities.timerwheel import TimerWheel
+from .amqpcodecs import MessageCodecs, CodecStats, CONTENT_TYPE_JSON
 from .exceptionreporter import ExceptionReporter
 
 logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
@@ -36,14 +46,71 @@ class _WorkerDelegateType(Constant):
 
 WORKER_TYPE = _WorkerDelegateType()
 
+class _ExecutionMode(Constant):
+    """Where synchronous consumer callbacks run, thread and process modes
+    keep CPU heavy callbacks off the ioloop, so that heartbeats were not
+    stalled
+    """
+    INLINE = 'inline'
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+EXECUTION_MODE = _ExecutionMode()
+
+def _timed_call(callback, *args):
+    """Runs callback in a pool, returns the wall clock time it started with
+    its result so that the waiting time in the pool could be measured, the
+    monotonic clock were not comparable across processes
+    """
+    started = time.time()
+    return started, callback(*args)
+
 class _RabbitMQDefaults(Constant):
     """
     """
     SOCKET_TIMEOUT = 15
     HEARTBEAT_INTERVAL = 10
+    # publish_async waits once the queue reaches the high watermark until it
+    # drains down to the low watermark, plain publish drops beyond the limit
+    PUBLISH_HIGH_WATERMARK = 10000
+    PUBLISH_LOW_WATERMARK = 2000
+    PUBLISH_QUEUE_LIMIT = 100000
+    # messages sent per ioloop tick before yielding back to the ioloop
+    PUBLISH_BATCH_SIZE = 200
+    # publish_confirmed calls waiting for their broker confirmations at once
+    CONFIRM_MAX_INFLIGHT = 1000
+    # seconds to wait for a rpc response, and the timer wheel resolution
+    RPC_TIMEOUT = 60
+    RPC_TIMER_RESOLUTION = 0.1
+    # adaptive prefetch were tuned once per these handled messages and seconds
+    PREFETCH_TUNE_SAMPLES = 200
+    PREFETCH_TUNE_INTERVAL = 10
+    # seconds before reopening a closed consumer or publishing channel
+    CHANNEL_REOPEN_DELAY = 1
+    # published payload bytes from which compressing
+    COMPRESS_THRESHOLD = 1024
+    # seconds a tracker batch envelope waits for filling up
+    TRACKER_FLUSH_INTERVAL = 1
 
 RABBIT_MQ_DEFAULTS = _RabbitMQDefaults()
 
+# header carrying the delivery tag of a confirmed message, so that a returned
+# message could be matched with its pending confirmation
+CONFIRM_TAG_HEADER = 'X-Publish-Tag'
+
+class PublishNacked(Exception):
+    """The broker rejected a confirmed message by Basic.Nack
+    """
+
+class PublishReturned(Exception):
+    """The broker returned a mandatory confirmed message as unroutable
+    """
+
+    def __init__(self, reply_code: int, reply_text: str):
+        super(PublishReturned, self).__init__('%s %s' % (str(reply_code), str(reply_text)))
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
 class WorkerDelegate(object):
     """
     """
@@ -59,7 +126,22 @@ class WorkerDelegate(object):
     registered = False
     prefetch_count = 20
 
-    def __init__(self, workerType, amqpProperties, callback, prefetch_count=20):
+    def __init__(self, workerType, amqpProperties, callback, prefetch_count=20, max_concurrency=None, prefetch_max=None,
+                 execution_mode=EXECUTION_MODE.INLINE, pool_size=None, decode_body=False):
+        """Constructs a worker delegate
+
+        :param int prefetch_count: initial prefetch count of the consumer
+        :param int max_concurrency: callbacks running at once, defaults to prefetch_count
+        :param int prefetch_max: enables adaptive prefetch between max_concurrency
+            and prefetch_max when greater than prefetch_count
+        :param str execution_mode: runs synchronous callbacks 'inline' on the
+            ioloop, in a 'thread' pool or in a 'process' pool
+        :param int pool_size: workers of the pool, defaults to max_concurrency
+            for threads and the cpu count for processes
+        :param bool decode_body: deserializes the bodies by their content type,
+            otherwise the callbacks got the decompressed bytes
+
+        """
         self.worker_type = workerType
         self.durable = amqpProperties.get('durable', True)
         self.exchange = amqpProperties.get('exchange')
@@ -72,32 +154,206 @@ class WorkerDelegate(object):
         self.worker_tag = '%s:%s:%s' % (self.exchange, self.routing_key, self.queue)
         self.consumer_tag = None
         self.registered = False
+        # consumers own a channel each, so that their qos and flow control
+        # were isolated from each other and from publishing
+        self.channel: Optional[pika.channel.Channel] = None
+        self.channel_opening = False
+        self.max_concurrency = max(1, max_concurrency or prefetch_count)
+        self.prefetch_min = max(1, min(prefetch_count, self.max_concurrency))
+        # auto-delete queues were deleted by cancelling their only consumer, so
+        # the prefetch of fanout consumers were never tuned by resubscribing
+        if prefetch_max and prefetch_max > prefetch_count and self.exchange_type != 'fanout':
+            self.prefetch_max = prefetch_max
+        else:
+            self.prefetch_max = 0
+        self.slots = tornado.locks.Semaphore(self.max_concurrency)
+        self.inflight = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self._tune_samples = 0
+        self._tune_wait = 0.0
+        self._tune_run = 0.0
+        self._tuned_at = time.monotonic()
+        self.execution_mode = execution_mode or EXECUTION_MODE.INLINE
+        if self.execution_mode == EXECUTION_MODE.PROCESS:
+            self.pool_size = pool_size or os.cpu_count() or 1
+        else:
+            self.pool_size = pool_size or self.max_concurrency
+        self._pool = None
+        # consume_batch settings, batch_size 0 delivers messages one by one
+        self.batch_size = 0
+        self.batch_wait = 0.0
+        self.requeue_failed = True
+        self.pending: List[DeliveredMessage] = []
+        self.pending_timer = None
+        # delivery tags not acked yet by the batches, in delivery order
+        self.outstanding: OrderedDict = OrderedDict()
+        self.pool_wait_total = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+        self.exec_count = 0
+        # codecs of the worker, the bodies were decompressed by their content
+        # encoding before the callbacks
+        self.codecs: Optional[MessageCodecs] = None
+        self.decode_body = decode_body
+        self.codec_stats = CodecStats()
 
         if callable(callback):
             self.callback = callback
         else:
             self.callback = None
+        if self.execution_mode not in (EXECUTION_MODE.INLINE, EXECUTION_MODE.THREAD, EXECUTION_MODE.PROCESS):
+            raise ValueError('Unknown execution mode %s' % str(self.execution_mode))
+        if self.execution_mode != EXECUTION_MODE.INLINE and self.callback:
+            if tornado.gen.is_coroutine_function(self.callback) or asyncio.iscoroutinefunction(self.callback):
+                raise ValueError('Coroutine callback %s runs inline only' % self.callback.__name__)
+            if not self.auto_ack:
+                # the channel were not thread safe nor picklable, so the pooled
+                # callbacks got no channel to ack by
+                raise ValueError('Callback %s in %s mode requires auto_ack' % (self.callback.__name__, self.execution_mode))
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.execution_mode == EXECUTION_MODE.PROCESS:
+                self._pool = ProcessPoolExecutor(max_workers=self.pool_size)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='amqp-%s' % str(self.queue))
+        return self._pool
+
+    def decode(self, properties: pika.BasicProperties, body: bytes):
+        if self.codecs is None:
+            return body
+        return self.codecs.decode(body, properties.content_type, properties.content_encoding, self.decode_body, self.codec_stats)
+
+    def shutdown_pool(self, wait: bool = False):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    @tornado.gen.coroutine
+    def batch_executor(self, ch: pika.channel.Channel, messages: List['DeliveredMessage']):
+        """Runs the batch callback, resolves the positions of the failed
+        messages in the batch.
+
+        The callback returns None or True if every message succeeded, False
+        if all failed, or the positions of the failed messages, an exception
+        fails the whole batch.
+
+        """
+        count = len(messages)
+        try:
+            for message in messages:
+                message.body = self.decode(message.properties, message.body)
+            started = time.monotonic()
+            if tornado.gen.is_coroutine_function(self.callback) or asyncio.iscoroutinefunction(self.callback):
+                resp = yield self.callback(ch, messages)
+            elif self.execution_mode == EXECUTION_MODE.INLINE:
+                resp = self.callback(ch, messages)
+            else:
+                submitted = time.time()
+                pool_started, resp = yield asyncio.wrap_future(self._get_pool().submit(_timed_call, self.callback, None, messages))
+                self.pool_wait_total += max(0.0, pool_started - submitted)
+            elapsed = time.monotonic() - started
+            self.exec_count += 1
+            self.exec_total += elapsed
+            if elapsed > self.exec_max:
+                self.exec_max = elapsed
+        except Exception as e:
+            LOGGER.error('Execute batch consumer callback:%s with %d messages failed with error:%s', self.callback.__name__, count, str(e))
+            return set(range(count))
+        if resp is None or resp is True:
+            return set()
+        if resp is False:
+            return set(range(count))
+        return set(i for i in resp if 0 <= i < count)
+
+    def record(self, wait: float, run: float, count: int = 1) -> int:
+        """Records a handled message, returns the tuned prefetch count when
+        adaptive prefetch decides to change it, otherwise 0.
+
+        Messages waiting for a free slot longer than handlers run means the
+        consumer buffers too much, while no waiting means the handlers could
+        starve between deliveries.
+
+        :param float wait: Seconds the message waited for a free slot
+        :param float run: Seconds the callback ran
+        :param int count: Messages handled by the callback
+
+        """
+        self.processed += count
+        self.wait_total += wait
+        self.run_total += run
+        if not self.prefetch_max:
+            return 0
+        self._tune_samples += 1
+        self._tune_wait += wait
+        self._tune_run += run
+        if self._tune_samples < RABBIT_MQ_DEFAULTS.PREFETCH_TUNE_SAMPLES:
+            return 0
+        now = time.monotonic()
+        if now - self._tuned_at < RABBIT_MQ_DEFAULTS.PREFETCH_TUNE_INTERVAL:
+            return 0
+        wait_avg = self._tune_wait / self._tune_samples
+        run_avg = self._tune_run / self._tune_samples
+        self._tune_samples = 0
+        self._tune_wait = 0.0
+        self._tune_run = 0.0
+        self._tuned_at = now
+        prefetch = self.prefetch_count
+        if wait_avg > run_avg * 2:
+            prefetch = max(self.prefetch_min, prefetch // 2)
+        elif wait_avg < run_avg * 0.1:
+            prefetch = min(self.prefetch_max, prefetch * 2)
+        return prefetch if prefetch != self.prefetch_count else 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue': self.queue,
+            'prefetch_count': self.prefetch_count,
+            'max_concurrency': self.max_concurrency,
+            'inflight': self.inflight,
+            'processed': self.processed,
+            'wait_avg': (self.wait_total / self.processed) if self.processed else 0.0,
+            'run_avg': (self.run_total / self.processed) if self.processed else 0.0,
+            'execution_mode': self.execution_mode,
+            'exec_avg': (self.exec_total / self.exec_count) if self.exec_count else 0.0,
+            'exec_max': self.exec_max,
+            'pool_wait_avg': (self.pool_wait_total / self.exec_count) if self.exec_count else 0.0,
+            'codec': self.codec_stats.stats(),
+        }
 
     @tornado.gen.coroutine
     def executor(self, worker, ch: pika.channel.Channel, basic_deliver: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
         if callable(self.callback):
             worker._set_reply_needed_message(properties)
             try:
+                body = self.decode(properties, body)
+                started = time.monotonic()
                 if tornado.gen.is_coroutine_function(self.callback):
                     resp = yield self.callback(ch, basic_deliver, properties, body)
                 elif asyncio.iscoroutinefunction(self.callback):
                     resp = yield self.callback(ch, basic_deliver, properties, body)
-                else:
+                elif self.execution_mode == EXECUTION_MODE.INLINE:
                     resp = self.callback(ch, basic_deliver, properties, body)
+                else:
+                    # the result were marshalled back to the ioloop, so that
+                    # the rpc reply below were published by the ioloop thread
+                    submitted = time.time()
+                    pool_started, resp = yield asyncio.wrap_future(self._get_pool().submit(_timed_call, self.callback, None, basic_deliver, properties, body))
+                    self.pool_wait_total += max(0.0, pool_started - submitted)
+                elapsed = time.monotonic() - started
+                self.exec_count += 1
+                self.exec_total += elapsed
+                if elapsed > self.exec_max:
+                    self.exec_max = elapsed
                 if resp and properties.reply_to and properties.correlation_id:
-                    if isinstance(resp, (list, dict)):
-                        try:
-                            resp = json.dumps(resp)
-                        except:
-                            LOGGER.error('json serialize %s failed with error:%s', str(resp), str(e))
-                    if isinstance(resp, (str, bytes)):
+                    # list and dict were serialized by the codec of the request content type
+                    if isinstance(resp, (str, bytes, list, dict)):
                         if properties.correlation_id in worker._processing_replyies:
-                            reply_properties = worker._processing_replyies.get(properties.correlation_id, properties)
+                            # the reply were encoded afresh rather than by the request encoding
+                            reply_properties = clone_properties(worker._processing_replyies.get(properties.correlation_id, properties),
+                                                                content_encoding=None)
                             reply_properties.timestamp = int(time.time())
                             LOGGER.debug('reply message(%s) to %s', str(properties.message_id), properties.reply_to)
                             worker.publish('', properties.reply_to, resp, reply_properties)
@@ -105,7 +361,8 @@ class WorkerDelegate(object):
             except Exception as e:
                 LOGGER.error('Execute consumer callback:%s failed with error:%s', self.callback.__name__, str(e))
                 if properties.reply_to and properties.correlation_id and properties.correlation_id in worker._processing_replyies:
-                    reply_properties = worker._processing_replyies.get(properties.correlation_id, properties)
+                    reply_properties = clone_properties(worker._processing_replyies.get(properties.correlation_id, properties),
+                                                        content_encoding=None)
                     reply_properties.timestamp = int(time.time())
                     resp = {'code': 500, 'message': str(e)}
                     worker.publish('', properties.reply_to, json.dumps(resp), reply_properties)
@@ -131,6 +388,48 @@ class WorkerDelegate(object):
                 return False
         return False
 
+def clone_properties(properties: pika.BasicProperties, **overrides) -> pika.BasicProperties:
+    """Clones message properties by a shallow copy, which is much cheaper
+    than copy.deepcopy, the headers were copied so that the clone could
+    modify them safely
+
+    :param pika.BasicProperties properties: The properties or template to clone
+    :param overrides: The property values replaced on the clone
+
+    """
+    cloned = copy.copy(properties)
+    if properties.headers:
+        cloned.headers = dict(properties.headers)
+    for k, v in overrides.items():
+        setattr(cloned, k, v)
+    return cloned
+
+class PublishChannel(object):
+    """A channel dedicated to publishing, delivery tags and the unconfirmed
+    messages were tracked per channel
+    """
+
+    def __init__(self, channel: pika.channel.Channel):
+        self.channel = channel
+        self.confirming = False
+        self.delivery_tag = 0
+        self.unconfirmed: OrderedDict = OrderedDict()
+
+    @property
+    def is_open(self) -> bool:
+        return self.channel.is_open
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties: Optional[pika.BasicProperties], mandatory: bool = False) -> int:
+        """Publishes a message on the channel, returns its delivery tag while
+        the channel were in confirm mode
+
+        """
+        self.channel.basic_publish(exchange, routing_key, body, properties, mandatory)
+        if self.confirming:
+            self.delivery_tag += 1
+            return self.delivery_tag
+        return 0
+
 class PublishesMessage(object):
     """
     """
@@ -139,6 +438,11 @@ class PublishesMessage(object):
     message: Optional[bytes] = None
     properties: Optional[pika.BasicProperties] = None
     callback: Optional[callable] = None
+    confirm_future: Optional[asyncio.Future] = None
+    returned: Optional[PublishReturned] = None
+    rpc_future: Optional[asyncio.Future] = None
+    rpc_timer = None
+    expired = False
 
     def __init__(self, exchange: str, routing_key: str, body: bytes, properties: Optional[pika.BasicProperties] = None, callback: Optional[callable] = None):
         """Constructs a publishing message
@@ -154,6 +458,7 @@ class PublishesMessage(object):
         self.message = body
         self.properties = properties
         self.callback = callback
+        self.enqueued_at = time.monotonic()
 
 class PublishesResponse(object):
     """RPC mq query response
@@ -165,6 +470,22 @@ class PublishesResponse(object):
         self.properties: pika.BasicProperties = properties
         self.body: bytes = body
 
+class DeliveredMessage(object):
+    """A message of the batch passed to the consume_batch callbacks
+    """
+    __slots__ = ('delivery', 'properties', 'body')
+
+    def __init__(self, basic_deliver: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+        self.delivery: pika.spec.Basic.Deliver = basic_deliver
+        self.properties: pika.BasicProperties = properties
+        self.body: bytes = body
+
+    def __getstate__(self):
+        return (self.delivery, self.properties, self.body)
+
+    def __setstate__(self, state):
+        self.delivery, self.properties, self.body = state
+
 class RabbitMQWorker(object):
     """
     """
@@ -177,7 +498,18 @@ class RabbitMQWorker(object):
                  password='guest',
                  socket_timeout=RABBIT_MQ_DEFAULTS.SOCKET_TIMEOUT,
                  hb_interval=RABBIT_MQ_DEFAULTS.HEARTBEAT_INTERVAL,
-                 publishing_interval=0.1):
+                 publishing_interval=0.1,
+                 publish_high_watermark=RABBIT_MQ_DEFAULTS.PUBLISH_HIGH_WATERMARK,
+                 publish_low_watermark=RABBIT_MQ_DEFAULTS.PUBLISH_LOW_WATERMARK,
+                 publish_queue_limit=RABBIT_MQ_DEFAULTS.PUBLISH_QUEUE_LIMIT,
+                 publish_batch_size=RABBIT_MQ_DEFAULTS.PUBLISH_BATCH_SIZE,
+                 confirm_max_inflight=RABBIT_MQ_DEFAULTS.CONFIRM_MAX_INFLIGHT,
+                 rpc_timeout=RABBIT_MQ_DEFAULTS.RPC_TIMEOUT,
+                 publish_channels=1,
+                 content_type=CONTENT_TYPE_JSON,
+                 compression=None,
+                 compress_threshold=RABBIT_MQ_DEFAULTS.COMPRESS_THRESHOLD,
+                 connection_class=None):
         """Constructor
 
         :param str host: amqp host
@@ -187,6 +519,23 @@ class RabbitMQWorker(object):
         :param str password: amqp password
         :param str socket_timeout: amqp connecting socket timeout
         :param str hb_interval: amqp heartbeat interval
+        :param int publish_high_watermark: queued messages count makes publish_async wait
+        :param int publish_low_watermark: queued messages count wakes up the waiting publish_async
+        :param int publish_queue_limit: queued messages count beyond which publish drops messages
+        :param int publish_batch_size: messages sent per ioloop tick
+        :param int confirm_max_inflight: publish_confirmed calls waiting for confirmations at once
+        :param float rpc_timeout: default seconds to wait for a rpc response
+        :param int publish_channels: channels dedicated to publishing, the
+            batches were round-robined across them, so messages were kept in
+            order with a single channel only
+        :param str content_type: content type serializing the published
+            dict and list messages, such as application/json or application/msgpack
+        :param str compression: compresses the published payloads by gzip,
+            zlib or zstd, the consumers decompress by the content encoding
+        :param int compress_threshold: payload bytes from which compressing
+        :param type connection_class: connection implementing the pika
+            TornadoConnection interface, defaults to TornadoConnection, such
+            as an in-process broker stand-in for tests and benchmarks
 
         """
         self._connection_info = 'amqp://%s@%s:%s/%s' % (username, host, str(port), virtual_host)
@@ -201,6 +550,7 @@ class RabbitMQWorker(object):
             credentials=credentials, socket_timeout=socket_timeout, heartbeat=hb_interval)
         
         self.publishing_interval = publishing_interval
+        self.connection_class = connection_class or TornadoConnection
         self._connection: Optional[TornadoConnection] = None
         self._channel: Optional[pika.channel.Channel] = None
         self._closing = False
@@ -209,15 +559,75 @@ class RabbitMQWorker(object):
         self._main_thread_ioloop = None
         self._workers: Dict[str, WorkerDelegate] = {}
         self._workers_by_consumer_tag = {}
-        self._publishes: List[PublishesMessage] = []
+        self._publishes: deque = deque()
         self._publish_working = False
+        self._consuming_inflight = 0
+        self._consuming_drained = tornado.locks.Condition()
+        self.publish_high_watermark = publish_high_watermark
+        self.publish_low_watermark = min(publish_low_watermark, publish_high_watermark)
+        self.publish_queue_limit = max(publish_queue_limit, publish_high_watermark)
+        self.publish_batch_size = max(1, publish_batch_size)
+        self._publish_writable = tornado.locks.Event()
+        self._publish_writable.set()
+        self._publish_stats = {
+            'published': 0,
+            'dropped': 0,
+            'batches': 0,
+            'queue_peak': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'confirmed': 0,
+            'nacked': 0,
+            'returned': 0,
+            'republished': 0,
+            'started_at': time.monotonic(),
+        }
+        self.codecs = MessageCodecs(content_type, compression, compress_threshold)
+        self._publish_codec_stats = CodecStats()
+        self.publish_channel_count = max(1, publish_channels)
+        self._publish_channels: List[PublishChannel] = []
+        self._publish_cursor = 0
+        # publisher confirms were enabled on every publishing channel once
+        # publish_confirmed had been called
+        self._confirm_enabled = False
+        self._confirm_slots = tornado.locks.Semaphore(max(1, confirm_max_inflight))
         self.tracker_queue_name = ''
         self.tracker_message_content = False
+        # ratio of the tracked messages by default and by 'exchange' or
+        # 'exchange:routing_key', decided by the correlation id so that a
+        # request and its reply were tracked together
+        self.tracker_sample_rate = 1.0
+        self.tracker_sample_rates: Dict[str, float] = {}
+        # tracks the body size and sha1 instead of the body
+        self.tracker_metadata_only = False
+        # records per tracker envelope, 1 publishes a copy per message
+        self.tracker_batch_size = 1
+        self.tracker_flush_interval = RABBIT_MQ_DEFAULTS.TRACKER_FLUSH_INTERVAL
+        self._tracker_records: List[Dict[str, Any]] = []
+        self._tracker_timer = None
+        self._tracker_stats = {
+            'tracked': 0,
+            'sampled_out': 0,
+            'envelopes': 0,
+            'dropped': 0,
+        }
         self.worker_hostname = str(socket.gethostname())
         self._rpc_queue_name = 'rpc-%s-%s' % (self.worker_hostname, random_string(8))
         self._rpc_queue: Dict[str, PublishesMessage] = {}
         self._rpc_started: bool = False
         self._processing_replyies: Dict[str, pika.BasicProperties] = {}
+        self._rpc_properties_template = pika.BasicProperties(reply_to=self._rpc_queue_name,
+                                                             headers={'X-Forward-For': self._rpc_queue_name})
+        self.rpc_timeout = rpc_timeout
+        self._rpc_timers = TimerWheel(resolution=RABBIT_MQ_DEFAULTS.RPC_TIMER_RESOLUTION)
+        self._rpc_stats = {
+            'replies': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'late_replies': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
 
     def set_custom_ioloop(self, custom_ioloop):
         """Specifies a custom ioloop, this method should be called before run
@@ -254,12 +664,12 @@ class RabbitMQWorker(object):
         """
         LOGGER.info('Connecting to %s', self._connection_info)
         self._closing = False
-        return TornadoConnection(parameters=self._parameters,
-                                 on_open_callback=self.on_connection_open,
-                                 on_open_error_callback=self.on_connection_open_error,
-                                 on_close_callback=self.on_connection_closed,
-                                 custom_ioloop=self._custom_ioloop
-                                )
+        return self.connection_class(parameters=self._parameters,
+                                     on_open_callback=self.on_connection_open,
+                                     on_open_error_callback=self.on_connection_open_error,
+                                     on_close_callback=self.on_connection_closed,
+                                     custom_ioloop=self._custom_ioloop
+                                    )
 
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
@@ -279,7 +689,14 @@ class RabbitMQWorker(object):
         self._channel = None
         for worker_cfg in self._workers.values():
             worker_cfg.registered = False
+            worker_cfg.channel = None
+            worker_cfg.channel_opening = False
+            self._discard_batch(worker_cfg)
+        self._workers_by_consumer_tag = {}
         self._publish_working = False
+        for pub in self._publish_channels:
+            self._requeue_unconfirmed(pub)
+        self._publish_channels = []
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -353,8 +770,122 @@ class RabbitMQWorker(object):
         self.add_on_channel_close_callback()
         self.add_on_cancel_callback()
 
+        for _ in range(self.publish_channel_count - len(self._publish_channels)):
+            self.open_publish_channel()
         self.setup_workers()
 
+    def open_publish_channel(self):
+        """Opens a channel dedicated to publishing
+        """
+        if self._connection is None or not self._connection.is_open or self._closing:
+            return
+        self._connection.channel(on_open_callback=self.on_publish_channel_open)
+
+    def on_publish_channel_open(self, channel: pika.channel.Channel):
+        """Invoked by pika when a publishing channel has been opened, the
+        messages queued while no publishing channel were open were resumed.
+
+        :param pika.channel.Channel channel: The channel object
+
+        """
+        LOGGER.info('Publishing channel %i on connection %s opened', channel.channel_number, self._connection_info)
+        pub = PublishChannel(channel)
+        self._publish_channels.append(pub)
+        channel.add_on_close_callback(self.on_publish_channel_closed)
+        if self._confirm_enabled:
+            self.enable_delivery_confirmations(pub)
+        if self._publishes and not self._publish_working:
+            self.start_publishing()
+
+    def on_publish_channel_closed(self, channel: pika.channel.Channel, reason):
+        """Invoked by pika when a publishing channel were closed, its
+        unconfirmed messages were requeued and the channel were reopened
+
+        :param pika.channel.Channel: The closed channel
+        :param Exception reason: why the channel was closed
+
+        """
+        pub = self._publish_channel_of(channel)
+        if pub is None:
+            return
+        self._publish_channels.remove(pub)
+        self._requeue_unconfirmed(pub)
+        if self._connection.is_open and not self._closing:
+            LOGGER.warning('Publishing channel %i on connection %s was closed, reopening: %s',
+                           channel.channel_number, self._connection_info, reason)
+            self._connection.ioloop.call_later(RABBIT_MQ_DEFAULTS.CHANNEL_REOPEN_DELAY, self.open_publish_channel)
+
+    def _publish_channel_of(self, channel: pika.channel.Channel) -> Optional[PublishChannel]:
+        for pub in self._publish_channels:
+            if pub.channel is channel:
+                return pub
+        return None
+
+    def _next_publish_channel(self) -> Optional[PublishChannel]:
+        """Round-robins the open publishing channels
+        """
+        count = len(self._publish_channels)
+        for _ in range(count):
+            self._publish_cursor = (self._publish_cursor + 1) % count
+            pub = self._publish_channels[self._publish_cursor]
+            if pub.is_open:
+                return pub
+        return None
+
+    def open_consumer_channel(self, worker_cfg: WorkerDelegate):
+        """Opens the channel of a consumer, the queue were declared and
+        consumed on it once opened
+
+        :param WorkerDelegate worker_cfg: WorkerDelegate config
+
+        """
+        if self._connection is None or not self._connection.is_open or self._closing:
+            return
+        if worker_cfg.channel is not None or worker_cfg.channel_opening:
+            return
+        worker_cfg.channel_opening = True
+        self._connection.channel(on_open_callback=lambda channel: self.on_consumer_channel_open(channel, worker_cfg))
+
+    def on_consumer_channel_open(self, channel: pika.channel.Channel, worker_cfg: WorkerDelegate):
+        """Invoked by pika when the channel of a consumer has been opened
+
+        :param pika.channel.Channel channel: The channel object
+        :param WorkerDelegate worker_cfg: WorkerDelegate config
+
+        """
+        LOGGER.info("Channel %i for queue '%s' on connection %s opened", channel.channel_number, worker_cfg.queue, self._connection_info)
+        worker_cfg.channel = channel
+        worker_cfg.channel_opening = False
+        channel.add_on_close_callback(lambda ch, reason: self.on_consumer_channel_closed(ch, reason, worker_cfg))
+        channel.add_on_cancel_callback(self.on_consumer_cancelled)
+        self.setup_exchange(worker_cfg)
+
+    def on_consumer_channel_closed(self, channel: pika.channel.Channel, reason, worker_cfg: WorkerDelegate):
+        """Invoked by pika when the channel of a consumer were closed, only
+        this consumer were reopened, the messages it had not acked were
+        redelivered by RabbitMQ
+
+        :param pika.channel.Channel: The closed channel
+        :param Exception reason: why the channel was closed
+        :param WorkerDelegate worker_cfg: WorkerDelegate config
+
+        """
+        if worker_cfg.channel is not channel:
+            return
+        worker_cfg.channel = None
+        worker_cfg.registered = False
+        self._discard_batch(worker_cfg)
+        if worker_cfg.consumer_tag:
+            self._workers_by_consumer_tag.pop(worker_cfg.consumer_tag, None)
+            worker_cfg.consumer_tag = None
+        if self._connection.is_open and not self._closing:
+            LOGGER.warning("Channel %i for queue '%s' on connection %s was closed, reopening: %s",
+                           channel.channel_number, worker_cfg.queue, self._connection_info, reason)
+            self._connection.ioloop.call_later(RABBIT_MQ_DEFAULTS.CHANNEL_REOPEN_DELAY, self.open_consumer_channel, worker_cfg)
+
+    def _channel_of(self, worker_cfg: WorkerDelegate) -> pika.channel.Channel:
+        return worker_cfg.channel if worker_cfg.channel is not None else self._channel
+
     def setup_exchange(self, worker_cfg: WorkerDelegate):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
         command. When it is complete, the on_exchange_declareok method will
@@ -367,7 +898,7 @@ class RabbitMQWorker(object):
             self.setup_queue(worker_cfg)
             return
         LOGGER.info("Declaring vhost:'%s' exchange '%s'", self._parameters.virtual_host, worker_cfg.exchange)
-        self._channel.exchange_declare(worker_cfg.exchange,
+        self._channel_of(worker_cfg).exchange_declare(worker_cfg.exchange,
                                        worker_cfg.exchange_type,
                                        durable=worker_cfg.exchange_durable,
                                        callback=lambda unused_frame: self.on_exchange_declareok(unused_frame, worker_cfg)
@@ -400,7 +931,7 @@ class RabbitMQWorker(object):
                 return
             queue_name = ''
             LOGGER.info("Declaring queue '%s' by vhost '%s'", worker_cfg.queue, self._parameters.virtual_host)
-            self._channel.queue_declare(queue_name, durable=False, auto_delete=True,
+            self._channel_of(worker_cfg).queue_declare(queue_name, durable=False, auto_delete=True,
                                         callback= lambda method_frame : self.on_queue_declareok(method_frame, worker_cfg)
                                         )
         else:
@@ -408,7 +939,7 @@ class RabbitMQWorker(object):
                 self.on_bindok('', worker_cfg)
                 return
             LOGGER.info("Declaring queue '%s' by vhost '%s'", worker_cfg.queue, self._parameters.virtual_host)
-            self._channel.queue_declare(queue_name,
+            self._channel_of(worker_cfg).queue_declare(queue_name,
                                         durable=worker_cfg.durable,
                                         callback= lambda method_frame : self.on_queue_declareok(method_frame, worker_cfg)
                                         )
@@ -429,7 +960,7 @@ class RabbitMQWorker(object):
             worker_cfg.queue = method_frame.method.queue
             LOGGER.info("Binding '%s' to '%s' with fanout type on vhost '%s'",
                         worker_cfg.exchange, worker_cfg.queue, self._parameters.virtual_host)
-            self._channel.queue_bind(worker_cfg.queue, 
+            self._channel_of(worker_cfg).queue_bind(worker_cfg.queue, 
                                      worker_cfg.exchange, '', 
                                      callback= lambda unused_frame : self.on_bindok(unused_frame, worker_cfg)
                                     )
@@ -438,7 +969,7 @@ class RabbitMQWorker(object):
                         worker_cfg.exchange, worker_cfg.queue, str(worker_cfg.routing_key), self._parameters.virtual_host)
             binding_keys = worker_cfg.routing_key if (isinstance(worker_cfg.routing_key, list) or isinstance(worker_cfg.routing_key, tuple)) else [worker_cfg.routing_key]
             for binding_key in binding_keys:
-                self._channel.queue_bind(worker_cfg.queue, 
+                self._channel_of(worker_cfg).queue_bind(worker_cfg.queue, 
                                          worker_cfg.exchange, 
                                          binding_key, 
                                          callback= lambda unused_frame : self.on_bindok(unused_frame, worker_cfg)
@@ -480,18 +1011,31 @@ class RabbitMQWorker(object):
         """
         LOGGER.info('Consumer was cancelled remotely, shutting down: %r',
                     method_frame)
-        if self._channel:
+        worker_cfg = self._workers_by_consumer_tag.get(method_frame.method.consumer_tag)
+        if worker_cfg is not None and worker_cfg.channel is not None:
+            # reopening the channel declares the queue again
+            worker_cfg.channel.close()
+        elif self._channel:
             self._channel.close()
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, delivery_tag, consumer_tag=None):
         """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        Basic.Ack RPC method for the delivery tag. Delivery tags are scoped
+        by channel, and each consumer receives its deliveries on a channel of
+        its own, so the ack were sent on the channel of the consumer.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param str consumer_tag: The consumer tag from the Basic.Deliver frame,
+            acking without it on the main channel is deprecated
 
         """
-        # LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        worker_cfg = self._workers_by_consumer_tag.get(consumer_tag) if consumer_tag else None
+        if worker_cfg is None:
+            LOGGER.warning('acknowledging delivery %s without a known consumer tag on the main channel is deprecated, '
+                           'pass basic_deliver.consumer_tag or ack by the channel of the delivery', delivery_tag)
+            self._channel.basic_ack(delivery_tag)
+            return
+        self._channel_of(worker_cfg).basic_ack(delivery_tag)
 
     def on_message(self, ch: pika.channel.Channel, basic_deliver: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
         """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -511,16 +1055,186 @@ class RabbitMQWorker(object):
         # LOGGER.info('Received message # %s from %s: %s', basic_deliver.delivery_tag, str(properties.app_id), body)
         worker_cfg = self._workers_by_consumer_tag.get(basic_deliver.consumer_tag)
         if worker_cfg and worker_cfg.callback:
-            # self._connection.ioloop.call_soon(worker_cfg.callback, ch, basic_deliver, properties, body)
-            # worker_cfg.callback(ch, basic_deliver, properties, body)
-            self._connection.ioloop.add_callback(functools.partial(worker_cfg.executor, self, ch, basic_deliver, properties, body))
-            if worker_cfg.auto_ack:
-                self.acknowledge_message(basic_deliver.delivery_tag)
+            worker_cfg.inflight += 1
+            self._consuming_inflight += 1
+            if worker_cfg.batch_size:
+                self._collect_batch(worker_cfg, ch, basic_deliver, properties, body)
+            else:
+                self._connection.ioloop.add_callback(self._dispatch_message, worker_cfg, ch, basic_deliver, properties, body)
 
             if self.tracker_queue_name and properties.correlation_id:
-                self._connection.ioloop.add_callback(functools.partial(self._publish_tracker), body, properties)
+                self._publish_tracker('consume', basic_deliver.exchange, basic_deliver.routing_key, body, properties)
         else:
-            self._channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
+            ch.basic_nack(basic_deliver.delivery_tag, requeue=True)
+
+    async def _dispatch_message(self, worker_cfg: WorkerDelegate, ch: pika.channel.Channel, basic_deliver: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+        """Runs the consumer callback once the consumer has a free slot, the
+        message were acked after the callback finished when auto_ack were set,
+        so that prefetch_count bounds the messages held by this process.
+
+        """
+        received = time.monotonic()
+        await worker_cfg.slots.acquire()
+        started = time.monotonic()
+        try:
+            await worker_cfg.executor(self, ch, basic_deliver, properties, body)
+        finally:
+            worker_cfg.slots.release()
+            if worker_cfg.auto_ack and ch.is_open:
+                ch.basic_ack(basic_deliver.delivery_tag)
+            worker_cfg.inflight -= 1
+            self._consuming_inflight -= 1
+            if not self._consuming_inflight:
+                self._consuming_drained.notify_all()
+        prefetch = worker_cfg.record(started - received, time.monotonic() - started)
+        if prefetch:
+            self._retune_prefetch(worker_cfg, prefetch)
+
+    def _collect_batch(self, worker_cfg: WorkerDelegate, ch: pika.channel.Channel, basic_deliver: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+        worker_cfg.outstanding[basic_deliver.delivery_tag] = False
+        worker_cfg.pending.append(DeliveredMessage(basic_deliver, properties, body))
+        if len(worker_cfg.pending) >= worker_cfg.batch_size:
+            self._flush_batch(worker_cfg)
+        elif worker_cfg.pending_timer is None:
+            worker_cfg.pending_timer = self._connection.ioloop.call_later(worker_cfg.batch_wait, self._flush_batch, worker_cfg)
+
+    def _flush_batch(self, worker_cfg: WorkerDelegate):
+        if worker_cfg.pending_timer is not None:
+            self._connection.ioloop.remove_timeout(worker_cfg.pending_timer)
+            worker_cfg.pending_timer = None
+        if not worker_cfg.pending or worker_cfg.channel is None:
+            return
+        messages = worker_cfg.pending
+        worker_cfg.pending = []
+        self._connection.ioloop.add_callback(self._dispatch_batch, worker_cfg, worker_cfg.channel, messages)
+
+    async def _dispatch_batch(self, worker_cfg: WorkerDelegate, ch: pika.channel.Channel, messages: List[DeliveredMessage]):
+        """Runs the batch callback once the consumer has a free slot, nacks
+        the failed messages one by one, then acks the handled messages with
+        multiple=True up to the first delivery still in process, so that the
+        concurrent batches of the channel were never acked by each other.
+
+        """
+        received = time.monotonic()
+        await worker_cfg.slots.acquire()
+        started = time.monotonic()
+        failed = set()
+        try:
+            failed = await worker_cfg.batch_executor(ch if worker_cfg.execution_mode == EXECUTION_MODE.INLINE else None, messages)
+        finally:
+            worker_cfg.slots.release()
+            if ch.is_open and worker_cfg.channel is ch:
+                outstanding = worker_cfg.outstanding
+                for pos, message in enumerate(messages):
+                    tag = message.delivery.delivery_tag
+                    if pos in failed:
+                        outstanding.pop(tag, None)
+                        ch.basic_nack(tag, requeue=worker_cfg.requeue_failed)
+                    elif tag in outstanding:
+                        outstanding[tag] = True
+                last_tag = 0
+                while outstanding:
+                    tag = next(iter(outstanding))
+                    if not outstanding[tag]:
+                        break
+                    outstanding.pop(tag)
+                    last_tag = tag
+                if last_tag:
+                    ch.basic_ack(last_tag, multiple=True)
+            worker_cfg.inflight -= len(messages)
+            self._consuming_inflight -= len(messages)
+            if not self._consuming_inflight:
+                self._consuming_drained.notify_all()
+        worker_cfg.record(started - received, time.monotonic() - started, len(messages))
+
+    def _discard_batch(self, worker_cfg: WorkerDelegate):
+        """Forgets the messages collected from a closed channel, RabbitMQ
+        redelivers them
+        """
+        if worker_cfg.pending_timer is not None:
+            self._connection.ioloop.remove_timeout(worker_cfg.pending_timer)
+            worker_cfg.pending_timer = None
+        if worker_cfg.pending:
+            worker_cfg.inflight -= len(worker_cfg.pending)
+            self._consuming_inflight -= len(worker_cfg.pending)
+            worker_cfg.pending = []
+            if not self._consuming_inflight:
+                self._consuming_drained.notify_all()
+        worker_cfg.outstanding.clear()
+
+    def _retune_prefetch(self, worker_cfg: WorkerDelegate, prefetch: int):
+        """Resubscribes the consumer with the tuned prefetch count, RabbitMQ
+        applies basic.qos to the consumers started after it only, and global
+        qos were unsupported by quorum queues
+
+        """
+        channel = self._channel_of(worker_cfg)
+        if channel is None or not channel.is_open or self._closing or not worker_cfg.consumer_tag:
+            return
+        LOGGER.info("Tuning prefetch of queue '%s' from %d to %d", worker_cfg.queue, worker_cfg.prefetch_count, prefetch)
+        previous_tag = worker_cfg.consumer_tag
+        # keeps the previous tag routed until the messages delivered before
+        # Basic.CancelOk were received
+        channel.basic_cancel(previous_tag, lambda unused_frame: self._workers_by_consumer_tag.pop(previous_tag, None))
+        worker_cfg.prefetch_count = prefetch
+        channel.basic_qos(prefetch_count=prefetch)
+        worker_cfg.consumer_tag = channel.basic_consume(worker_cfg.queue,
+                                                        self.on_message,
+                                                        auto_ack = False)
+        self._workers_by_consumer_tag[worker_cfg.consumer_tag] = worker_cfg
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Cancels the consumers and waits for the messages in process, the
+        messages still prefetched by the channel were requeued by RabbitMQ once
+        the channel closes.
+
+        :param float timeout: Seconds to wait, None waits until drained
+
+        :return bool True if no message were in process any more
+
+        """
+        for worker_cfg in self._workers.values():
+            channel = self._channel_of(worker_cfg)
+            if worker_cfg.consumer_tag and channel is not None and channel.is_open:
+                channel.basic_cancel(worker_cfg.consumer_tag)
+                worker_cfg.consumer_tag = None
+            if worker_cfg.pending:
+                self._flush_batch(worker_cfg)
+        deadline = None if timeout is None else (time.monotonic() + timeout)
+        while self._consuming_inflight:
+            if deadline is None:
+                await self._consuming_drained.wait()
+            elif not await self._consuming_drained.wait(timeout=datetime.timedelta(seconds=max(0, deadline - time.monotonic()))):
+                break
+        return not self._consuming_inflight
+
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the consuming metrics by worker
+        """
+        return {key: worker_cfg.stats() for key, worker_cfg in self._workers.items() if worker_cfg.worker_type == WORKER_TYPE.CONSUMER}
+
+    def execution_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the callback latency by execution mode
+        """
+        modes = {}
+        for worker_cfg in self._workers.values():
+            if worker_cfg.worker_type != WORKER_TYPE.CONSUMER or not worker_cfg.exec_count:
+                continue
+            mode = modes.setdefault(worker_cfg.execution_mode, {'count': 0, 'total': 0.0, 'max': 0.0, 'pool_wait': 0.0})
+            mode['count'] += worker_cfg.exec_count
+            mode['total'] += worker_cfg.exec_total
+            mode['pool_wait'] += worker_cfg.pool_wait_total
+            mode['max'] = max(mode['max'], worker_cfg.exec_max)
+        return {name: {
+            'count': mode['count'],
+            'latency_avg': mode['total'] / mode['count'],
+            'latency_max': mode['max'],
+            'pool_wait_avg': mode['pool_wait'] / mode['count'],
+        } for name, mode in modes.items()}
+
+    def _shutdown_pools(self):
+        for worker_cfg in self._workers.values():
+            worker_cfg.shutdown_pool()
 
     def on_cancel_consuming_ok(self, unused_frame):
         """This method is invoked by pika when RabbitMQ acknowledges the
@@ -560,8 +1274,9 @@ class RabbitMQWorker(object):
         if self._channel:
             LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
             for worker_cfg in self._workers.values():
-                if worker_cfg.consumer_tag:
-                    self._channel.basic_cancel(worker_cfg.consumer_tag, self.on_cancel_consuming_ok)
+                channel = self._channel_of(worker_cfg)
+                if worker_cfg.consumer_tag and channel.is_open:
+                    channel.basic_cancel(worker_cfg.consumer_tag, self.on_cancel_consuming_ok)
 
     def start_worker(self, worker_cfg):
         """This method sets up the consumer by first calling
@@ -578,10 +1293,11 @@ class RabbitMQWorker(object):
         # self.add_on_cancel_callback()
         if worker_cfg.worker_type == WORKER_TYPE.CONSUMER:
             LOGGER.info("Issuing consumer for queue:'%s' by vhost '%s'", worker_cfg.queue, self._parameters.virtual_host)
-            self._channel.basic_qos(prefetch_count=worker_cfg.prefetch_count)
-            worker_cfg.consumer_tag = self._channel.basic_consume(worker_cfg.queue, 
-                                                                  self.on_message,
-                                                                  auto_ack = False)
+            channel = self._channel_of(worker_cfg)
+            channel.basic_qos(prefetch_count=worker_cfg.prefetch_count)
+            worker_cfg.consumer_tag = channel.basic_consume(worker_cfg.queue, 
+                                                            self.on_message,
+                                                            auto_ack = False)
             self._workers_by_consumer_tag[worker_cfg.consumer_tag] = worker_cfg
         
         elif not self._publish_working:
@@ -596,7 +1312,7 @@ class RabbitMQWorker(object):
         # self.enable_delivery_confirmations()
         self.schedule_next_message()
 
-    def enable_delivery_confirmations(self):
+    def enable_delivery_confirmations(self, pub: PublishChannel):
         """Send the Confirm.Select RPC method to RabbitMQ to enable delivery
         confirmations on the channel. The only way to turn this off is to close
         the channel and create a new one.
@@ -606,11 +1322,24 @@ class RabbitMQWorker(object):
         or Basic.Nack method from RabbitMQ that will indicate which messages it
         is confirming or rejecting.
 
+        :param PublishChannel pub: The publishing channel
+
         """
         LOGGER.info('Issuing Confirm.Select RPC command')
-        self._channel.confirm_delivery(self.on_delivery_confirmation)
+        self._confirm_enabled = True
+        pub.delivery_tag = 0
+        try:
+            pub.channel.confirm_delivery(lambda method_frame: self.on_delivery_confirmation(method_frame, pub))
+        except Exception as e:
+            LOGGER.error('Enabling delivery confirmations on %s failed with error:%s', self._connection_info, str(e))
+            pub.confirming = False
+            return
+        pub.channel.add_on_return_callback(self.on_message_returned)
+        # frames were ordered within the channel, so the messages published
+        # from now on were counted by the broker
+        pub.confirming = True
 
-    def on_delivery_confirmation(self, method_frame):
+    def on_delivery_confirmation(self, method_frame, pub: PublishChannel):
         """Invoked by pika when RabbitMQ responds to a Basic.Publish RPC
         command, passing in either a Basic.Ack or Basic.Nack frame with
         the delivery tag of the message that was published. The delivery tag
@@ -621,20 +1350,77 @@ class RabbitMQWorker(object):
         that are pending confirmation.
 
         :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+        :param PublishChannel pub: The publishing channel
+
+        """
+        unconfirmed = pub.unconfirmed
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        delivery_tag = method.delivery_tag
+        if method.multiple:
+            while unconfirmed:
+                tag = next(iter(unconfirmed))
+                if tag > delivery_tag:
+                    break
+                self._settle_confirmation(unconfirmed.pop(tag), acked)
+        else:
+            element = unconfirmed.pop(delivery_tag, None)
+            if element is not None:
+                self._settle_confirmation(element, acked)
+
+    def on_message_returned(self, ch: pika.channel.Channel, method: pika.spec.Basic.Return, properties: pika.BasicProperties, body: bytes):
+        """Invoked by pika when RabbitMQ returns an unroutable mandatory
+        message, the broker acks the message after returning it, so the
+        confirmation were rejected when that ack arrives.
+
+        :param pika.channel.Channel ch: The channel object
+        :param pika.spec.Basic.Return method: The Basic.Return method
+        :param pika.BasicProperties properties: The returned message properties
+        :param bytes body: The returned message body
 
         """
-        # confirmation_type = method_frame.method.NAME.split('.')[1].lower()
-        # LOGGER.info('Received %s for delivery tag: %i', confirmation_type,
-        #             method_frame.method.delivery_tag)
-        # if confirmation_type == 'ack':
-        #     self._acked += 1
-        # elif confirmation_type == 'nack':
-        #     self._nacked += 1
-        # self._deliveries.remove(method_frame.method.delivery_tag)
-        # LOGGER.info(
-        #     'Published %i messages, %i have yet to be confirmed, '
-        #     '%i were acked and %i were nacked', self._message_number,
-        #     len(self._deliveries), self._acked, self._nacked)
+        pub = self._publish_channel_of(ch)
+        tag = properties.headers.get(CONFIRM_TAG_HEADER) if properties.headers else None
+        element = pub.unconfirmed.get(tag) if pub is not None else None
+        if element is not None:
+            element.returned = PublishReturned(method.reply_code, method.reply_text)
+        else:
+            LOGGER.warning('Message to %s|%s returned by %s: %s %s', method.exchange, method.routing_key,
+                           self._connection_info, str(method.reply_code), str(method.reply_text))
+
+    def _settle_confirmation(self, element: PublishesMessage, acked: bool):
+        stats = self._publish_stats
+        future = element.confirm_future
+        if element.returned is not None:
+            stats['returned'] += 1
+            if not future.done():
+                future.set_exception(element.returned)
+        elif acked:
+            stats['confirmed'] += 1
+            if not future.done():
+                future.set_result(True)
+        else:
+            stats['nacked'] += 1
+            if not future.done():
+                future.set_exception(PublishNacked('Message to %s|%s were nacked by %s' % (element.exchange, element.routing_key, self._connection_info)))
+
+    def _requeue_unconfirmed(self, pub: PublishChannel):
+        """Puts the messages unconfirmed by a closed channel back to the head
+        of the publishing queue, they were republished once a channel opens
+        again, so the consumers should tolerate duplicates
+
+        """
+        pub.confirming = False
+        pub.delivery_tag = 0
+        if not pub.unconfirmed:
+            return
+        pending = [element for element in pub.unconfirmed.values() if not element.confirm_future.done()]
+        pub.unconfirmed.clear()
+        for element in pending:
+            element.returned = None
+        self._publishes.extendleft(reversed(pending))
+        self._publish_stats['republished'] += len(pending)
+        LOGGER.warning('%d unconfirmed messages on %s were requeued for republishing', len(pending), self._connection_info)
 
     def schedule_next_message(self):
         """If we are not closing our connection to RabbitMQ, schedule another
@@ -648,72 +1434,141 @@ class RabbitMQWorker(object):
         else:
             self._publish_working = False
 
-    @tornado.gen.coroutine
     def _do_publish_message(self):
-        """If the class is not stopping, publish a message to RabbitMQ,
-        appending a list of deliveries with the message number that was sent.
-        This list will be used to check for delivery confirmations in the
-        on_delivery_confirmations method.
+        """If the class is not stopping, publish the queued messages to
+        RabbitMQ, at most publish_batch_size messages per ioloop tick so that
+        consumers and heartbeats were not starved by a large backlog.
 
-        Once the message has been sent, schedule another message to be sent.
-        The main reason I put scheduling in was just so you can get a good idea
-        of how the process is flowing by slowing down and speeding up the
-        delivery intervals by changing the publishing_interval constant in the
-        class.
+        Once the batch has been sent, schedule the next batch while messages
+        remain, the waiting publish_async calls were woken up as soon as the
+        queue drains down to the low watermark.
 
         """
-        if self._channel is None or not self._channel.is_open:
+        pub = self._next_publish_channel()
+        if pub is None:
             self._publish_working = False
             return
 
-        for element in self._publishes:
+        stats = self._publish_stats
+        tracking = bool(self.tracker_queue_name)
+        timestamp = int(time.time())
+        now = time.monotonic()
+        sent = 0
+        latency_max = stats['latency_max']
+        latency_total = 0.0
+        while self._publishes and sent < self.publish_batch_size:
+            element = self._publishes.popleft()
+            if element.expired:
+                # rpc timed out or cancelled before being published
+                continue
             pub_properties = element.properties
-            if callable(element.callback):
-                if not element.properties:
-                    correlation_id = str(uuid.uuid4())
-                    element.properties = pika.BasicProperties(correlation_id=correlation_id,
-                                                              reply_to=self._rpc_queue_name,
-                                                              message_id=correlation_id,
-                                                              headers={'X-Forward-For': self._rpc_queue_name}
-                    )
-                if not element.properties.correlation_id:
-                    element.properties.correlation_id = str(uuid.uuid4())
-                    if element.properties.reply_to:
-                        if not element.properties.headers:
-                            element.properties.headers = {'X-Forward-For': element.properties.reply_to}
-                        elif 'X-Forward-For' not in element.properties.headers:
-                            element.properties.headers['X-Forward-For'] = element.properties.reply_to
-                element.properties.timestamp = int(time.time())
-                pub_properties = copy.deepcopy(element.properties)
-                if False == self._rpc_started:
-                    self._ensure_rpc_response_queue()
-                    self._rpc_started = True
-                self._rpc_queue[pub_properties.correlation_id] = element
-                pub_properties.reply_to = self._rpc_queue_name
-
-            self._channel.basic_publish(element.exchange, element.routing_key,
-                                        element.message,
-                                        pub_properties)
-            if self.tracker_queue_name and element.properties and element.properties.correlation_id:
-                self._connection.ioloop.add_callback(functools.partial(self._publish_tracker), element.message, element.properties)
-        self._publishes = []
-
-        # hdrs = {u'مفتاح': u' قيمة', u'键': u'值', u'キー': u'値'}
-        # properties = pika.BasicProperties(
-        #     app_id='example-publisher',
-        #     content_type='application/json',
-        #     headers=hdrs)
-
-        # message = u'مفتاح قيمة 键 值 キー 値'
-        # self._channel.basic_publish(self.exchange, self.routing_key,
-        #                             json.dumps(message, ensure_ascii=False),
-        #                             properties)
-        # self._message_number += 1
-        # self._deliveries.append(self._message_number)
-        # LOGGER.info('Published message # %i', self._message_number)
-
-        if self._publish_working:
-            self.schedule_next_message()
+            confirming = element.confirm_future is not None
+            if confirming:
+                if element.confirm_future.done():
+                    # cancelled by the caller before being published
+                    continue
+                if not pub.confirming:
+                    element.confirm_future.set_exception(PublishNacked('Delivery confirmations were unavailable on %s' % self._connection_info))
+                    continue
+                headers = {CONFIRM_TAG_HEADER: pub.delivery_tag + 1}
+                if pub_properties is None:
+                    pub_properties = pika.BasicProperties(headers=headers)
+                else:
+                    if pub_properties.headers:
+                        headers.update(pub_properties.headers)
+                        headers[CONFIRM_TAG_HEADER] = pub.delivery_tag + 1
+                    pub_properties = clone_properties(pub_properties, headers=headers)
+            elif callable(element.callback):
+                pub_properties = self._prepare_rpc_properties(element, timestamp)
+            try:
+                delivery_tag = pub.basic_publish(element.exchange, element.routing_key,
+                                                 element.message,
+                                                 pub_properties,
+                                                 confirming)
+            except Exception as e:
+                # keeps the message for the next channel
+                LOGGER.warning('Publishing message to %s failed with error:%s, %d messages were kept',
+                               self._connection_info, str(e), len(self._publishes) + 1)
+                self._publishes.appendleft(element)
+                break
+            if confirming:
+                pub.unconfirmed[delivery_tag] = element
+            if tracking and element.properties and element.properties.correlation_id:
+                self._publish_tracker('publish', element.exchange, element.routing_key, element.message, element.properties, pub)
+            sent += 1
+            latency = now - element.enqueued_at
+            latency_total += latency
+            if latency > latency_max:
+                latency_max = latency
+
+        if sent:
+            stats['published'] += sent
+            stats['batches'] += 1
+            stats['latency_total'] += latency_total
+            stats['latency_max'] = latency_max
+        if not self._publish_writable.is_set() and len(self._publishes) <= self.publish_low_watermark:
+            self._publish_writable.set()
+
+        if sent and self._publishes and pub.is_open:
+            self._connection.ioloop.add_callback(self._do_publish_message)
+        else:
+            self._publish_working = False
+
+    def _prepare_rpc_properties(self, element: PublishesMessage, timestamp: int) -> pika.BasicProperties:
+        """Fills the correlation id of a rpc message and registers the message
+        for its response, returns the properties to be published
+
+        """
+        properties = element.properties
+        if not properties:
+            correlation_id = str(uuid.uuid4())
+            properties = clone_properties(self._rpc_properties_template,
+                                          correlation_id=correlation_id,
+                                          message_id=correlation_id)
+            element.properties = properties
+        if not properties.correlation_id:
+            properties.correlation_id = str(uuid.uuid4())
+            if not properties.message_id:
+                properties.message_id = properties.correlation_id
+            forward_for = properties.reply_to or self._rpc_queue_name
+            if not properties.headers:
+                properties.headers = {'X-Forward-For': forward_for}
+            elif 'X-Forward-For' not in properties.headers:
+                properties.headers['X-Forward-For'] = forward_for
+        properties.timestamp = timestamp
+        if False == self._rpc_started:
+            self._ensure_rpc_response_queue()
+            self._rpc_started = True
+        self._rpc_queue[properties.correlation_id] = element
+        if properties.reply_to == self._rpc_queue_name:
+            return properties
+        return clone_properties(properties, reply_to=self._rpc_queue_name)
+
+    def publish_stats(self) -> Dict[str, Any]:
+        """Returns the publishing metrics, latency were measured from publish
+        to basic_publish in seconds
+
+        """
+        stats = self._publish_stats
+        published = stats['published']
+        elapsed = time.monotonic() - stats['started_at']
+        return {
+            'queued': len(self._publishes),
+            'published': published,
+            'dropped': stats['dropped'],
+            'batches': stats['batches'],
+            'queue_peak': stats['queue_peak'],
+            'throughput': (published / elapsed) if elapsed > 0 else 0.0,
+            'latency_avg': (stats['latency_total'] / published) if published else 0.0,
+            'latency_max': stats['latency_max'],
+            'backpressure': not self._publish_writable.is_set(),
+            'unconfirmed': sum(len(pub.unconfirmed) for pub in self._publish_channels),
+            'confirmed': stats['confirmed'],
+            'nacked': stats['nacked'],
+            'returned': stats['returned'],
+            'republished': stats['republished'],
+            'codec': self._publish_codec_stats.stats(),
+        }
 
     def _set_reply_needed_message(self, properties: pika.BasicProperties):
         if properties.correlation_id and properties.reply_to:
@@ -751,13 +1606,103 @@ class RabbitMQWorker(object):
         :param bytes body: The message body
 
         """
-        if properties.correlation_id not in self._rpc_queue:
+        element = self._rpc_queue.pop(properties.correlation_id, None)
+        if element is None:
+            # the caller had timed out or cancelled
+            self._rpc_stats['late_replies'] += 1
+            LOGGER.debug('late rpc response %s dropped', str(properties.correlation_id))
             return
-        element = self._rpc_queue[properties.correlation_id]
+        if element.rpc_timer is not None:
+            element.rpc_timer.cancel()
+            element.rpc_timer = None
+        stats = self._rpc_stats
+        latency = time.monotonic() - element.enqueued_at
+        stats['replies'] += 1
+        stats['latency_total'] += latency
+        if latency > stats['latency_max']:
+            stats['latency_max'] = latency
         if callable(element.callback):
-            element.callback(ch, basic_deliver, properties, body)
-        del self._rpc_queue[properties.correlation_id]
-        LOGGER.info('got rpc response %s', str(body))
+            try:
+                element.callback(ch, basic_deliver, properties, body)
+            except Exception as e:
+                LOGGER.error('Execute rpc callback:%s failed with error:%s', str(element.callback), str(e))
+        LOGGER.debug('got rpc response %s', str(body))
+
+    def _watch_rpc(self, element: PublishesMessage, timeout: Optional[float]):
+        element.rpc_timer = self._rpc_timers.add(self.rpc_timeout if timeout is None else timeout,
+                                                 functools.partial(self._expire_rpc, element))
+
+    def _discard_rpc(self, element: PublishesMessage):
+        element.expired = True
+        if element.rpc_timer is not None:
+            element.rpc_timer.cancel()
+            element.rpc_timer = None
+        if element.properties is not None and element.properties.correlation_id:
+            correlation_id = element.properties.correlation_id
+            if self._rpc_queue.get(correlation_id) is element:
+                del self._rpc_queue[correlation_id]
+
+    def _expire_rpc(self, element: PublishesMessage):
+        element.rpc_timer = None
+        self._discard_rpc(element)
+        self._rpc_stats['timeouts'] += 1
+        if element.rpc_future is not None:
+            if not element.rpc_future.done():
+                element.rpc_future.set_exception(asyncio.TimeoutError('RPC to %s|%s timed out' % (element.exchange, element.routing_key)))
+        else:
+            LOGGER.warning('RPC to %s|%s got no response in time, its callback were dropped', element.exchange, element.routing_key)
+
+    def _on_rpc_future_done(self, element: PublishesMessage, future: asyncio.Future):
+        if future.cancelled() and not element.expired:
+            self._discard_rpc(element)
+            self._rpc_stats['cancelled'] += 1
+
+    def query(self, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, timeout: Optional[float] = None) -> asyncio.Future:
+        """publishing a message and waiting response, cancelling the future
+        forgets the pending rpc
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param pika.BasicProperties properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the response, defaults to rpc_timeout
+
+        :return asyncio.Future of PublishesResponse, raises asyncio.TimeoutError
+            if no response arrived in time
+
+        """
+        future = asyncio.get_event_loop().create_future()
+        def on_response(ch, delivery, props, body):
+            if not future.done():
+                future.set_result(PublishesResponse(ch, delivery, props, body))
+        element = PublishesMessage(exchange, routing_key, message, properties, on_response)
+        element.rpc_future = future
+        if not self._enqueue(element):
+            future.set_exception(PublishNacked('Publishing queue of %s were full' % self._connection_info))
+            return future
+        self._watch_rpc(element, timeout)
+        future.add_done_callback(functools.partial(self._on_rpc_future_done, element))
+        if not self._publish_working:
+            self.start_publishing()
+        return future
+
+    def rpc_stats(self) -> Dict[str, Any]:
+        """Returns the rpc metrics, latency were measured from publish to
+        response in seconds
+
+        """
+        stats = self._rpc_stats
+        replies = stats['replies']
+        return {
+            'pending': len(self._rpc_queue),
+            'timers': len(self._rpc_timers),
+            'replies': replies,
+            'timeouts': stats['timeouts'],
+            'cancelled': stats['cancelled'],
+            'late_replies': stats['late_replies'],
+            'latency_avg': (stats['latency_total'] / replies) if replies else 0.0,
+            'latency_max': stats['latency_max'],
+        }
 
     def run(self):
         """Run the example consumer by connecting to RabbitMQ and then
@@ -776,7 +1721,7 @@ class RabbitMQWorker(object):
                 if not self._using_outside_ioloop:
                     self._connection.ioloop.start()
 
-    def stop(self):
+    def stop(self, drain_timeout: Optional[float] = None):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
         with RabbitMQ. When RabbitMQ confirms the cancellation, on_cancelok
         will be invoked by pika, which will then closing the channel and
@@ -786,36 +1731,70 @@ class RabbitMQWorker(object):
         communicate with RabbitMQ. All of the commands issued prior to starting
         the IOLoop will be buffered but not processed.
 
+        With drain_timeout, the consumers were cancelled first and the messages
+        in process were finished within drain_timeout seconds before closing
+        the connection, which then stops the IOLoop.
+
+        :param float drain_timeout: Seconds to wait for the messages in process
+
         """
         LOGGER.info('Stopping')
         self._closing = True
+        if drain_timeout and self._connection is not None and not self._connection.is_closed:
+            self._connection.ioloop.add_callback(self._stop_after_drain, drain_timeout)
+            return
+        self._flush_tracker()
         self.stop_consuming()
+        self._shutdown_pools()
         self._connection.ioloop.stop()
         LOGGER.info('Stopped')
 
+    async def _stop_after_drain(self, drain_timeout: float):
+        if not await self.drain(drain_timeout):
+            LOGGER.warning('%d messages on %s were still in process after draining %s seconds',
+                           self._consuming_inflight, self._connection_info, str(drain_timeout))
+        self._flush_tracker()
+        self._shutdown_pools()
+        if self._connection.is_closed:
+            self._connection.ioloop.stop()
+        else:
+            self._connection.close()
+        LOGGER.info('Stopped')
+
     def setup_workers(self):
         for worker_cfg in self._workers.values():
-            if not worker_cfg.registered:
+            if worker_cfg.registered:
+                continue
+            if worker_cfg.worker_type == WORKER_TYPE.CONSUMER:
+                self.open_consumer_channel(worker_cfg)
+            else:
                 self.setup_exchange(worker_cfg)
         
         if self._rpc_started:
             self._ensure_rpc_response_queue()
 
-    def publish(self, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, callback: Optional[callable] = None):
-        """publishing a message
+    def publish(self, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, callback: Optional[callable] = None) -> bool:
+        """publishing a message, the message would be dropped when the
+        publishing queue were full, use publish_async to wait for the queue
+        instead
 
         :param str exchange: The exchange name of destination rabbitmq
         :param str routing_key: The routing key of destination rabbitmq
         :param str|bytes body: The message content
         :param pika.BasicProperties properties: The rabbitmq message properties
 
+        :return bool False if the message were dropped
+
         """
         element = PublishesMessage(exchange,
                                    routing_key,
                                    message,
                                    properties,
                                    callback)
-        self._publishes.append(element)
+        if not self._enqueue(element):
+            return False
+        if callable(callback):
+            self._watch_rpc(element, None)
 
         if properties:
             # check if the publish message belongs to rpc reply
@@ -823,8 +1802,96 @@ class RabbitMQWorker(object):
                 self._answer_reply_needed_message(properties)
         if not self._publish_working:
             self.start_publishing()
+        return True
+
+    def _enqueue(self, element: PublishesMessage) -> bool:
+        queued = len(self._publishes)
+        stats = self._publish_stats
+        if queued >= self.publish_queue_limit:
+            if not stats['dropped']:
+                LOGGER.error('Publishing queue of %s reached its limit %d, messages were dropped',
+                             self._connection_info, self.publish_queue_limit)
+            stats['dropped'] += 1
+            return False
+        self._encode(element)
+        self._publishes.append(element)
+        queued += 1
+        if queued > stats['queue_peak']:
+            stats['queue_peak'] = queued
+        if queued >= self.publish_high_watermark and self._publish_writable.is_set():
+            self._publish_writable.clear()
+        return True
+
+    def _encode(self, element: PublishesMessage):
+        properties = element.properties
+        body, content_type, content_encoding = self.codecs.encode(element.message,
+                                                                  properties.content_type if properties else None,
+                                                                  properties.content_encoding if properties else None,
+                                                                  self._publish_codec_stats)
+        element.message = body
+        if content_type or content_encoding:
+            overrides = {}
+            if content_type:
+                overrides['content_type'] = content_type
+            if content_encoding:
+                overrides['content_encoding'] = content_encoding
+            element.properties = clone_properties(properties, **overrides) if properties else pika.BasicProperties(**overrides)
+
+    async def publish_async(self, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, callback: Optional[callable] = None) -> bool:
+        """publishing a message, waits while the publishing queue were above
+        its high watermark until it drains down to the low watermark
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param pika.BasicProperties properties: The rabbitmq message properties
+
+        """
+        while not self._publish_writable.is_set():
+            await self._publish_writable.wait()
+        return self.publish(exchange, routing_key, message, properties, callback)
+
+    async def publish_confirmed(self, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, timeout: Optional[float] = None) -> bool:
+        """publishing a mandatory message and waiting for its broker
+        confirmation, at most confirm_max_inflight calls were waiting at once,
+        the unconfirmed messages were republished after reconnecting
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param pika.BasicProperties properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the confirmation, None waits forever
+
+        :return True once the broker acked the message
+        :raises PublishNacked: The broker nacked the message
+        :raises PublishReturned: The message were unroutable
+        :raises asyncio.TimeoutError: No confirmation within timeout
 
-    def consume(self, exchange, exchange_type, binding_key, queue, durable, callback, auto_ack = True, exchange_durable = None, prefetch_count=20):
+        """
+        await self._confirm_slots.acquire()
+        try:
+            if not self._confirm_enabled:
+                self._confirm_enabled = True
+                # the channels opened later were enabled once opened
+                for pub in self._publish_channels:
+                    if pub.is_open:
+                        self.enable_delivery_confirmations(pub)
+            while not self._publish_writable.is_set():
+                await self._publish_writable.wait()
+            element = PublishesMessage(exchange, routing_key, message, properties)
+            element.confirm_future = asyncio.get_event_loop().create_future()
+            if not self._enqueue(element):
+                raise PublishNacked('Publishing queue of %s were full' % self._connection_info)
+            if not self._publish_working:
+                self.start_publishing()
+            if timeout is None:
+                return await element.confirm_future
+            return await asyncio.wait_for(element.confirm_future, timeout)
+        finally:
+            self._confirm_slots.release()
+
+    def consume(self, exchange, exchange_type, binding_key, queue, durable, callback, auto_ack = True, exchange_durable = None, prefetch_count=20, max_concurrency=None, prefetch_max=None,
+                execution_mode=EXECUTION_MODE.INLINE, pool_size=None, decode_body=False):
         """Consumes a message
 
         :param str exchange: The exchange name of destination rabbitmq
@@ -837,6 +1904,16 @@ class RabbitMQWorker(object):
         :param bool auto_ack: Enable manually ack when set to False
         :param bool exchange_durable: if the exchange is durable
         :param int prefetch_count: each consume fetch count, default 20
+        :param int max_concurrency: callbacks running at once, defaults to prefetch_count
+        :param int prefetch_max: tunes prefetch count by the callback latency
+            up to prefetch_max when greater than prefetch_count
+        :param str execution_mode: runs synchronous callbacks 'inline' on the
+            ioloop, in a 'thread' pool or in a 'process' pool, pooled callbacks
+            were called with None as the channel and require auto_ack, process
+            pooled callbacks and their results must be picklable
+        :param int pool_size: workers of the pool
+        :param bool decode_body: the callback got the body deserialized by its
+            content type, such as a dict of application/json, otherwise bytes
 
         """
         key = '%s:%s:%s' % (exchange, binding_key, queue)
@@ -855,7 +1932,75 @@ class RabbitMQWorker(object):
         worker_cfg = WorkerDelegate(WORKER_TYPE.CONSUMER, 
                                     amqp_properties,
                                     callback,
-                                    prefetch_count=prefetch_count)
+                                    prefetch_count=prefetch_count,
+                                    max_concurrency=max_concurrency,
+                                    prefetch_max=prefetch_max,
+                                    execution_mode=execution_mode,
+                                    pool_size=pool_size,
+                                    decode_body=decode_body)
+        worker_cfg.codecs = self.codecs
+        self._workers[key] = worker_cfg
+        if self._channel:
+            self.setup_workers()
+
+    def consume_batch(self, exchange, exchange_type, binding_key, queue, durable, callback, max_batch=100, max_wait_ms=200, exchange_durable=None, prefetch_count=None, max_concurrency=1,
+                      requeue_failed=True, execution_mode=EXECUTION_MODE.INLINE, pool_size=None, decode_body=False):
+        """Consumes messages in batches, callback(ch, messages) were called
+        once with up to max_batch DeliveredMessage gathered within max_wait_ms
+        since the first of them arrived, so that the handlers could use bulk
+        inserts.
+
+        The callback returns None or True when the whole batch succeeded,
+        False when the whole batch failed, or the positions of the failed
+        messages in the batch. The succeeded messages were acked with
+        multiple=True and the failed ones were nacked one by one.
+
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param callable callback: callback(ch, messages) for each batch
+        :param int max_batch: messages count of a batch at most
+        :param int max_wait_ms: milliseconds waiting for a batch to fill up
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, defaults to
+            twice max_batch so that the next batch fills while one runs
+        :param int max_concurrency: batches running at once
+        :param bool requeue_failed: requeue the failed messages when nacking
+        :param str execution_mode: runs synchronous callbacks 'inline' on the
+            ioloop, in a 'thread' pool or in a 'process' pool
+        :param int pool_size: workers of the pool
+        :param bool decode_body: the bodies of the messages were deserialized
+            by their content type
+
+        """
+        max_batch = max(1, int(max_batch))
+        key = '%s:%s:%s' % (exchange, binding_key, queue)
+        if key in self._workers:
+            LOGGER.error('Consumes a queue by exchange:%s binding_key:%s queue:%s while the consumer already registered.', exchange, binding_key, queue)
+            return
+        amqp_properties = {
+            'exchange': exchange,
+            'exchange_type': exchange_type,
+            'exchange_durable': (durable if exchange_durable is None else exchange_durable),
+            'routing_key': binding_key,
+            'queue': queue,
+            'durable': durable,
+            'auto_ack': True,
+        }
+        worker_cfg = WorkerDelegate(WORKER_TYPE.CONSUMER,
+                                    amqp_properties,
+                                    callback,
+                                    prefetch_count=(prefetch_count or max_batch * 2),
+                                    max_concurrency=max_concurrency,
+                                    execution_mode=execution_mode,
+                                    pool_size=pool_size,
+                                    decode_body=decode_body)
+        worker_cfg.codecs = self.codecs
+        worker_cfg.batch_size = max_batch
+        worker_cfg.batch_wait = max(0, max_wait_ms) / 1000.0
+        worker_cfg.requeue_failed = requeue_failed
         self._workers[key] = worker_cfg
         if self._channel:
             self.setup_workers()
@@ -891,26 +2036,109 @@ class RabbitMQWorker(object):
         if self._channel:
             self.setup_workers()
 
-    @tornado.gen.coroutine
-    def _publish_tracker(self, message: bytes, properties: pika.BasicProperties):
-        """If the class is not stopping, publish a message to RabbitMQ,
-        appending a list of deliveries with the message number that was sent.
-        This list will be used to check for delivery confirmations in the
-        on_delivery_confirmations method.
-
-        Once the message has been sent, schedule another message to be sent.
-        The main reason I put scheduling in was just so you can get a good idea
-        of how the process is flowing by slowing down and speeding up the
-        delivery intervals by changing the publishing_interval constant in the
-        class.
+    def _tracker_sampled(self, exchange: str, routing_key: str, correlation_id: str) -> bool:
+        rate = self.tracker_sample_rate
+        if self.tracker_sample_rates:
+            rates = self.tracker_sample_rates
+            rate = rates.get('%s:%s' % (exchange, routing_key), rates.get(exchange, rate))
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        return zlib.crc32(correlation_id.encode('utf-8')) % 10000 < rate * 10000
+
+    def _publish_tracker(self, direction: str, exchange: str, routing_key: str, message: bytes, properties: pika.BasicProperties, pub: Optional[PublishChannel] = None):
+        """Tracks a consumed or published message to the tracker queue if it
+        were sampled, by a copy of the message or by a record of the batch
+        envelope when tracker_batch_size were greater than 1
 
         """
-        if not self.tracker_queue_name or self._channel is None or not self._channel.is_open:
+        if not self.tracker_queue_name:
+            return
+        stats = self._tracker_stats
+        if not self._tracker_sampled(exchange, routing_key, properties.correlation_id):
+            stats['sampled_out'] += 1
             return
+        stats['tracked'] += 1
+        if self.tracker_batch_size > 1:
+            self._tracker_records.append(self._tracker_record(direction, exchange, routing_key, message, properties))
+            if len(self._tracker_records) >= self.tracker_batch_size:
+                self._flush_tracker()
+            elif self._tracker_timer is None:
+                self._tracker_timer = self._connection.ioloop.call_later(self.tracker_flush_interval, self._flush_tracker)
+            return
+        pub = pub or self._next_publish_channel()
+        if pub is None:
+            stats['dropped'] += 1
+            return
+        self._basic_publish_tracker(pub, message, properties)
+
+    def _basic_publish_tracker(self, pub: PublishChannel, message: bytes, properties: pika.BasicProperties):
+        if self.tracker_metadata_only:
+            headers = dict(properties.headers) if properties.headers else {}
+            headers['X-Body-Size'] = len(message)
+            headers['X-Body-Sha1'] = hashlib.sha1(message).hexdigest()
+            pub.basic_publish('', self.tracker_queue_name, b'', clone_properties(properties, headers=headers))
+            return
+        pub.basic_publish('', self.tracker_queue_name,
+                          message if self.tracker_message_content else b'',
+                          properties)
 
-        self._channel.basic_publish('', self.tracker_queue_name,
-                                    message if self.tracker_message_content else bytes('', 'utf-8'),
-                                    properties)
+    def _tracker_record(self, direction: str, exchange: str, routing_key: str, message: bytes, properties: pika.BasicProperties) -> Dict[str, Any]:
+        record = {
+            'direction': direction,
+            'exchange': exchange,
+            'routing_key': routing_key,
+            'correlation_id': properties.correlation_id,
+            'message_id': properties.message_id,
+            'reply_to': properties.reply_to,
+            'app_id': properties.app_id,
+            'content_type': properties.content_type,
+            'content_encoding': properties.content_encoding,
+            'timestamp': properties.timestamp,
+            'tracked_at': time.time(),
+            'size': len(message),
+        }
+        if self.tracker_metadata_only:
+            record['sha1'] = hashlib.sha1(message).hexdigest()
+        elif self.tracker_message_content:
+            # the encoded body were kept as base64 within the json envelope
+            record['body'] = base64.b64encode(message).decode('ascii')
+        return record
+
+    def _flush_tracker(self):
+        """Publishes the tracked records as one json envelope, encoded and
+        compressed by the codecs of the worker
+        """
+        if self._tracker_timer is not None:
+            self._connection.ioloop.remove_timeout(self._tracker_timer)
+            self._tracker_timer = None
+        records = self._tracker_records
+        if not records:
+            return
+        self._tracker_records = []
+        pub = self._next_publish_channel()
+        if pub is None or not self.tracker_queue_name:
+            self._tracker_stats['dropped'] += len(records)
+            return
+        body, content_type, content_encoding = self.codecs.encode({'worker_host': self.worker_hostname, 'records': records})
+        properties = pika.BasicProperties(content_type=content_type,
+                                          content_encoding=content_encoding,
+                                          timestamp=int(time.time()),
+                                          headers={'X-Tracker-Records': len(records)})
+        try:
+            pub.basic_publish('', self.tracker_queue_name, body, properties)
+            self._tracker_stats['envelopes'] += 1
+        except Exception as e:
+            LOGGER.warning('Publishing %d tracker records failed with error:%s', len(records), str(e))
+            self._tracker_stats['dropped'] += len(records)
+
+    def tracker_stats(self) -> Dict[str, Any]:
+        """Returns the tracking metrics
+        """
+        stats = dict(self._tracker_stats)
+        stats['pending'] = len(self._tracker_records)
+        return stats
 
 @singleton
 class RabbitMQFactory(object):
@@ -919,21 +2147,38 @@ class RabbitMQFactory(object):
         """Constructs a RabbitMQ operation factory
 
         """
-        self._instances: Dict[str, WorkerDelegate] = {}
+        self._instances: Dict[str, RabbitMQWorker] = {}
+        # connections of each virtual host, the first one were the instance
+        # used for publishing and rpc
+        self._shards: Dict[str, List[RabbitMQWorker]] = {}
         self._default_virtual_host = None
         self._custom_ioloop = None
         self._tracker_queue_name: str = ''
         self._tracker_message_content: bool = False
+        self._tracker_settings: Dict[str, Any] = {}
 
     def initialize(self, conn_info: Dict[str, Any]):
         """Initializing a RabbitMQ operation factory
 
-        :param dict conn_info: Connection configurations
+        :param dict conn_info: Connection configurations, 'connections' spreads
+            the consumers across several connections, 'publish_channels'
+            round-robins publishing across several channels, 'content_type',
+            'compression' and 'compress_threshold' configure the payload codecs
 
         """
         virtual_host = conn_info.get('virtual_host')
         if virtual_host in self._instances:
             return self._instances[virtual_host]
+        shards = [self._create_worker(conn_info) for _ in range(max(1, int(conn_info.get('connections', 1))))]
+        self._shards[virtual_host] = shards
+        self._instances[virtual_host] = shards[0]
+        if not self._default_virtual_host:
+            self._default_virtual_host = virtual_host
+
+        return shards[0]
+
+    def _create_worker(self, conn_info: Dict[str, Any]) -> RabbitMQWorker:
+        virtual_host = conn_info.get('virtual_host')
         socket_timeout = conn_info['sock_timeout'] if 'sock_timeout' in conn_info else RABBIT_MQ_DEFAULTS.SOCKET_TIMEOUT
         heartbeat_interval = conn_info['heartbeat'] if 'heartbeat' in conn_info else RABBIT_MQ_DEFAULTS.HEARTBEAT_INTERVAL
         amqp_instance = RabbitMQWorker(host=conn_info.get('host'),
@@ -942,17 +2187,38 @@ class RabbitMQFactory(object):
                                         password=conn_info.get('password'),
                                         virtual_host=virtual_host,
                                         socket_timeout=socket_timeout,
-                                        hb_interval=heartbeat_interval)
+                                        hb_interval=heartbeat_interval,
+                                        publish_high_watermark=conn_info.get('publish_high_watermark', RABBIT_MQ_DEFAULTS.PUBLISH_HIGH_WATERMARK),
+                                        publish_low_watermark=conn_info.get('publish_low_watermark', RABBIT_MQ_DEFAULTS.PUBLISH_LOW_WATERMARK),
+                                        publish_queue_limit=conn_info.get('publish_queue_limit', RABBIT_MQ_DEFAULTS.PUBLISH_QUEUE_LIMIT),
+                                        publish_batch_size=conn_info.get('publish_batch_size', RABBIT_MQ_DEFAULTS.PUBLISH_BATCH_SIZE),
+                                        confirm_max_inflight=conn_info.get('confirm_max_inflight', RABBIT_MQ_DEFAULTS.CONFIRM_MAX_INFLIGHT),
+                                        rpc_timeout=conn_info.get('rpc_timeout', RABBIT_MQ_DEFAULTS.RPC_TIMEOUT),
+                                        publish_channels=conn_info.get('publish_channels', 1),
+                                        content_type=conn_info.get('content_type', CONTENT_TYPE_JSON),
+                                        compression=conn_info.get('compression'),
+                                        compress_threshold=conn_info.get('compress_threshold', RABBIT_MQ_DEFAULTS.COMPRESS_THRESHOLD),
+                                        connection_class=conn_info.get('connection_class'))
         amqp_instance.set_using_outside_ioloop(True)
 
         amqp_instance.tracker_queue_name = self._tracker_queue_name
         amqp_instance.tracker_message_content = self._tracker_message_content
-        self._instances[virtual_host] = amqp_instance
-        if not self._default_virtual_host:
-            self._default_virtual_host = virtual_host
-
+        for name, value in self._tracker_settings.items():
+            setattr(amqp_instance, name, value)
         return amqp_instance
 
+    def _shard_of(self, virtual_host: str, queue: str, connection: Optional[int] = None) -> RabbitMQWorker:
+        """Returns the connection consuming the queue, by the given index or
+        by the hash of the queue name so that a queue stays on one connection
+        """
+        shards = self._shards[virtual_host]
+        if connection is None:
+            connection = zlib.crc32(str(queue).encode('utf-8'))
+        return shards[connection % len(shards)]
+
+    def _all_workers(self) -> List[RabbitMQWorker]:
+        return [inst for shards in self._shards.values() for inst in shards]
+
     def set_custom_ioloop(self, custom_ioloop):
         """Specifies a custom ioloop, this method should be called before run
 
@@ -967,17 +2233,64 @@ class RabbitMQFactory(object):
         """Setup global tracker queue name, this would affect all workers
         """
         self._tracker_queue_name = queue_name
-        for inst in self._instances.values():
+        for inst in self._all_workers():
             inst.tracker_queue_name = self._tracker_queue_name
 
     def enable_tracker_message_content(self, enabled: bool):
         """Setup global tracker queue name, this would affect all workers
         """
         self._tracker_message_content = True if enabled else False
-        for inst in self._instances.values():
+        for inst in self._all_workers():
             inst.tracker_message_content = self._tracker_message_content
 
-    def consume(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, callback: callable, auto_ack: bool = True, exchange_durable: bool = None, prefetch_count=20):
+    def _set_tracker_settings(self, **settings):
+        self._tracker_settings.update(settings)
+        for inst in self._all_workers():
+            for name, value in settings.items():
+                setattr(inst, name, value)
+
+    def set_tracker_sampling(self, rate: float = 1.0, rates: Optional[Dict[str, float]] = None):
+        """Tracks a ratio of the messages, decided by their correlation ids so
+        that a request and its reply were tracked together, this would affect
+        all workers
+
+        :param float rate: default ratio between 0 and 1
+        :param dict rates: ratios by 'exchange' or 'exchange:routing_key'
+
+        """
+        self._set_tracker_settings(tracker_sample_rate=float(rate), tracker_sample_rates=dict(rates or {}))
+
+    def set_tracker_batching(self, batch_size: int, flush_interval: float = RABBIT_MQ_DEFAULTS.TRACKER_FLUSH_INTERVAL):
+        """Aggregates the tracked messages into json envelopes published once
+        batch_size records were collected or flush_interval seconds passed,
+        this would affect all workers
+
+        :param int batch_size: records per envelope, 1 tracks a copy per message
+        :param float flush_interval: seconds an envelope waits for filling up
+
+        """
+        self._set_tracker_settings(tracker_batch_size=max(1, int(batch_size)), tracker_flush_interval=flush_interval)
+
+    def enable_tracker_metadata_only(self, enabled: bool):
+        """Tracks the properties with the body size and sha1 instead of the
+        body, this would affect all workers
+        """
+        self._set_tracker_settings(tracker_metadata_only=True if enabled else False)
+
+    def tracker_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the tracking metrics by virtual host
+        """
+        stats = {}
+        for vhost, shards in self._shards.items():
+            merged = {}
+            for inst in shards:
+                for k, v in inst.tracker_stats().items():
+                    merged[k] = merged.get(k, 0) + v
+            stats[vhost] = merged
+        return stats
+
+    def consume(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, callback: callable, auto_ack: bool = True, exchange_durable: bool = None, prefetch_count=20, max_concurrency=None, prefetch_max=None, connection: Optional[int] = None,
+                execution_mode: str = EXECUTION_MODE.INLINE, pool_size: Optional[int] = None, decode_body: bool = False):
         """Consumes a message
 
         :param str virtual_host: The destination connection virtual host
@@ -990,9 +2303,51 @@ class RabbitMQFactory(object):
           Basic.ConsumeOk.
         :param bool auto_ack: Enable manually ack when set to False
         :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, default 20
+        :param int max_concurrency: callbacks running at once, defaults to prefetch_count
+        :param int prefetch_max: tunes prefetch count by the callback latency
+            up to prefetch_max when greater than prefetch_count
+        :param int connection: index of the connection consuming the queue,
+            defaults to the hash of the queue name
+        :param str execution_mode: runs synchronous callbacks 'inline' on the
+            ioloop, in a 'thread' pool or in a 'process' pool
+        :param int pool_size: workers of the pool
+        :param bool decode_body: the callback got the body deserialized by its content type
 
         """
-        self._instances[virtual_host].consume(exchange, exchange_type, binding_key, queue, durable, callback, auto_ack, exchange_durable, prefetch_count=prefetch_count)
+        self._shard_of(virtual_host, queue, connection).consume(exchange, exchange_type, binding_key, queue, durable, callback, auto_ack, exchange_durable,
+                                              prefetch_count=prefetch_count, max_concurrency=max_concurrency, prefetch_max=prefetch_max,
+                                              execution_mode=execution_mode, pool_size=pool_size, decode_body=decode_body)
+
+    def consume_batch(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, callback: callable, max_batch: int = 100, max_wait_ms: int = 200,
+                      exchange_durable: bool = None, prefetch_count: Optional[int] = None, max_concurrency: int = 1, requeue_failed: bool = True, connection: Optional[int] = None,
+                      execution_mode: str = EXECUTION_MODE.INLINE, pool_size: Optional[int] = None, decode_body: bool = False):
+        """Consumes messages in batches, see RabbitMQWorker.consume_batch
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str exchange_type: The exchange type of destination rabbitmq
+        :param str binding_key: The routing key of destination rabbitmq
+        :param str queue: The destination queue
+        :param bool durable: If the queue is durable
+        :param callable callback: callback(ch, messages) for each batch
+        :param int max_batch: messages count of a batch at most
+        :param int max_wait_ms: milliseconds waiting for a batch to fill up
+        :param bool exchange_durable: if the exchange is durable
+        :param int prefetch_count: each consume fetch count, defaults to twice max_batch
+        :param int max_concurrency: batches running at once
+        :param bool requeue_failed: requeue the failed messages when nacking
+        :param int connection: index of the connection consuming the queue,
+            defaults to the hash of the queue name
+        :param str execution_mode: runs synchronous callbacks 'inline' on the
+            ioloop, in a 'thread' pool or in a 'process' pool
+        :param int pool_size: workers of the pool
+        :param bool decode_body: the bodies of the messages were deserialized by their content type
+
+        """
+        self._shard_of(virtual_host, queue, connection).consume_batch(exchange, exchange_type, binding_key, queue, durable, callback, max_batch, max_wait_ms, exchange_durable,
+                                                    prefetch_count=prefetch_count, max_concurrency=max_concurrency, requeue_failed=requeue_failed,
+                                                    execution_mode=execution_mode, pool_size=pool_size, decode_body=decode_body)
 
     def initialize_publisher(self, virtual_host: str, exchange: str, exchange_type: str, binding_key: str, queue: str, durable: bool, exchange_durable: bool = None):
         """Initialize a publishing queue and exchange
@@ -1017,10 +2372,47 @@ class RabbitMQFactory(object):
         :param str|bytes body: The message content
         :param pika.BasicProperties properties: The rabbitmq message properties
 
+        :return bool False if the message were dropped
+
         """
-        self._instances[virtual_host].publish(exchange, routing_key, message, properties, callback)
+        return self._instances[virtual_host].publish(exchange, routing_key, message, properties, callback)
+
+    async def publish_async(self, virtual_host: str, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, callback: Optional[callable] = None):
+        """publishing a message, waits while the publishing queue of the
+        virtual host were above its high watermark
 
-    def query_mq(self, virtual_host: str, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None):
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param pika.BasicProperties properties: The rabbitmq message properties
+
+        """
+        return await self._instances[virtual_host].publish_async(exchange, routing_key, message, properties, callback)
+
+    async def publish_confirmed(self, virtual_host: str, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, timeout: Optional[float] = None) -> bool:
+        """publishing a mandatory message and waiting for its broker confirmation
+
+        :param str virtual_host: The destination connection virtual host
+        :param str exchange: The exchange name of destination rabbitmq
+        :param str routing_key: The routing key of destination rabbitmq
+        :param str|bytes body: The message content
+        :param pika.BasicProperties properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the confirmation, None waits forever
+
+        :return True once the broker acked the message
+        :raises PublishNacked: The broker nacked the message
+        :raises PublishReturned: The message were unroutable
+
+        """
+        return await self._instances[virtual_host].publish_confirmed(exchange, routing_key, message, properties, timeout)
+
+    def publish_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the publishing metrics by virtual host
+        """
+        return {vhost: inst.publish_stats() for vhost, inst in self._instances.items()}
+
+    def query_mq(self, virtual_host: str, exchange: str, routing_key: str, message: bytes, properties: Optional[pika.BasicProperties] = None, timeout: Optional[float] = None) -> asyncio.Future:
         """publishing a message and waiting response
 
         :param str virtual_host: The destination connection virtual host
@@ -1028,21 +2420,34 @@ class RabbitMQFactory(object):
         :param str routing_key: The routing key of destination rabbitmq
         :param str|bytes body: The message content
         :param pika.BasicProperties properties: The rabbitmq message properties
+        :param float timeout: Seconds to wait for the response, defaults to the rpc_timeout of the connection
 
-        :return tornado.gen.Future of PublishesResponse
+        :return asyncio.Future of PublishesResponse, raises asyncio.TimeoutError
+            if no response arrived in time
+
+        """
+        return self._instances[virtual_host].query(exchange, routing_key, message, properties, timeout)
+
+    def rpc_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the rpc metrics by virtual host
+        """
+        return {vhost: inst.rpc_stats() for vhost, inst in self._instances.items()}
 
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the consuming metrics by virtual host and worker
         """
-        waiter = tornado.gen.Future()
-        callback = lambda ch, delivery, properties, body: waiter.set_result(PublishesResponse(ch, delivery, properties, body))
-        # todo: waiter timeout
-        self._instances[virtual_host].publish(exchange, routing_key, message, properties, callback)
-        return waiter
+        stats = {}
+        for vhost, shards in self._shards.items():
+            stats[vhost] = {}
+            for inst in shards:
+                stats[vhost].update(inst.consumer_stats())
+        return stats
 
     def run(self):
         # asyncio.set_event_loop(asyncio.new_event_loop())
-        for amqp_instance in self._instances.values():
+        for amqp_instance in self._all_workers():
             amqp_instance.run()
 
-    def stop(self):
-        for amqp_instance in self._instances.values():
-            amqp_instance.stop()
+    def stop(self, drain_timeout: Optional[float] = None):
+        for amqp_instance in self._all_workers():
+            amqp_instance.stop(drain_timeout)
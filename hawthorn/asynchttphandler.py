@@ -12,7 +12,7 @@ import tornado.gen
 import tornado.escape
 from .supports import singleton
 from .exceptionreporter import ExceptionReporter
-from .session import TornadoSession
+from .session import TornadoSession, SESSION_KEY, HandlerSessionDataManager
 
 LOG = logging.getLogger('tornadohandler')
 
@@ -29,11 +29,17 @@ routes = AsyncRoutes()
 class GeneralTornadoHandler(tornado.web.RequestHandler):
     """
     """
+    # loads the session of a blocking backend before the callback, otherwise
+    # callbacks reading the session await load_session()
+    preload_session = False
 
-    def initialize(self, callback, methods, ac=[]):
+    def initialize(self, callback, methods, ac=[], preload_session=None):
         self.callbacks = {}
         self._ac = []
-        self.session = TornadoSession(self)
+        self._session = None
+        self._session_saving = None
+        if preload_session is not None:
+            self.preload_session = preload_session
         if isinstance(methods, str):
             methods = [methods]
         for method in methods:
@@ -55,6 +61,47 @@ class GeneralTornadoHandler(tornado.web.RequestHandler):
             elif callable(ac):
                 self._ac.append(['', ac])
                 
+    @property
+    def session(self) -> TornadoSession:
+        """Session of the request, materialized at the first access only"""
+        if self._session is None:
+            self._session = TornadoSession(self)
+        return self._session
+
+    async def load_session(self) -> TornadoSession:
+        """Session of the request with its data loaded, a blocking session
+        backend were called on its executor rather than on the ioloop
+        """
+        await self.session.preload()
+        return self.session
+
+    async def prepare(self):
+        if self.preload_session and HandlerSessionDataManager().is_blocking() and self.get_cookie(SESSION_KEY):
+            await self.session.preload()
+
+    def finish(self, chunk=None):
+        """Finishes the response once the changed session were saved, so that the
+        next request of the client reads the saved session
+        """
+        if self._session_saving is not None:
+            return self._session_saving
+        if self._session is None or not self._session.is_dirty():
+            return super().finish(chunk)
+        self._session_saving = asyncio.ensure_future(self._finish_after_session_saved(chunk))
+        return self._session_saving
+
+    async def _finish_after_session_saved(self, chunk):
+        try:
+            await self._session.flush_async()
+        except Exception as e:
+            LOG.error('saving session of %s failed with error:%s', self.request.path, str(e))
+            if not self._headers_written:
+                # the client were told rather than losing the session silently
+                self.clear()
+                self.set_status(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+                chunk = None
+        return await super().finish(chunk)
+
     def set_default_headers(self):
         """Responses default headers"""
         if routes.default_headers:
@@ -78,7 +125,7 @@ class GeneralTornadoHandler(tornado.web.RequestHandler):
             await self._do_callback('OPTIONS', *args, **kwargs)
         else:
             self.set_status(http.HTTPStatus.NO_CONTENT)
-            self.finish()
+            await self.finish()
     
     async def patch(self, *args, **kwargs):
         await self._do_callback('PATCH', *args, **kwargs)
@@ -119,7 +166,7 @@ class GeneralTornadoHandler(tornado.web.RequestHandler):
             if is_reject:
                 self.write(reject_resson)
                 self.set_status(http.HTTPStatus.FORBIDDEN)
-                self.finish()
+                await self.finish()
                 return
 
             argsx = [self, self.request]
@@ -153,15 +200,15 @@ class GeneralTornadoHandler(tornado.web.RequestHandler):
 
             if isinstance(response, str):
                 self.write(response)
-                self.finish()
+                await self.finish()
             else:
                 # LOG.error("====== unknown response type:%s", str(response))
                 if not self._finished:
-                    self.finish()
+                    await self.finish()
         else:
             LOG.debug('not callable cb:', cb)
             self.set_status(http.HTTPStatus.METHOD_NOT_ALLOWED)
-            self.finish()
+            await self.finish()
 
 class PageNotFoundHandler(tornado.web.RequestHandler):
     def get(self):
@@ -175,6 +222,8 @@ def async_route(rule: str, **options):
     : methods list[GET|POST|DELETE|HEAD|OPTION]: allowed http methods
     
     : ac callable: access control function
+
+    : preload_session bool: loads the session before the callback
     """
     def decorator(f):
         # endpoint = options.pop('endpoint', None)
@@ -182,7 +231,8 @@ def async_route(rule: str, **options):
         #     endpoint = f.__name__
         ac = options.pop('ac', [])
 
-        routes.routes.append((rule, GeneralTornadoHandler, dict(callback=f, methods=options.pop('methods', ['GET']), ac=ac)))
+        routes.routes.append((rule, GeneralTornadoHandler, dict(callback=f, methods=options.pop('methods', ['GET']), ac=ac,
+                                                               preload_session=options.pop('preload_session', None))))
         return f
     return decorator
 
@@ -3,15 +3,42 @@
 
 import logging
 import datetime
+import time
+import json
+import math
+import random
+import asyncio
 import tornado.gen
 import aredis
+import redis
 
 from .supports import singleton
 from .modelutils import model_columns, DEFAULT_SKIP_FIELDS
+from .utilities import JsonEncoder, random_string
 from .cacher.filecache import FileCache
+from .cacher.codecs import create_codec
+from .cacher.shardedredis import ShardedRedis, SlotAwareRedisCluster, key_slot, group_keys
+from .cacher import scripts
 
 LOG = logging.getLogger('components.cacheproxy')
 
+GENERATION_POINTER_SUFFIX = '@generation'
+GENERATION_HISTORY_SUFFIX = '@generations'
+GENERATION_POINTER_TTL = 1.0
+
+# errors responded by the redis clients, such as WRONGTYPE
+RESPONSE_ERRORS = (aredis.exceptions.ResponseError, redis.exceptions.ResponseError)
+
+LOADING_LOCK_SUFFIX = '@lock'
+LOADING_LOCK_MILLIS = 5000
+LOADING_WAIT_INTERVAL = 0.05
+
+GET_OBJECTS_CONCURRENCY = 100
+# keys per SCAN call, and keys per DEL call when clearing by a key prefix
+SCAN_COUNT = 1000
+DELETE_BATCH_SIZE = 50
+INDEX_SCRIPT_BATCH_SIZE = 200
+
 @singleton
 class CacheProxy(object):
     """
@@ -20,10 +47,31 @@ class CacheProxy(object):
 
     def __init__(self):
         self.cache_inst = None
-    
+        self.generation_pointer_ttl = GENERATION_POINTER_TTL
+        self._generation_pointers = {}
+        # versioned prefixes by length descending, so that the longest one matches first
+        self._versioned_prefixes = []
+        self._loading_futures = {}
+        self._refreshing_futures = {}
+        self.codec = None
+        self._prefix_codecs = {}
+        self.hash_tag_index_keys = False
+        self._scripts = {}
+        self._scripts_inst = None
+
     def configure(self, conf: dict):
+        if conf.get('codec'):
+            self.set_codec(create_codec(conf))
+        self.generation_pointer_ttl = float(conf.get('generation_pointer_ttl', GENERATION_POINTER_TTL))
+        for key_prefix in conf.get('versioned_prefixes', []):
+            self.register_versioned_prefix(key_prefix)
+        self.hash_tag_index_keys = bool(conf.get('hash_tag_index_keys', False))
         if conf.get('type', None) == 'redis':
             self.configure_redis(conf)
+        elif conf.get('type', None) == 'redis-sharded':
+            self.configure_sharded_redis(conf)
+        elif conf.get('type', None) == 'redis-cluster':
+            self.configure_redis_cluster(conf)
         elif conf.get('type', None) == 'file':
             self.configure_filecache(conf.get('path', 'data/file-caching.db'))
         else:
@@ -34,6 +82,28 @@ class CacheProxy(object):
             db=redis_conf.get('db', 0), password=redis_conf.get('password', None), retry_on_timeout=True)
         return True
     
+    def configure_sharded_redis(self, redis_conf: dict):
+        """Distributes keys across standalone redis nodes by consistent hashing,
+        configured like {'type': 'redis-sharded', 'nodes': [{'host': 'cache1', 'port': 6379}, ...]}
+        """
+        nodes = redis_conf.get('nodes', [])
+        if not nodes:
+            LOG.error('configure sharded redis cacheproxy failed with no nodes')
+            return False
+        self.cache_inst = ShardedRedis(nodes)
+        return True
+
+    def configure_redis_cluster(self, redis_conf: dict):
+        """Connects to Redis Cluster by startup nodes, configured like
+        {'type': 'redis-cluster', 'nodes': [{'host': 'cache1', 'port': 7000}, ...]}
+        """
+        startup_nodes = [{'host': n.get('host', 'localhost'), 'port': n.get('port', 6379)} for n in redis_conf.get('nodes', [])]
+        if not startup_nodes:
+            startup_nodes = [{'host': redis_conf.get('host', 'localhost'), 'port': redis_conf.get('port', 6379)}]
+        self.cache_inst = SlotAwareRedisCluster(startup_nodes=startup_nodes, password=redis_conf.get('password', None),
+            max_connections=redis_conf.get('max_connections', 32), skip_full_coverage_check=True, retry_on_timeout=True)
+        return True
+
     def configure_filecache(self, cache_path: str):
         self.cache_inst = FileCache(cache_path)
 
@@ -41,10 +111,51 @@ class CacheProxy(object):
         if self.cache_inst == None:
             self.configure_filecache('data/file-caching.db')
 
-    @tornado.gen.coroutine
-    def get_object(self, key, keys):
+    def set_codec(self, codec, key_prefix=None):
+        """Sets the codec that objects were encoded into one binary value by,
+        instead of the default layout of one hash field per object field.
+
+        :param codec: cacher.codecs.CacheCodec instance, configuration of
+            cacher.codecs.create_codec, or None for the hash fields layout
+        :param str key_prefix: applies the codec to keys starting with the prefix
+            only, such as a SchemaCodec built from the model cached by the prefix
+        """
+        codec = create_codec(codec)
+        if key_prefix is None:
+            self.codec = codec
+        else:
+            self._prefix_codecs[key_prefix] = codec
+
+    def get_codec(self, key):
+        if self._prefix_codecs:
+            for key_prefix in sorted(self._prefix_codecs, key=len, reverse=True):
+                if key.startswith(key_prefix):
+                    return self._prefix_codecs[key_prefix]
+        return self.codec
+
+    async def get_object(self, key, keys):
         self.prepare()
-        res = yield self.cache_inst.hmget(key, keys)
+        key = await self.resolve_key(key)
+        codec = self.get_codec(key)
+        if codec is not None:
+            try:
+                val = await self.cache_inst.get(key)
+            except RESPONSE_ERRORS as e:
+                if 'WRONGTYPE' not in str(e):
+                    raise
+                # an object cached as a hash before the codec were configured
+                return await self._get_hash_object(key, keys)
+            if val is None and await self.cache_inst.type(key) in ('hash', b'hash'):
+                # backends that read a hash as a missing value
+                return await self._get_hash_object(key, keys)
+            obj = codec.decode(val)
+            if obj is None:
+                return False
+            return {k: obj.get(k) for k in keys}
+        return await self._get_hash_object(key, keys)
+
+    async def _get_hash_object(self, key, keys):
+        res = await self.cache_inst.hmget(key, keys)
         if not res:
             return False
         result = {}
@@ -60,31 +171,195 @@ class CacheProxy(object):
             result = False
         return result
     
-    @tornado.gen.coroutine
-    def get_objects(self, key, keys):
+    async def get_objects(self, key, keys):
+        """Gets objects indexed by the set of ``key``, the objects were loaded
+        in parallel, ``GET_OBJECTS_CONCURRENCY`` at a time. Keys of relations
+        cached with hash_tag_index_keys enabled should be built by index_cache_key
+        """
         self.prepare()
+        key = await self.resolve_key(key)
         results = []
-        idxes = yield self.get_sets_values(key)
-        for idx in idxes:
-            row = yield self.get_object(key+':'+idx, keys)
-            if row is not False:
-                results.append(row)
+        idxes = await self.get_sets_values(key)
+        for i in range(0, len(idxes), GET_OBJECTS_CONCURRENCY):
+            rows = await asyncio.gather(*[self.get_object(key+':'+idx, keys) for idx in idxes[i:i+GET_OBJECTS_CONCURRENCY]])
+            results.extend([row for row in rows if row is not False])
         return results
 
-    @tornado.gen.coroutine
-    def set_object(self, key, mapping, expire=None):
+    async def set_object(self, key, mapping, expire=None):
         if not mapping:
             return False
+        key = await self.resolve_key(key)
+        codec = self.get_codec(key)
+        if codec is not None:
+            await self.cache_inst.set(key, codec.encode(mapping), ex=expire)
+            return True
         for k,v in mapping.items():
             if v is None:
                 mapping[k] = ''
-        yield self.cache_inst.hmset(key, mapping, expire=expire)
+        await self.cache_inst.hmset(key, mapping)
+        if expire:
+            await self.cache_inst.expire(key, expire)
         return True
 
-    @tornado.gen.coroutine
-    def get_sets_values(self, key):
+    async def set_objects(self, items, expire=None):
+        """Set a batch of objects in one pipelined round trip
+
+        :param list items: list of (key, mapping) pairs
+        :param int expire: expire seconds applied to each key
+        """
+        self.prepare()
+        if not items:
+            return 0
+        pipe = await self._pipeline()
+        if pipe is None:
+            for key, mapping in items:
+                await self.set_object(key, mapping, expire=expire)
+            return len(items)
+        for key, mapping in items:
+            if not mapping:
+                continue
+            await self._pipe_object(pipe, await self.resolve_key(key), mapping, expire)
+        await pipe.execute()
+        return len(items)
+
+    async def _pipe_object(self, pipe, key, mapping, expire=None):
+        codec = self.get_codec(key)
+        if codec is not None:
+            await pipe.set(key, codec.encode(mapping), ex=expire)
+            return
+        await pipe.hmset(key, self._format_mapping(mapping))
+        if expire:
+            await pipe.expire(key, expire)
+
+    async def _pipeline(self):
+        if not hasattr(self.cache_inst, 'pipeline'):
+            return None
+        try:
+            pipe = await self.cache_inst.pipeline(transaction=False)
+        except NotImplementedError:
+            return None
+        return pipe
+
+    def _format_mapping(self, mapping):
+        return {k: ('' if v is None else v) for k, v in mapping.items()}
+
+    async def get_or_load(self, key, loader, ttl, stale_ttl=None, lock_millis=LOADING_LOCK_MILLIS, beta=1.0):
+        """Gets the cached value of key, or loads it by ``loader`` when it were missing.
+
+        Only one loader runs per key at a time: concurrent callers in the process
+        await the same loading, and other processes are excluded by a short lived
+        ``SET NX PX`` lock, they wait for the value that the lock holder stores.
+        A value older than ``ttl`` is served stale for ``stale_ttl`` more seconds
+        while it is refreshed in background, and a fresh value may be refreshed a
+        bit earlier than ``ttl`` by probabilistic early expiration weighted by
+        the loading time and ``beta``.
+
+        :param str key: cache key
+        :param callable loader: function or coroutine function returning the value,
+            the value should be json serializable
+        :param int ttl: seconds the loaded value were treated as fresh
+        :param int stale_ttl: seconds the value could be served stale after ttl, defaults to ttl
+        :param int lock_millis: expiry of the loading lock in milliseconds
+        :param float beta: early expiration factor, 0 disables early expiration
+        """
+        self.prepare()
+        key = await self.resolve_key(key)
+        if stale_ttl is None:
+            stale_ttl = ttl
+        envelope = await self._get_loaded_envelope(key)
+        if envelope is not None:
+            now = time.time()
+            expiry = envelope.get('exp', 0)
+            delta = envelope.get('delta', 0)
+            if beta > 0 and delta > 0:
+                # probabilistic early expiration, -log(random) is an exponential distributed factor
+                now -= delta * beta * math.log(max(random.random(), 1e-12))
+            if now >= expiry:
+                # stale while revalidate
+                fut = self._load_single_flight(key, loader, ttl, stale_ttl, lock_millis, wait=False)
+                fut.add_done_callback(self._on_background_loaded)
+            return envelope.get('v')
+        value = await self._load_single_flight(key, loader, ttl, stale_ttl, lock_millis, wait=True)
+        return value
+
+    async def _get_loaded_envelope(self, key):
+        val = await self.cache_inst.get(key)
+        if val is None:
+            return None
+        if isinstance(val, bytes):
+            val = val.decode()
+        try:
+            envelope = json.loads(val)
+        except ValueError:
+            return None
+        return envelope if isinstance(envelope, dict) and 'v' in envelope else None
+
+    def _load_single_flight(self, key, loader, ttl, stale_ttl, lock_millis, wait):
+        # a background refresh gives up to the other processes and its failure
+        # were only logged, so that the callers missing the value never join it
+        fut = self._loading_futures.get(key)
+        if fut is None and not wait:
+            fut = self._refreshing_futures.get(key)
+        if fut is None:
+            futures = self._loading_futures if wait else self._refreshing_futures
+            fut = asyncio.ensure_future(self._do_load(key, loader, ttl, stale_ttl, lock_millis, wait))
+            futures[key] = fut
+            fut.add_done_callback(lambda f: futures.pop(key, None))
+        return fut
+
+    def _on_background_loaded(self, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            LOG.warning('refreshing cache value in background failed with error:%s', str(fut.exception()))
+
+    async def _do_load(self, key, loader, ttl, stale_ttl, lock_millis, wait):
+        lock_key = key + LOADING_LOCK_SUFFIX
+        lock_token = random_string(16)
+        deadline = time.time() + lock_millis / 1000.0
+        while True:
+            locked = await self.cache_inst.set(lock_key, lock_token, px=lock_millis, nx=True)
+            if locked:
+                break
+            if not wait:
+                # another process is refreshing it
+                return None
+            await asyncio.sleep(LOADING_WAIT_INTERVAL)
+            envelope = await self._get_loaded_envelope(key)
+            if envelope is not None and envelope.get('exp', 0) > time.time():
+                return envelope.get('v')
+            if time.time() > deadline:
+                LOG.warning('waiting loading lock of %s timeout, loads it anyway', key)
+                break
+        try:
+            t1 = time.time()
+            if tornado.gen.is_coroutine_function(loader) or asyncio.iscoroutinefunction(loader):
+                value = await loader()
+            else:
+                value = loader()
+            now = time.time()
+            envelope = {'v': value, 'exp': now + ttl, 'delta': now - t1}
+            await self.cache_inst.set(key, json.dumps(envelope, cls=JsonEncoder), ex=int(math.ceil(ttl + stale_ttl)))
+        finally:
+            await self._release_lock(lock_key, lock_token)
+        return value
+
+    async def _release_lock(self, lock_key, lock_token):
+        """Deletes the lock only if it were still held by ``lock_token``, by one lua
+        script call so that a lock expired and taken by another loader were kept
+        """
+        script = self._script('RELEASE_LOCK')
+        if script is not None:
+            await script.execute([lock_key], [lock_token])
+            return
+        val = await self.cache_inst.get(lock_key)
+        if isinstance(val, bytes):
+            val = val.decode()
+        if val == lock_token:
+            await self.cache_inst.delete(lock_key)
+
+    async def get_sets_values(self, key):
         results = []
-        vals = yield self.cache_inst.smembers(key)
+        key = await self.resolve_key(key)
+        vals = await self.cache_inst.smembers(key)
         if not vals:
             return results
         for val in vals:
@@ -92,13 +367,12 @@ class CacheProxy(object):
             results.append(val)
         return results
 
-    @tornado.gen.coroutine
-    def add_sets_values(self, key, value):
-        yield self.cache_inst.sadd(key, value)
+    async def add_sets_values(self, key, value):
+        key = await self.resolve_key(key)
+        await self.cache_inst.sadd(key, value)
         
-    @tornado.gen.coroutine
-    def get_sets_values_extend(self, key, keys):
-        vals = yield self.get_sets_values(key)
+    async def get_sets_values_extend(self, key, keys):
+        vals = await self.get_sets_values(key)
         return self.parse_imploded_values(vals, keys)
 
     def parse_imploded_values(self, rows, keys):
@@ -121,31 +395,77 @@ class CacheProxy(object):
             results.append(one)
         return results
         
-    @tornado.gen.coroutine
-    def get_sorted_sets_values(self, key):
-        results = []
-        vals = yield self.zrange(key, 0, -1, withscores=True)
-        if not vals:
-            return results
-        for ele in vals:
-            val = ele[0]
-            val = val.decode() if isinstance(val, bytes) else val
-            results.append(val)
-        return results
+    async def get_sorted_sets_values(self, key, offset=0, limit=None, desc=False):
+        """Gets members of sorted set ``key`` ordered by score, ``limit`` members
+        from ``offset`` if limit were given
+        """
+        key = await self.resolve_key(key)
+        end = -1 if limit is None else offset + limit - 1
+        if limit is not None and limit <= 0:
+            return []
+        vals = await self.zrange(key, offset, end, desc=desc)
+        return [val.decode() if isinstance(val, bytes) else val for val in vals or []]
+
+    async def get_sorted_sets_page(self, key, count, cursor=None, min='-inf', max='+inf', desc=False):
+        """Gets a page of ``count`` members of sorted set ``key`` within the score
+        window [min, max] ordered by score, the next page were got by the returned
+        cursor. Unlike offsets, the cursor keeps its position while members before
+        it were added or removed.
+
+        :param str cursor: cursor returned by the previous page, None for the first page
+        :return tuple: ([(member, score), ...], next cursor or None for the last page)
+        """
+        key = await self.resolve_key(key)
+        skip = 0
+        if cursor:
+            score, _, skip = cursor.rpartition(':')
+            skip = int(skip)
+            if desc:
+                max = score
+            else:
+                min = score
+        if desc:
+            rows = await self.cache_inst.zrevrangebyscore(key, max, min, start=skip, num=count, withscores=True)
+        else:
+            rows = await self.cache_inst.zrangebyscore(key, min, max, start=skip, num=count, withscores=True)
+        rows = [(member.decode() if isinstance(member, bytes) else member, score) for member, score in rows or []]
+        if len(rows) < count:
+            return rows, None
+        last_score = rows[-1][1]
+        same_scores = 0
+        for _, score in reversed(rows):
+            if score != last_score:
+                break
+            same_scores += 1
+        if cursor and same_scores == len(rows) and float(cursor.rpartition(':')[0]) == last_score:
+            # the whole page shares the score of the cursor
+            same_scores += skip
+        return rows, '%r:%d' % (last_score, same_scores)
+
+    async def iter_sorted_sets_values(self, key, page_size=100, min='-inf', max='+inf', desc=False):
+        """Iterates (member, score) of sorted set ``key`` within the score window
+        page by page, such as `async for member, score in cacheproxy.iter_sorted_sets_values(key)`
+        """
+        cursor = None
+        while True:
+            rows, cursor = await self.get_sorted_sets_page(key, page_size, cursor, min, max, desc)
+            for row in rows:
+                yield row
+            if cursor is None:
+                break
     
-    @tornado.gen.coroutine
-    def get_sorted_sets_value_extend(self, key, keys):
-        vals = yield self.get_sorted_sets_values(key)
+    async def get_sorted_sets_value_extend(self, key, keys):
+        vals = await self.get_sorted_sets_values(key)
         return self.parse_imploded_values(vals, keys)
 
-    @tornado.gen.coroutine
-    def get_cache_value(self, key):
-        val = yield self.cache_inst.get(key)
+    async def get_cache_value(self, key):
+        key = await self.resolve_key(key)
+        val = await self.cache_inst.get(key)
         return val
 
-    @tornado.gen.coroutine
-    def scan_hash_keys(self, hash_key, key_match, count=1000, cursor=0):
-        res = yield self.cache_inst.hscan(hash_key, cursor, match=key_match, count=count)
+    async def scan_hash_keys(self, hash_key, key_match, count=1000, cursor=0):
+        hash_key = await self.resolve_key(hash_key)
+        res = await self.cache_inst.hscan(hash_key, cursor, match=key_match, count=count)
         keys = []
         next_cursor = 0
         if res:
@@ -154,8 +474,7 @@ class CacheProxy(object):
                 keys.append(k.decode() if isinstance(k, bytes) else str(k))
         return keys, next_cursor
     
-    @tornado.gen.coroutine
-    def find_hash_keys(self, hash_key, key_match, match_keys = {}):
+    async def find_hash_keys(self, hash_key, key_match, match_keys = {}):
         keys = []
         if not hash_key or not key_match or not match_keys:
             return keys
@@ -163,47 +482,52 @@ class CacheProxy(object):
         while next_cursor != 0:
             if next_cursor == -1:
                 next_cursor = 0
-            scanedKeys, next_cursor = yield self.scan_hash_keys(hash_key, key_match, cursor=next_cursor)
+            scanedKeys, next_cursor = await self.scan_hash_keys(hash_key, key_match, cursor=next_cursor)
             for k in scanedKeys:
                 if k in match_keys:
                     keys.append(k)
         return keys
 
-    @tornado.gen.coroutine
-    def get_all_hash_keys(self, hash_key_prefix, match_keys = {}):
-        res = yield self.cache_inst.hgetall(hash_key_prefix)
+    async def get_all_hash_keys(self, hash_key_prefix, match_keys = {}):
+        hash_key_prefix = await self.resolve_key(hash_key_prefix)
+        res = await self.cache_inst.hgetall(hash_key_prefix)
         result = []
         for row in res:
             a = row
         return result
         
-    @tornado.gen.coroutine
-    def clear_by_key_prefix(self, key_prefix):
-        keys = yield self.cache_inst.keys(key_prefix+'*')
-        del_keys = [[]]
-        i = 0
-        for k in keys:
-            del_keys[i].append(k.decode() if isinstance(k, bytes) else str(k))
-            if len(del_keys[i]) > 50:
-                i += 1
-                del_keys.append([])
-
-            if i > 10:
-                yield [self.cache_inst.delete(*dkeys) for dkeys in del_keys]
-                del_keys = [[]]
-                i = 0
-        
-        if del_keys[0]:
-            yield [self.cache_inst.delete(*dkeys) for dkeys in del_keys]
+    async def scan_keys(self, pattern):
+        """Iterates the keys matching ``pattern`` by SCAN, which unlike KEYS
+        does not block the server while walking a large keyspace
+        """
+        async for k in self.cache_inst.scan_iter(match=pattern, count=SCAN_COUNT):
+            yield k.decode() if isinstance(k, bytes) else str(k)
 
-    @tornado.gen.coroutine
-    def incr(self, key, expire = None):
-        yield self.cache_inst.incr(key)
+    async def clear_by_key_prefix(self, key_prefix, keep=None):
+        """Deletes the keys starting with ``key_prefix``, except those that
+        ``keep(key)`` returns true for
+        """
+        del_keys = []
+        async for k in self.scan_keys(key_prefix + '*'):
+            if keep is not None and keep(k):
+                continue
+            del_keys.append(k)
+            if len(del_keys) >= DELETE_BATCH_SIZE * 10:
+                await self._delete_keys(del_keys)
+                del_keys = []
+        if del_keys:
+            await self._delete_keys(del_keys)
+
+    async def _delete_keys(self, keys):
+        await asyncio.gather(*[self.cache_inst.delete(*keys[i:i+DELETE_BATCH_SIZE]) for i in range(0, len(keys), DELETE_BATCH_SIZE)])
+
+    async def incr(self, key, expire = None):
+        key = await self.resolve_key(key)
+        await self.cache_inst.incr(key)
         if expire:
-            yield self.cache_inst.expire(key, expire)
+            await self.cache_inst.expire(key, expire)
 
-    @tornado.gen.coroutine
-    def set(self, key, value, expire = None, px=None, nx=False, xx=False):
+    async def set(self, key, value, expire = None, px=None, nx=False, xx=False):
         """
         Set the value at key ``name`` to ``value``
 
@@ -217,20 +541,20 @@ class CacheProxy(object):
         ``xx`` if set to True, set the value at key ``name`` to ``value`` only
             if it already exists.
         """
-        yield self.cache_inst.set(key, value, ex=expire, px=px, nx=nx, xx=xx)
+        key = await self.resolve_key(key)
+        await self.cache_inst.set(key, value, ex=expire, px=px, nx=nx, xx=xx)
 
-    @tornado.gen.coroutine
-    def get(self, key):
-        val = yield self.cache_inst.get(key)
+    async def get(self, key):
+        key = await self.resolve_key(key)
+        val = await self.cache_inst.get(key)
         return val
 
-    @tornado.gen.coroutine
-    def delete(self, key):
-        val = yield self.cache_inst.delete(key)
+    async def delete(self, key):
+        key = await self.resolve_key(key)
+        val = await self.cache_inst.delete(key)
         return val
 
-    @tornado.gen.coroutine
-    def zrange(self, name, start, end, desc=False, withscores=False,
+    async def zrange(self, name, start, end, desc=False, withscores=False,
                score_cast_func=float):
         """
         Return a range of values from sorted set ``name`` between
@@ -245,38 +569,367 @@ class CacheProxy(object):
 
         ``score_cast_func`` a callable used to cast the score return value
         """
-        val = yield self.cache_inst.zrange(name, start, end, desc=desc, withscores=withscores, score_cast_func=score_cast_func)
+        name = await self.resolve_key(name)
+        val = await self.cache_inst.zrange(name, start, end, desc=desc, withscores=withscores, score_cast_func=score_cast_func)
         return val
 
-    @tornado.gen.coroutine
-    def is_exists_in_sets(self, key, value):
-        val = yield self.cache_inst.sismember(key, value)
+    async def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        """
+        Return a range of values from sorted set ``name`` between
+        ``start`` and ``end`` sorted in descending order.
+        """
+        name = await self.resolve_key(name)
+        val = await self.cache_inst.zrevrange(name, start, end, withscores=withscores, score_cast_func=score_cast_func)
         return val
 
-    @tornado.gen.coroutine
-    def add_to_cache_indexed_to_many(self, item, key_prefix, index_key, pk):
-        if not isinstance(item, dict):
-            item2 = item
-            item = {}
-            columns,_ = model_columns(item2)
-            for k in columns:
-                if k not in DEFAULT_SKIP_FIELDS:
-                    item[k] = getattr(item2, k)
-        pk_value = self.get_index_key_value(item, pk)
-        idx_value = self.get_index_key_value(item, index_key)
-        cache_key = key_prefix + idx_value
-        yield self.cache_inst.sadd(cache_key, pk_value)
-        cache_key += ':' + pk_value
-        yield self.set_object(cache_key, item)
-
-    @tornado.gen.coroutine
-    def del_from_cache_indexed_to_many(self, item, key_prefix, index_key, pk):
+    async def zrangebyscore(self, name, min, max, offset=None, limit=None, withscores=False, score_cast_func=float):
+        """
+        Return a range of values from sorted set ``name`` with scores
+        between ``min`` and ``max`` in ascending order.
+
+        ``min`` and ``max`` could be '-inf', '+inf', or prefixed by '(' to exclude the bound.
+
+        ``offset`` and ``limit`` pages the range, a negative limit returns all
+        values from offset.
+        """
+        name = await self.resolve_key(name)
+        offset, limit = self._score_range_limit(offset, limit)
+        val = await self.cache_inst.zrangebyscore(name, min, max, start=offset, num=limit, withscores=withscores, score_cast_func=score_cast_func)
+        return val
+
+    async def zrevrangebyscore(self, name, max, min, offset=None, limit=None, withscores=False, score_cast_func=float):
+        """
+        Return a range of values from sorted set ``name`` with scores
+        between ``min`` and ``max`` in descending order, paged like zrangebyscore.
+        """
+        name = await self.resolve_key(name)
+        offset, limit = self._score_range_limit(offset, limit)
+        val = await self.cache_inst.zrevrangebyscore(name, max, min, start=offset, num=limit, withscores=withscores, score_cast_func=score_cast_func)
+        return val
+
+    def _score_range_limit(self, offset, limit):
+        if offset is None and limit is None:
+            return None, None
+        return offset or 0, -1 if limit is None else limit
+
+    async def zadd(self, name, mapping, expire=None):
+        """Adds members of ``mapping`` like {member: score} into sorted set ``name``"""
+        name = await self.resolve_key(name)
+        pieces = []
+        for member, score in mapping.items():
+            pieces.append(score)
+            pieces.append(member)
+        val = await self.cache_inst.zadd(name, *pieces)
+        if expire:
+            await self.cache_inst.expire(name, expire)
+        return val
+
+    async def zrem(self, name, *values):
+        name = await self.resolve_key(name)
+        val = await self.cache_inst.zrem(name, *values)
+        return val
+
+    async def is_exists_in_sets(self, key, value):
+        key = await self.resolve_key(key)
+        val = await self.cache_inst.sismember(key, value)
+        return val
+
+    async def add_to_cache_indexed_to_many(self, item, key_prefix, index_key, pk):
+        await self.add_objects_to_cache_indexed_to_many([item], key_prefix, index_key, pk)
+
+    async def add_objects_to_cache_indexed_to_many(self, items, key_prefix, index_key, pk):
+        """Adds objects into index-to-many relations, the index set and the object
+        of all items were written by one lua script call per ``INDEX_SCRIPT_BATCH_SIZE``
+        items atomically. Backends not running scripts get the writes pipelined
+        with each object written before its index entry.
+        """
+        self.prepare()
+        if not items:
+            return 0
+        key_prefix = await self.resolve_key(key_prefix)
+        entries = [self._index_entry(self._object_as_dict(item), key_prefix, index_key, pk) for item in items]
+        script = self._index_script('ADD_INDEXED_OBJECTS')
+        if script is not None:
+            await self._execute_index_script(script, entries, self._add_index_script_args)
+            return len(entries)
+        pipe = await self._pipeline()
+        if pipe is None:
+            for cache_key, object_key, pk_value, item in entries:
+                await self.set_object(object_key, item)
+                await self.cache_inst.sadd(cache_key, pk_value)
+            return len(entries)
+        for cache_key, object_key, pk_value, item in entries:
+            await self._pipe_object(pipe, object_key, item)
+            await pipe.sadd(cache_key, pk_value)
+        await pipe.execute()
+        return len(entries)
+
+    def index_cache_key(self, key_prefix, idx_value):
+        """Key of the index set of an index-to-many relation, the index value is
+        wrapped as ``{hash tag}`` if hash_tag_index_keys were enabled, so that the
+        index set and its objects were kept on one node of sharded backends
+        """
+        if self.hash_tag_index_keys:
+            return '%s{%s}' % (key_prefix, idx_value)
+        return key_prefix + idx_value
+
+    def _object_as_dict(self, item):
+        if isinstance(item, dict):
+            return item
+        result = {}
+        columns,_ = model_columns(item)
+        for k in columns:
+            if k not in DEFAULT_SKIP_FIELDS:
+                result[k] = getattr(item, k)
+        return result
+
+    async def del_from_cache_indexed_to_many(self, item, key_prefix, index_key, pk):
+        await self.del_objects_from_cache_indexed_to_many([item], key_prefix, index_key, pk)
+
+    async def del_objects_from_cache_indexed_to_many(self, items, key_prefix, index_key, pk):
+        """Removes objects from index-to-many relations, batched like add_objects_to_cache_indexed_to_many"""
+        self.prepare()
+        if not items:
+            return 0
+        key_prefix = await self.resolve_key(key_prefix)
+        entries = [self._index_entry(item, key_prefix, index_key, pk) for item in items]
+        script = self._index_script('DEL_INDEXED_OBJECTS')
+        if script is not None:
+            await self._execute_index_script(script, entries, lambda entry: [entry[2]])
+            return len(entries)
+        for cache_key, object_key, pk_value, _ in entries:
+            await self.cache_inst.srem(cache_key, pk_value)
+            await self.cache_inst.delete(object_key)
+        return len(entries)
+
+    def _index_entry(self, item, key_prefix, index_key, pk):
         pk_value = self.get_index_key_value(item, pk)
-        idx_value = self.get_index_key_value(item, index_key)
-        cache_key = key_prefix + idx_value
-        yield self.cache_inst.srem(cache_key, pk_value)
-        cache_key += ':' + pk_value
-        yield self.cache_inst.delete(cache_key)
+        cache_key = self.index_cache_key(key_prefix, self.get_index_key_value(item, index_key))
+        return cache_key, cache_key + ':' + pk_value, pk_value, item
+
+    def _add_index_script_args(self, entry):
+        _, object_key, pk_value, item = entry
+        codec = self.get_codec(object_key)
+        if codec is not None:
+            return [pk_value, 's', 1, codec.encode(item)]
+        args = []
+        for k, v in self._format_mapping(item).items():
+            args.append(k)
+            args.append(v)
+        return [pk_value, 'h', len(args)] + args
+
+    def _index_script(self, name):
+        """Gets the index script ``name`` like _script, or None if the index sets and
+        objects were not guaranteed to be on one node of a distributed backend since
+        hash_tag_index_keys were disabled
+        """
+        if not self.hash_tag_index_keys and isinstance(self.cache_inst, (ShardedRedis, aredis.StrictRedisCluster)):
+            return None
+        return self._script(name)
+
+    def _script(self, name):
+        """Gets the lua script ``name`` of cacher.scripts registered on the backend,
+        the script is loaded once and called by its SHA. Returns None if the backend
+        could not run scripts
+        """
+        if self._scripts_inst is not self.cache_inst:
+            self._scripts = {}
+            self._scripts_inst = self.cache_inst
+        if name not in self._scripts:
+            script = None
+            if hasattr(self.cache_inst, 'register_script'):
+                script = self.cache_inst.register_script(getattr(scripts, name))
+            self._scripts[name] = script
+        return self._scripts[name]
+
+    def _shard_of(self, key):
+        if isinstance(self.cache_inst, aredis.StrictRedisCluster):
+            return key_slot(key)
+        elif isinstance(self.cache_inst, ShardedRedis):
+            return self.cache_inst.ring.get_node_index(key)
+        return 0
+
+    async def _execute_index_script(self, script, entries, make_args):
+        calls = []
+        for shard_entries, _ in group_keys(entries, lambda entry: self._shard_of(entry[0])).values():
+            for i in range(0, len(shard_entries), INDEX_SCRIPT_BATCH_SIZE):
+                keys = []
+                args = []
+                for entry in shard_entries[i:i+INDEX_SCRIPT_BATCH_SIZE]:
+                    keys.append(entry[0])
+                    keys.append(entry[1])
+                    args.extend(make_args(entry))
+                calls.append(script.execute(keys, args))
+        await asyncio.gather(*calls)
+
+    async def verify_cache_indexed_to_many(self, key_prefix, repair=False):
+        """Scans the index-to-many relations cached under ``key_prefix`` for
+        inconsistent entries, which are index members whose objects were missing,
+        and objects missing from the existing index set they belong to. Entries
+        were checked again before repairing, so that concurrent writes were kept.
+
+        :param str key_prefix: key prefix of the relations
+        :param bool repair: removes the dangling index members and the orphan objects
+        :return dict: {'dangling': {index key: [pk, ...]}, 'orphans': [object key, ...]}
+        """
+        self.prepare()
+        key_prefix = await self.resolve_key(key_prefix)
+        key_set = set()
+        async for k in self.scan_keys(key_prefix + '*'):
+            # skips the generation pointers, versioned namespaces and loading locks
+            if not k.startswith('@', len(key_prefix)) and not k.endswith(LOADING_LOCK_SUFFIX):
+                key_set.add(k)
+        keys = sorted(key_set)
+        types = await self._gather_chunked(self.cache_inst.type, keys)
+        index_keys = [k for k, t in zip(keys, types) if (t.decode() if isinstance(t, bytes) else t) == 'set']
+        index_members = dict(zip(index_keys, [set(members) for members in await self._gather_chunked(self.get_sets_values, index_keys)]))
+        dangling = {}
+        for cache_key, members in index_members.items():
+            missing = sorted(pk_value for pk_value in members if cache_key + ':' + pk_value not in key_set)
+            if missing:
+                dangling[cache_key] = missing
+        orphans = []
+        for k in keys:
+            if k in index_members:
+                continue
+            owners = list(self._owning_indexes(k, index_members))
+            if owners and not any(pk_value in index_members[cache_key] for cache_key, pk_value in owners):
+                orphans.append(k)
+        LOG.info('verified cache relations of %s, %d index sets, %d dangling index members, %d orphan objects', key_prefix,
+            len(index_keys), sum(len(v) for v in dangling.values()), len(orphans))
+        if repair:
+            for cache_key, missing in dangling.items():
+                exists = await self._gather_chunked(self.cache_inst.exists, [cache_key + ':' + pk_value for pk_value in missing])
+                missing = [pk_value for pk_value, e in zip(missing, exists) if not e]
+                if missing:
+                    await self.cache_inst.srem(cache_key, *missing)
+            for k in orphans:
+                owned = False
+                for cache_key, pk_value in self._owning_indexes(k, index_members):
+                    if await self.cache_inst.sismember(cache_key, pk_value):
+                        owned = True
+                        break
+                if not owned:
+                    await self.cache_inst.delete(k)
+        return {'dangling': dangling, 'orphans': orphans}
+
+    def _owning_indexes(self, object_key, index_keys):
+        """Yields (index key, pk) of each index set in ``index_keys`` that the object
+        key could belong to, the whole suffix after the index key is the pk since
+        composite pks were joined by ':' as well
+        """
+        pos = object_key.find(':')
+        while pos >= 0:
+            if object_key[:pos] in index_keys:
+                yield object_key[:pos], object_key[pos+1:]
+            pos = object_key.find(':', pos + 1)
+
+    async def _gather_chunked(self, func, args):
+        results = []
+        for i in range(0, len(args), GET_OBJECTS_CONCURRENCY):
+            results.extend(await asyncio.gather(*[func(arg) for arg in args[i:i+GET_OBJECTS_CONCURRENCY]]))
+        return results
+
+    def generation_key_prefix(self, key_prefix, generation):
+        """Key prefix of the versioned namespace of ``key_prefix`` by generation"""
+        return '%s@g%s:' % (key_prefix, str(generation))
+
+    def register_versioned_prefix(self, key_prefix):
+        """Lookups of keys starting with ``key_prefix`` would be resolved into
+        the current generation namespace of the prefix. Every process reading
+        the prefix should register it, by the versioned_prefixes configuration,
+        before its loaders write generations.
+        """
+        if key_prefix not in self._generation_pointers:
+            self._generation_pointers[key_prefix] = [None, 0]
+            self._versioned_prefixes = sorted(self._generation_pointers, key=len, reverse=True)
+
+    def is_versioned_prefix(self, key_prefix):
+        return key_prefix in self._generation_pointers
+
+    async def get_current_generation(self, key_prefix, refresh=False):
+        """Gets current generation of a versioned key prefix, the pointer would
+        be cached locally for ``generation_pointer_ttl`` seconds
+        """
+        self.prepare()
+        pointer = self._generation_pointers.get(key_prefix)
+        now = time.time()
+        if pointer is not None and not refresh and pointer[1] > now:
+            return pointer[0]
+        val = await self.cache_inst.get(key_prefix + GENERATION_POINTER_SUFFIX)
+        if isinstance(val, bytes):
+            val = val.decode()
+        generation = str(val) if val else None
+        self._generation_pointers[key_prefix] = [generation, now + self.generation_pointer_ttl]
+        return generation
+
+    async def resolve_key(self, key):
+        """Resolves a key under a versioned prefix into its current generation namespace"""
+        if not self._versioned_prefixes or not isinstance(key, str):
+            return key
+        for key_prefix in self._versioned_prefixes:
+            if not key.startswith(key_prefix):
+                continue
+            if key.startswith('@g', len(key_prefix)):
+                # already resolved
+                return key
+            generation = await self.get_current_generation(key_prefix)
+            if generation is None:
+                return key
+            return self.generation_key_prefix(key_prefix, generation) + key[len(key_prefix):]
+        return key
+
+    def begin_generation(self, key_prefix):
+        """Starts a new generation of ``key_prefix``, loaders write into the returned
+        versioned key prefix and call commit_generation once finished
+
+        :return tuple: (generation, versioned key prefix)
+        """
+        generation = str(int(time.time() * 1000))
+        return generation, self.generation_key_prefix(key_prefix, generation)
+
+    async def commit_generation(self, key_prefix, generation, keep_generations=1, clear_unversioned=False):
+        """Flips the pointer of ``key_prefix`` to ``generation`` atomically, the
+        previous ``keep_generations`` generations are kept for in flight readers
+        and older ones are collected
+
+        :param bool clear_unversioned: deletes the plain keys of the prefix written
+            before it were versioned, which should only be set once every reader
+            resolves the pointer, see clear_unversioned_keys
+        """
+        self.prepare()
+        self.register_versioned_prefix(key_prefix)
+        history_key = key_prefix + GENERATION_HISTORY_SUFFIX
+        previous = await self.get_current_generation(key_prefix, refresh=True)
+        await self.cache_inst.sadd(history_key, generation)
+        await self.cache_inst.set(key_prefix + GENERATION_POINTER_SUFFIX, generation)
+        self._generation_pointers[key_prefix] = [generation, time.time() + self.generation_pointer_ttl]
+        LOG.info('cache prefix %s switched generation from %s to %s', key_prefix, str(previous), generation)
+        if clear_unversioned:
+            await self.clear_unversioned_keys(key_prefix)
+        await self.collect_generations(key_prefix, keep_generations)
+
+    async def collect_generations(self, key_prefix, keep_generations=1):
+        """Deletes generations of ``key_prefix`` except the current one and the
+        latest ``keep_generations`` previous ones
+        """
+        history_key = key_prefix + GENERATION_HISTORY_SUFFIX
+        current = await self.get_current_generation(key_prefix, refresh=True)
+        generations = await self.get_sets_values(history_key)
+        generations = sorted([g for g in generations if g != current], key=int, reverse=True)
+        for generation in generations[max(0, keep_generations):]:
+            LOG.info('collecting cache prefix %s generation %s', key_prefix, generation)
+            await self.clear_by_key_prefix(self.generation_key_prefix(key_prefix, generation))
+            await self.cache_inst.srem(history_key, generation)
+
+    async def clear_unversioned_keys(self, key_prefix):
+        """Deletes the plain keys of ``key_prefix`` left from before it were
+        versioned. Readers that did not register the prefix still read those
+        keys, so that it is called once every reader resolves the pointer.
+        """
+        self.prepare()
+        versioned_prefix = key_prefix + '@'
+        await self.clear_by_key_prefix(key_prefix, keep=lambda k: k.startswith(versioned_prefix))
 
     def get_index_key_value(self, item, index_key):
         idx_value = ''
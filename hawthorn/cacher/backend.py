@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+class CacheBackend(object):
+    """Protocol of the cache backends CacheProxy works on, the commands follow
+    the aredis client which is the reference backend, so that aredis clients
+    were used as they are and other backends implement this protocol.
+
+    All commands are native coroutines, backends doing blocking I/O should run
+    it out of the event loop thread, such as on an executor.
+    """
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        raise NotImplementedError
+
+    async def mget(self, keys):
+        raise NotImplementedError
+
+    async def mset(self, mapping):
+        raise NotImplementedError
+
+    async def delete(self, *keys):
+        raise NotImplementedError
+
+    async def keys(self, pattern='*'):
+        raise NotImplementedError
+
+    async def scan_iter(self, match=None, count=None):
+        """Iterates the keys matching ``match`` incrementally as an async
+        generator, backends without cursors iterate the keys of ``keys``
+        """
+        for key in await self.keys(match or '*'):
+            yield key
+
+    async def exists(self, key):
+        raise NotImplementedError
+
+    async def type(self, key):
+        raise NotImplementedError
+
+    async def incr(self, key, amount=1):
+        raise NotImplementedError
+
+    async def expire(self, key, seconds):
+        raise NotImplementedError
+
+    async def hget(self, key, field):
+        raise NotImplementedError
+
+    async def hset(self, key, field, value):
+        raise NotImplementedError
+
+    async def hmget(self, key, fields):
+        raise NotImplementedError
+
+    async def hmset(self, key, mapping):
+        raise NotImplementedError
+
+    async def hgetall(self, key):
+        raise NotImplementedError
+
+    async def hscan(self, key, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    async def smembers(self, key):
+        raise NotImplementedError
+
+    async def sadd(self, key, *values):
+        raise NotImplementedError
+
+    async def srem(self, key, *values):
+        raise NotImplementedError
+
+    async def sismember(self, key, value):
+        raise NotImplementedError
+
+    async def zadd(self, key, *args, **kwargs):
+        raise NotImplementedError
+
+    async def zrem(self, key, *values):
+        raise NotImplementedError
+
+    async def zcard(self, key):
+        raise NotImplementedError
+
+    async def zscore(self, key, value):
+        raise NotImplementedError
+
+    async def zrange(self, key, start, end, desc=False, withscores=False, score_cast_func=float):
+        raise NotImplementedError
+
+    async def zrevrange(self, key, start, end, withscores=False, score_cast_func=float):
+        raise NotImplementedError
+
+    async def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        raise NotImplementedError
+
+    async def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        raise NotImplementedError
+
+    async def pipeline(self, transaction=False):
+        """Returns a pipeline whose commands are queued by awaiting them and
+        sent by ``await pipe.execute()``, backends without pipelining support
+        leave it unimplemented and callers fall back to single commands
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from ..utilities.compression import compress, decompress, is_compression_supported, COMPRESSION_ZLIB, COMPRESSION_ZSTD, COMPRESSION_GZIP
+
+LOG = logging.getLogger('components.cacher.codecs')
+
+# leading byte of encoded values tells the compression of the payload
+_COMPRESSION_FLAGS = {
+    None: b'\x00',
+    COMPRESSION_ZLIB: b'\x01',
+    COMPRESSION_ZSTD: b'\x02',
+    COMPRESSION_GZIP: b'\x03',
+}
+_COMPRESSION_BY_FLAG = {v[0]: k for k, v in _COMPRESSION_FLAGS.items()}
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    return str(obj)
+
+class CacheCodec(object):
+    """Encodes a cached object mapping into one binary value, the payload larger
+    than ``compress_threshold`` bytes would be compressed by ``compression``.
+    """
+    name = 'json'
+
+    def __init__(self, compression=None, compress_threshold=1024):
+        if compression and not is_compression_supported(compression):
+            LOG.warning('cache codec compression %s were not supported, disables compression', compression)
+            compression = None
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+    def serialize(self, obj) -> bytes:
+        return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+    def deserialize(self, data: bytes):
+        return json.loads(data)
+
+    def pack(self, mapping: dict):
+        return mapping
+
+    def unpack(self, obj) -> dict:
+        return obj if isinstance(obj, dict) else None
+
+    def encode(self, mapping: dict) -> bytes:
+        payload = self.serialize(self.pack(mapping))
+        compression = None
+        if self.compression and len(payload) >= self.compress_threshold:
+            compression = self.compression
+            payload = compress(payload, compression)
+        return _COMPRESSION_FLAGS[compression] + payload
+
+    def decode(self, data: bytes) -> dict:
+        """Decodes an encoded value, returns None if the value were not decodable
+        by this codec, such as values written by the hash fields layout
+        """
+        if not data:
+            return None
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        compression = _COMPRESSION_BY_FLAG.get(data[0], False)
+        if compression is False:
+            return None
+        try:
+            payload = data[1:]
+            if compression:
+                payload = decompress(payload, compression)
+            return self.unpack(self.deserialize(payload))
+        except Exception as e:
+            LOG.debug('decoding cached value by %s codec failed with error:%s', self.name, str(e))
+            return None
+
+class MsgpackCodec(CacheCodec):
+    """Encodes cached objects by msgpack which requires msgpack package"""
+    name = 'msgpack'
+
+    def __init__(self, compression=None, compress_threshold=1024):
+        if msgpack is None:
+            raise ValueError('msgpack cache codec requires msgpack package')
+        super(MsgpackCodec, self).__init__(compression, compress_threshold)
+
+    def serialize(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True, default=_json_default)
+
+    def deserialize(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+class SchemaCodec(CacheCodec):
+    """Encodes cached objects as arrays of values ordered by the schema columns,
+    so that the field names were not stored per value. The arrays were packed
+    by msgpack if it were installed, otherwise by json. The schema fingerprint
+    is stored within the value, values encoded by another schema decode as None.
+    """
+    name = 'schema'
+
+    def __init__(self, columns, compression=None, compress_threshold=1024):
+        super(SchemaCodec, self).__init__(compression, compress_threshold)
+        self.columns = list(columns)
+        self._column_set = set(self.columns)
+        self.fingerprint = zlib.crc32(','.join(self.columns).encode('utf-8'))
+
+    def serialize(self, obj) -> bytes:
+        if msgpack is not None:
+            return msgpack.packb(obj, use_bin_type=True, default=_json_default)
+        return super(SchemaCodec, self).serialize(obj)
+
+    def deserialize(self, data: bytes):
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False)
+        return super(SchemaCodec, self).deserialize(data)
+
+    @classmethod
+    def from_model(cls, model, compression=None, compress_threshold=1024):
+        """Constructs schema codec by columns of a sqlalchemy or mongoengine model"""
+        from ..modelutils import model_columns, get_model_skip_response_fields
+        columns, _ = model_columns(model)
+        skip_fields = get_model_skip_response_fields(model)
+        return cls([k for k in columns if k not in skip_fields], compression, compress_threshold)
+
+    def pack(self, mapping: dict):
+        values = [mapping.get(k) for k in self.columns]
+        extra = {k: v for k, v in mapping.items() if k not in self._column_set}
+        return [self.fingerprint, values, extra] if extra else [self.fingerprint, values]
+
+    def unpack(self, obj) -> dict:
+        if not isinstance(obj, list) or len(obj) < 2 or obj[0] != self.fingerprint:
+            return None
+        result = dict(zip(self.columns, obj[1]))
+        if len(obj) > 2 and isinstance(obj[2], dict):
+            result.update(obj[2])
+        return result
+
+_CODECS = {
+    CacheCodec.name: CacheCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+def register_codec(name: str, codec_cls):
+    _CODECS[name] = codec_cls
+
+def create_codec(conf) -> CacheCodec:
+    """Creates codec by configuration like {'codec': 'msgpack', 'compression': 'zstd', 'compress_threshold': 1024},
+    returns None for the hash fields layout
+    """
+    if isinstance(conf, CacheCodec) or not conf:
+        return conf or None
+    if isinstance(conf, str):
+        conf = {'codec': conf}
+    name = conf.get('codec')
+    if not name or name == 'hash':
+        return None
+    if name not in _CODECS:
+        raise ValueError('unknown cache codec:%s' % str(name))
+    return _CODECS[name](compression=conf.get('compression'), compress_threshold=int(conf.get('compress_threshold', 1024)))
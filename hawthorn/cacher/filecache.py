@@ -4,198 +4,466 @@
 import os
 import hashlib
 import shelve
-import pickle
 import time
-import tornado.gen
+import fnmatch
+import asyncio
+import functools
+import bisect
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-class FileCache:
-    def __init__(self, cache_file):
+from .backend import CacheBackend
+
+# decoded sorted set entries kept in memory at most
+ZSET_CACHE_SIZE = 128
+
+class FileCache(CacheBackend):
+    """Cache backend persisting entries into a shelve file.
+
+    The shelve I/O runs on a single threaded executor, so that it neither
+    blocks the event loop nor needs locking, the ``_xxx`` methods are the
+    synchronous commands running on the executor thread.
+    """
+
+    def __init__(self, cache_file, zset_cache_size=ZSET_CACHE_SIZE):
         path_name, _ = os.path.split(cache_file)
-        if not os.path.exists(path_name):
+        if path_name and not os.path.exists(path_name):
             os.makedirs(path_name, 0o777)
         self.cache = shelve.open(cache_file)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='filecache')
+        # decoded sorted set entries by recent use, so that range reads need
+        # not unpickle them
+        self._zsets = collections.OrderedDict()
+        self.zset_cache_size = zset_cache_size
 
     def get_cache_key(self, key):
         hash_object = hashlib.md5(str(key).encode())
         return hash_object.hexdigest()
 
-    @tornado.gen.coroutine
-    def get(self, key):
-        cache_key = self.get_cache_key(key)
-
-        if cache_key in self.cache:
-            data = self.cache[cache_key]
-            if 'value' in data:
-                if data.get('expiry', 0) >= time.time():
-                    return data['value']
-                else:
-                    del self.cache[cache_key]
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
 
-        return None
-
-    @tornado.gen.coroutine
-    def set(self, key, value, expire=None):
-        cache_key = self.get_cache_key(key)
-
-        if expire is not None:
-            expiry_time = time.time() + expire
+    def _load(self, key, cache_key=None):
+        cache_key = cache_key or self.get_cache_key(key)
+        data = self._zsets.get(cache_key)
+        if data is None:
+            data = self.cache.get(cache_key)
         else:
-            expiry_time = None
-
-        self.cache[cache_key] = {'value': value, 'expiry': expiry_time}
-
-    @tornado.gen.coroutine
-    def mget(self, keys):
-        values = []
-
-        for key in keys:
-            values.append(self.get(key))
-
-        return values
-
-    @tornado.gen.coroutine
-    def mset(self, mapping, expire=None):
-        for key, value in mapping.items():
-            self.set(key, value, expire)
+            self._zsets.move_to_end(cache_key)
+        if data is None:
+            return None
+        expiry = data.get('expiry')
+        if expiry is not None and expiry < time.time():
+            del self.cache[cache_key]
+            self._zsets.pop(cache_key, None)
+            return None
+        return data
 
-    @tornado.gen.coroutine
-    def hget(self, key, field):
+    def _store(self, key, data):
+        data['key'] = str(key)
         cache_key = self.get_cache_key(key)
-
-        if cache_key in self.cache and isinstance(self.cache[cache_key], dict):
-            data = self.cache[cache_key]
-            if 'fields' in data:
-                return data['fields'].get(field)
-
+        self.cache[cache_key] = data
+        if isinstance(data.get('sorted_set'), dict) and 'items' in data['sorted_set']:
+            self._cache_zset(cache_key, data)
+        else:
+            self._zsets.pop(cache_key, None)
+
+    def _cache_zset(self, cache_key, data):
+        self._zsets[cache_key] = data
+        self._zsets.move_to_end(cache_key)
+        while len(self._zsets) > self.zset_cache_size:
+            self._zsets.popitem(last=False)
+
+    def _expiry(self, ex=None, px=None):
+        if ex is not None:
+            return time.time() + ex
+        elif px is not None:
+            return time.time() + px / 1000.0
         return None
 
-    @tornado.gen.coroutine
-    def hset(self, key, field, value, expire=None):
-        cache_key = self.get_cache_key(key)
-
-        if cache_key not in self.cache:
-            self.cache[cache_key] = {'fields': {}}
-
-        self.cache[cache_key]['fields'][field] = value
-        self.set(key, self.cache[cache_key], expire)
-
-    @tornado.gen.coroutine
-    def hmget(self, key, fields):
-        cache_key = self.get_cache_key(key)
-
-        if cache_key in self.cache and isinstance(self.cache[cache_key], dict):
-            data = self.cache[cache_key]
-            if 'fields' in data:
-                values = []
-                for field in fields:
-                    values.append(data['fields'].get(field))
-                return values
-
-        return [None] * len(fields)
-
-    @tornado.gen.coroutine
-    def hmset(self, key, mapping, expire=None):
-        cache_key = self.get_cache_key(key)
-
-        if cache_key not in self.cache:
-            self.cache[cache_key] = {'fields': {}}
+    def _get(self, key):
+        data = self._load(key)
+        if data is not None:
+            return data.get('value')
+        return None
 
-        self.cache[cache_key]['fields'].update(mapping)
-        self.set(key, self.cache[cache_key], expire)
+    def _set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        if nx or xx:
+            exists = self._load(key) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+        self._store(key, {'value': value, 'expiry': self._expiry(ex, px)})
+        return True
 
-    @tornado.gen.coroutine
-    def delete(self, key):
-        cache_key = self.get_cache_key(key)
-        if cache_key in self.cache:
-            del self.cache[cache_key]
+    def _mget(self, keys):
+        return [self._get(key) for key in keys]
 
-    @tornado.gen.coroutine
-    def smembers(self, key):
-        cache_key = self.get_cache_key(key)
+    def _mset(self, mapping, expire=None):
+        for key, value in mapping.items():
+            self._set(key, value, ex=expire)
+        return True
 
-        if cache_key in self.cache:
-            data = self.cache[cache_key]
-            if 'members' in data:
-                return data['members']
+    def _delete(self, *keys):
+        count = 0
+        for key in keys:
+            cache_key = self.get_cache_key(key)
+            self._zsets.pop(cache_key, None)
+            if cache_key in self.cache:
+                del self.cache[cache_key]
+                count += 1
+        return count
+
+    def _keys(self, pattern='*'):
+        results = []
+        for cache_key in list(self.cache.keys()):
+            data = self._load(None, cache_key)
+            if data is not None and 'key' in data and fnmatch.fnmatchcase(data['key'], pattern):
+                results.append(data['key'])
+        return results
+
+    def _exists(self, key):
+        return self._load(key) is not None
+
+    def _type(self, key):
+        data = self._load(key)
+        if data is None:
+            return 'none'
+        elif 'fields' in data:
+            return 'hash'
+        elif 'members' in data:
+            return 'set'
+        elif 'sorted_set' in data:
+            return 'zset'
+        return 'string'
+
+    def _incr(self, key, amount=1):
+        data = self._load(key) or {'value': 0, 'expiry': None}
+        data['value'] = int(data.get('value') or 0) + amount
+        self._store(key, data)
+        return data['value']
+
+    def _expire(self, key, seconds):
+        data = self._load(key)
+        if data is None:
+            return False
+        data['expiry'] = self._expiry(seconds)
+        self._store(key, data)
+        return True
+
+    def _fields(self, key):
+        data = self._load(key)
+        if data is not None and 'fields' in data:
+            return data['fields']
+        return {}
 
+    def _hget(self, key, field):
+        return self._fields(key).get(field)
+
+    def _hset(self, key, field, value, expire=None):
+        return self._hmset(key, {field: value}, expire)
+
+    def _hmget(self, key, fields):
+        data = self._fields(key)
+        return [data.get(field) for field in fields]
+
+    def _hmset(self, key, mapping, expire=None):
+        data = self._load(key)
+        if data is None or 'fields' not in data:
+            data = {'fields': {}, 'expiry': None}
+        data['fields'].update(mapping)
+        if expire:
+            data['expiry'] = self._expiry(expire)
+        self._store(key, data)
+        return True
+
+    def _hgetall(self, key):
+        return dict(self._fields(key))
+
+    def _hscan(self, key, cursor=0, match=None, count=None):
+        data = self._fields(key)
+        fields = [k for k in data.keys() if match is None or fnmatch.fnmatchcase(str(k), match)]
+        cursor = int(cursor)
+        count = len(fields) if count is None else int(count)
+        fields_slice = fields[cursor : cursor + count]
+        next_cursor = cursor + count if cursor + count < len(fields) else 0
+        return next_cursor, [(field, data[field]) for field in fields_slice]
+
+    def _members(self, key):
+        data = self._load(key)
+        if data is not None and 'members' in data:
+            return data['members']
         return set()
 
-    @tornado.gen.coroutine
-    def sadd(self, key, *values):
-        cache_key = self.get_cache_key(key)
+    def _smembers(self, key):
+        return set(self._members(key))
+
+    def _sadd(self, key, *values):
+        data = self._load(key)
+        if data is None or 'members' not in data:
+            data = {'members': set(), 'expiry': None}
+        count = len(data['members'])
+        data['members'].update(values)
+        self._store(key, data)
+        return len(data['members']) - count
+
+    def _srem(self, key, *values):
+        data = self._load(key)
+        if data is None or 'members' not in data:
+            return 0
+        count = len(data['members'])
+        data['members'].difference_update(values)
+        self._store(key, data)
+        return count - len(data['members'])
+
+    def _sismember(self, key, value):
+        return value in self._members(key)
+
+    def _zset(self, key, create=False):
+        """Gets the sorted set entry of key, the members were kept as a list of
+        (score, member) sorted by score then member, and a parallel list of the
+        scores for bisecting score bounds
+        """
+        data = self._load(key)
+        if data is None or 'sorted_set' not in data:
+            if not create:
+                return None
+            data = {'sorted_set': None, 'expiry': None}
+        sorted_set = data['sorted_set']
+        if not isinstance(sorted_set, dict) or 'items' not in sorted_set:
+            # upgrades entries of member -> score mappings or lists of pairs
+            pairs = sorted_set.items() if isinstance(sorted_set, dict) else (sorted_set or [])
+            items = sorted((float(score), self._zmember(member)) for member, score in pairs)
+            data['sorted_set'] = {'items': items, 'scores': [item[0] for item in items],
+                'index': {member: score for score, member in items}}
+        if 'key' in data:
+            self._cache_zset(self.get_cache_key(key), data)
+        return data
+
+    def _zmember(self, member):
+        return member.decode('utf-8') if isinstance(member, bytes) else str(member)
+
+    def _zbound(self, value):
+        """Parses score bound like 1.5, '(1.5', '-inf' or '+inf' into (score, exclusive)"""
+        if isinstance(value, bytes):
+            value = value.decode()
+        if isinstance(value, str):
+            if value.startswith('('):
+                return float(value[1:]), True
+            return float(value), False
+        return float(value), False
+
+    def _zscore_span(self, sorted_set, min_score, max_score):
+        scores = sorted_set['scores']
+        low, low_exclusive = self._zbound(min_score)
+        high, high_exclusive = self._zbound(max_score)
+        begin = bisect.bisect_right(scores, low) if low_exclusive else bisect.bisect_left(scores, low)
+        end = bisect.bisect_left(scores, high) if high_exclusive else bisect.bisect_right(scores, high)
+        return begin, max(begin, end)
+
+    def _zresult(self, items, withscores, score_cast_func):
+        if withscores:
+            return [(member, score_cast_func(score)) for score, member in items]
+        return [member for _, member in items]
+
+    def _zadd(self, key, *args, **kwargs):
+        pairs = [(args[i], args[i + 1]) for i in range(0, len(args), 2)] + [(score, member) for member, score in kwargs.items()]
+        data = self._zset(key, create=True)
+        sorted_set = data['sorted_set']
+        items, scores, index = sorted_set['items'], sorted_set['scores'], sorted_set['index']
+        added = 0
+        for score, member in pairs:
+            score, member = float(score), self._zmember(member)
+            if member in index:
+                pos = bisect.bisect_left(items, (index[member], member))
+                del items[pos]
+                del scores[pos]
+            else:
+                added += 1
+            pos = bisect.bisect_left(items, (score, member))
+            items.insert(pos, (score, member))
+            scores.insert(pos, score)
+            index[member] = score
+        self._store(key, data)
+        return added
+
+    def _zrem(self, key, *values):
+        data = self._zset(key)
+        if data is None:
+            return 0
+        sorted_set = data['sorted_set']
+        items, scores, index = sorted_set['items'], sorted_set['scores'], sorted_set['index']
+        removed = 0
+        for member in values:
+            member = self._zmember(member)
+            if member in index:
+                pos = bisect.bisect_left(items, (index.pop(member), member))
+                del items[pos]
+                del scores[pos]
+                removed += 1
+        self._store(key, data)
+        return removed
+
+    def _zcard(self, key):
+        data = self._zset(key)
+        return len(data['sorted_set']['items']) if data is not None else 0
+
+    def _zscore(self, key, value):
+        data = self._zset(key)
+        return data['sorted_set']['index'].get(self._zmember(value)) if data is not None else None
+
+    def _zrange(self, key, start, end, desc=False, withscores=False, score_cast_func=float):
+        data = self._zset(key)
+        if data is None:
+            return []
+        items = data['sorted_set']['items']
+        n = len(items)
+        start = max(start + n if start < 0 else start, 0)
+        end = min(end + n if end < 0 else end, n - 1)
+        if start > end:
+            return []
+        if desc:
+            return self._zresult(items[n - 1 - end:n - start][::-1], withscores, score_cast_func)
+        return self._zresult(items[start:end + 1], withscores, score_cast_func)
+
+    def _zrevrange(self, key, start, end, withscores=False, score_cast_func=float):
+        return self._zrange(key, start, end, True, withscores, score_cast_func)
+
+    def _zrangebyscore(self, key, min_score, max_score, start=None, num=None, withscores=False, score_cast_func=float):
+        data = self._zset(key)
+        if data is None:
+            return []
+        begin, end = self._zscore_span(data['sorted_set'], min_score, max_score)
+        if start is not None:
+            begin = min(begin + start, end)
+            if num is not None and num >= 0:
+                end = min(begin + num, end)
+        return self._zresult(data['sorted_set']['items'][begin:end], withscores, score_cast_func)
+
+    def _zrevrangebyscore(self, key, max_score, min_score, start=None, num=None, withscores=False, score_cast_func=float):
+        data = self._zset(key)
+        if data is None:
+            return []
+        begin, end = self._zscore_span(data['sorted_set'], min_score, max_score)
+        if start is not None:
+            end = max(end - start, begin)
+            if num is not None and num >= 0:
+                begin = max(end - num, begin)
+        return self._zresult(data['sorted_set']['items'][begin:end][::-1], withscores, score_cast_func)
+
+    def _execute(self, commands):
+        return [func(*args, **kwargs) for func, args, kwargs in commands]
+
+    async def get(self, key):
+        return await self._run(self._get, key)
+
+    async def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        return await self._run(self._set, key, value, ex=ex, px=px, nx=nx, xx=xx)
+
+    async def mget(self, keys):
+        return await self._run(self._mget, keys)
+
+    async def mset(self, mapping, expire=None):
+        return await self._run(self._mset, mapping, expire)
+
+    async def delete(self, *keys):
+        return await self._run(self._delete, *keys)
+
+    async def keys(self, pattern='*'):
+        return await self._run(self._keys, pattern)
+
+    async def exists(self, key):
+        return await self._run(self._exists, key)
+
+    async def type(self, key):
+        return await self._run(self._type, key)
+
+    async def incr(self, key, amount=1):
+        return await self._run(self._incr, key, amount)
+
+    async def expire(self, key, seconds):
+        return await self._run(self._expire, key, seconds)
+
+    async def hget(self, key, field):
+        return await self._run(self._hget, key, field)
 
-        if cache_key not in self.cache:
-            self.cache[cache_key] = {'members': set()}
+    async def hset(self, key, field, value, expire=None):
+        return await self._run(self._hset, key, field, value, expire)
+
+    async def hmget(self, key, fields):
+        return await self._run(self._hmget, key, fields)
 
-        self.cache[cache_key]['members'].update(values)
-        
-    @tornado.gen.coroutine
-    def hscan(self, key, cursor=0, count=None):
-        cache_key = self.get_cache_key(key)
+    async def hmset(self, key, mapping, expire=None):
+        return await self._run(self._hmset, key, mapping, expire)
 
-        if cache_key in self.cache:
-            data = self.cache[cache_key]
-            if 'fields' in data:
-                fields = list(data['fields'].keys())
-                cursor = int(cursor)
-                if count is None:
-                    count = len(fields)
-                else:
-                    count = int(count)
+    async def hgetall(self, key):
+        return await self._run(self._hgetall, key)
 
-                fields_slice = fields[cursor : cursor + count]
-                next_cursor = cursor + count if cursor + count < len(fields) else 0
+    async def hscan(self, key, cursor=0, match=None, count=None):
+        return await self._run(self._hscan, key, cursor, match, count)
 
-                result = []
-                for field in fields_slice:
-                    result.append((field, data['fields'][field]))
+    async def smembers(self, key):
+        return await self._run(self._smembers, key)
 
-                return next_cursor, result
+    async def sadd(self, key, *values):
+        return await self._run(self._sadd, key, *values)
 
-        return 0, []
+    async def srem(self, key, *values):
+        return await self._run(self._srem, key, *values)
 
-    @tornado.gen.coroutine
-    def hgetall(self, key):
-        cache_key = self.get_cache_key(key)
+    async def sismember(self, key, value):
+        return await self._run(self._sismember, key, value)
 
-        if cache_key in self.cache and isinstance(self.cache[cache_key], dict):
-            data = self.cache[cache_key]
-            if 'fields' in data:
-                return data['fields']
+    async def zadd(self, key, *args, **kwargs):
+        return await self._run(self._zadd, key, *args, **kwargs)
 
-        return {}
+    async def zrem(self, key, *values):
+        return await self._run(self._zrem, key, *values)
 
-    @tornado.gen.coroutine
-    def zrange(self, key, start, stop, withscores=False):
-        cache_key = self.get_cache_key(key)
+    async def zcard(self, key):
+        return await self._run(self._zcard, key)
 
-        if cache_key in self.cache:
-            data = self.cache[cache_key]
-            if 'sorted_set' in data:
-                sorted_set = data['sorted_set']
+    async def zscore(self, key, value):
+        return await self._run(self._zscore, key, value)
 
-                if isinstance(sorted_set, dict):
-                    sorted_set = sorted(sorted_set.items(), key=lambda x: x[1])
+    async def zrange(self, key, start, end, desc=False, withscores=False, score_cast_func=float):
+        return await self._run(self._zrange, key, start, end, desc, withscores, score_cast_func)
 
-                if withscores:
-                    return sorted_set[start : stop + 1]
-                else:
-                    return [item[0] for item in sorted_set[start : stop + 1]]
+    async def zrevrange(self, key, start, end, withscores=False, score_cast_func=float):
+        return await self._run(self._zrevrange, key, start, end, withscores, score_cast_func)
 
-        return []
+    async def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        return await self._run(self._zrangebyscore, key, min, max, start, num, withscores, score_cast_func)
 
-    @tornado.gen.coroutine
-    def sismember(self, key, value):
-        cache_key = self.get_cache_key(key)
+    async def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        return await self._run(self._zrevrangebyscore, key, max, min, start, num, withscores, score_cast_func)
 
-        if cache_key in self.cache:
-            data = self.cache[cache_key]
-            if 'members' in data:
-                return value in data['members']
+    async def pipeline(self, transaction=False):
+        return FileCachePipeline(self)
 
-        return False
-        
     def close(self):
+        self._executor.shutdown(wait=True)
         self.cache.close()
 
+class FileCachePipeline(object):
+    """Queues commands of a FileCache and runs them in one executor job"""
+
+    def __init__(self, cache: FileCache):
+        self.cache = cache
+        self.commands = []
+
+    def __getattr__(self, name):
+        func = getattr(self.cache, '_' + name, None)
+        if name.startswith('_') or func is None or not asyncio.iscoroutinefunction(getattr(self.cache, name, None)):
+            raise AttributeError(name)
+
+        async def queue(*args, **kwargs):
+            self.commands.append((func, args, kwargs))
+            return self
+        return queue
 
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        return await self.cache._run(self.cache._execute, commands)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lua scripts maintaining index-to-many relations of CacheProxy in one round
+trip, KEYS are pairs of (index set key, object key) per item, and releasing
+the loading locks of CacheProxy.
+"""
+
+# ARGV per item: pk, 'h' or 's', n, then n hash field/value arguments for 'h'
+# or the encoded object value for 's'
+ADD_INDEXED_OBJECTS = """
+local pos = 1
+for i = 1, #KEYS, 2 do
+    local pk = ARGV[pos]
+    local mode = ARGV[pos + 1]
+    local n = tonumber(ARGV[pos + 2])
+    pos = pos + 3
+    if mode == 's' then
+        redis.call('SET', KEYS[i + 1], ARGV[pos])
+    elseif n > 0 then
+        redis.call('HMSET', KEYS[i + 1], unpack(ARGV, pos, pos + n - 1))
+    end
+    redis.call('SADD', KEYS[i], pk)
+    pos = pos + n
+end
+return #KEYS / 2
+"""
+
+# ARGV: the pk of each item
+DEL_INDEXED_OBJECTS = """
+for i = 1, #KEYS, 2 do
+    redis.call('SREM', KEYS[i], ARGV[(i + 1) / 2])
+    redis.call('DEL', KEYS[i + 1])
+end
+return #KEYS / 2
+"""
+
+# KEYS: the lock key, ARGV: the token of the lock holder, the lock is deleted
+# only if it were still held by the token
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
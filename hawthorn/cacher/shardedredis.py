@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import hashlib
+import asyncio
+import logging
+import aredis
+from aredis.utils import hash_slot
+from aredis.scripting import Script
+
+from .backend import CacheBackend
+
+LOG = logging.getLogger('components.cacher.shardedredis')
+
+RING_REPLICAS = 160
+
+def key_hash_tag(key) -> bytes:
+    """Returns the part of key that decides its shard, which is the content of
+    the first non empty ``{...}`` hash tag as Redis Cluster does, or the key
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def key_slot(key) -> int:
+    """Redis Cluster hash slot of key"""
+    return hash_slot(key_hash_tag(key))
+
+def group_keys(keys, shard_func):
+    """Groups keys by shard_func(key), keeps the position of each key
+
+    :return dict: shard -> ([keys], [positions])
+    """
+    groups = {}
+    for i, key in enumerate(keys):
+        shard = shard_func(key)
+        if shard not in groups:
+            groups[shard] = ([], [])
+        groups[shard][0].append(key)
+        groups[shard][1].append(i)
+    return groups
+
+class HashRing(object):
+    """Consistent hashing ring with ``replicas`` virtual nodes per node, so that
+    adding or removing a node only moves about 1/N of the keys
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        ring = []
+        for i, name in enumerate(self.nodes):
+            for r in range(replicas):
+                ring.append((self._hash(('%s#%d' % (name, r)).encode('utf-8')), i))
+        ring.sort()
+        self._points = [p for p, _ in ring]
+        self._owners = [i for _, i in ring]
+
+    def _hash(self, data: bytes) -> int:
+        return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+    def get_node_index(self, key) -> int:
+        idx = bisect.bisect(self._points, self._hash(key_hash_tag(key)))
+        if idx == len(self._points):
+            idx = 0
+        return self._owners[idx]
+
+class ShardedRedis(CacheBackend):
+    """Cache backend distributing keys across standalone Redis nodes by consistent
+    hashing of the keys, keys sharing one ``{hash tag}`` are kept on one node.
+    Multi-key commands were split per node and sent in parallel.
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        """
+        :param list nodes: list of aredis clients, or connection configures like
+            {'host': 'localhost', 'port': 6379, 'db': 0, 'password': None}
+        """
+        self.nodes = []
+        names = []
+        for node in nodes:
+            if isinstance(node, dict):
+                names.append('%s:%s/%s' % (node.get('host', 'localhost'), str(node.get('port', 6379)), str(node.get('db', 0))))
+                node = aredis.StrictRedis(host=node.get('host', 'localhost'), port=node.get('port', 6379),
+                    db=node.get('db', 0), password=node.get('password', None), retry_on_timeout=True)
+            else:
+                names.append(str(len(names)))
+            self.nodes.append(node)
+        if not self.nodes:
+            raise ValueError('sharded redis requires at least one node')
+        self.ring = HashRing(names, replicas)
+
+    def get_node(self, key):
+        return self.nodes[self.ring.get_node_index(key)]
+
+    def split_keys(self, keys):
+        """Groups keys by their nodes
+
+        :return dict: node index -> ([keys], [positions])
+        """
+        return group_keys(keys, self.ring.get_node_index)
+
+    def __getattr__(self, name):
+        # single key commands not listed here were routed by their first argument
+        if name.startswith('_'):
+            raise AttributeError(name)
+        command = getattr(aredis.StrictRedis, name, None)
+        if command is None or not asyncio.iscoroutinefunction(command):
+            raise AttributeError(name)
+
+        async def route(key, *args, **kwargs):
+            return await getattr(self.get_node(key), name)(key, *args, **kwargs)
+        return route
+
+    async def get(self, key):
+        return await self.get_node(key).get(key)
+
+    async def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        return await self.get_node(key).set(key, value, ex=ex, px=px, nx=nx, xx=xx)
+
+    async def mget(self, keys):
+        results = [None] * len(keys)
+        groups = list(self.split_keys(keys).items())
+        values = await asyncio.gather(*[self.nodes[i].mget(node_keys) for i, (node_keys, _) in groups])
+        for (_, (_, positions)), node_values in zip(groups, values):
+            for pos, value in zip(positions, node_values):
+                results[pos] = value
+        return results
+
+    async def mset(self, mapping):
+        groups = self.split_keys(list(mapping.keys()))
+        await asyncio.gather(*[self.nodes[i].mset({k: mapping[k] for k in node_keys}) for i, (node_keys, _) in groups.items()])
+        return True
+
+    async def delete(self, *keys):
+        groups = self.split_keys(keys)
+        counts = await asyncio.gather(*[self.nodes[i].delete(*node_keys) for i, (node_keys, _) in groups.items()])
+        return sum(counts)
+
+    async def keys(self, pattern='*'):
+        results = await asyncio.gather(*[node.keys(pattern) for node in self.nodes])
+        return [k for node_keys in results for k in node_keys]
+
+    async def scan_iter(self, match=None, count=None):
+        for node in self.nodes:
+            async for key in node.scan_iter(match=match, count=count):
+                yield key
+
+    async def exists(self, key):
+        return await self.get_node(key).exists(key)
+
+    async def type(self, key):
+        return await self.get_node(key).type(key)
+
+    async def incr(self, key, amount=1):
+        return await self.get_node(key).incr(key, amount)
+
+    async def expire(self, key, seconds):
+        return await self.get_node(key).expire(key, seconds)
+
+    async def hget(self, key, field):
+        return await self.get_node(key).hget(key, field)
+
+    async def hset(self, key, field, value):
+        return await self.get_node(key).hset(key, field, value)
+
+    async def hmget(self, key, fields):
+        return await self.get_node(key).hmget(key, fields)
+
+    async def hmset(self, key, mapping):
+        return await self.get_node(key).hmset(key, mapping)
+
+    async def hgetall(self, key):
+        return await self.get_node(key).hgetall(key)
+
+    async def hscan(self, key, cursor=0, match=None, count=None):
+        return await self.get_node(key).hscan(key, cursor=cursor, match=match, count=count)
+
+    async def smembers(self, key):
+        return await self.get_node(key).smembers(key)
+
+    async def sadd(self, key, *values):
+        return await self.get_node(key).sadd(key, *values)
+
+    async def srem(self, key, *values):
+        return await self.get_node(key).srem(key, *values)
+
+    async def sismember(self, key, value):
+        return await self.get_node(key).sismember(key, value)
+
+    async def zadd(self, key, *args, **kwargs):
+        return await self.get_node(key).zadd(key, *args, **kwargs)
+
+    async def zrem(self, key, *values):
+        return await self.get_node(key).zrem(key, *values)
+
+    async def zcard(self, key):
+        return await self.get_node(key).zcard(key)
+
+    async def zscore(self, key, value):
+        return await self.get_node(key).zscore(key, value)
+
+    async def zrange(self, key, start, end, desc=False, withscores=False, score_cast_func=float):
+        return await self.get_node(key).zrange(key, start, end, desc=desc, withscores=withscores, score_cast_func=score_cast_func)
+
+    async def zrevrange(self, key, start, end, withscores=False, score_cast_func=float):
+        return await self.get_node(key).zrevrange(key, start, end, withscores=withscores, score_cast_func=score_cast_func)
+
+    async def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        return await self.get_node(key).zrangebyscore(key, min, max, start=start, num=num, withscores=withscores, score_cast_func=score_cast_func)
+
+    async def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False, score_cast_func=float):
+        return await self.get_node(key).zrevrangebyscore(key, max, min, start=start, num=num, withscores=withscores, score_cast_func=score_cast_func)
+
+    async def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+class ShardedScript(object):
+    """Lua script of a ShardedRedis, executed on the node of its first key, so
+    that all keys of one execution should share a node, such as by hash tags
+    """
+
+    def __init__(self, sharded: ShardedRedis, script):
+        self.sharded = sharded
+        self.script = Script(sharded.nodes[0], script)
+
+    async def execute(self, keys=[], args=[]):
+        if not keys:
+            raise ValueError('sharded redis script requires keys to locate the node')
+        return await self.script.execute(keys, args, client=self.sharded.get_node(keys[0]))
+
+class ShardedPipeline(object):
+    """Queues commands of a ShardedRedis, executes one pipeline per node in
+    parallel and returns the results in the order the commands were queued
+    """
+
+    def __init__(self, sharded: ShardedRedis):
+        self.sharded = sharded
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def queue(key, *args, **kwargs):
+            self.commands.append((self.sharded.ring.get_node_index(key), name, key, args, kwargs))
+            return self
+        return queue
+
+    async def _execute_node(self, index, commands):
+        pipe = await self.sharded.nodes[index].pipeline(transaction=False)
+        for _, name, key, args, kwargs in commands:
+            await getattr(pipe, name)(key, *args, **kwargs)
+        return await pipe.execute()
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        groups = group_keys(commands, lambda command: command[0])
+        results = [None] * len(commands)
+        indexes = list(groups.keys())
+        node_results = await asyncio.gather(*[self._execute_node(i, groups[i][0]) for i in indexes])
+        for i, values in zip(indexes, node_results):
+            for pos, value in zip(groups[i][1], values):
+                results[pos] = value
+        return results
+
+class SlotAwareRedisCluster(aredis.StrictRedisCluster):
+    """Redis Cluster client sending multi-key DEL and MGET per hash slot in
+    parallel, rather than one command per key in sequence as aredis does
+    """
+
+    async def delete(self, *names):
+        groups = group_keys(names, key_slot)
+        counts = await asyncio.gather(*[self.execute_command('DEL', *slot_keys) for slot_keys, _ in groups.values()])
+        return sum(counts)
+
+    async def mget(self, keys, *args):
+        keys = list(keys) + list(args) if isinstance(keys, (list, tuple)) else [keys] + list(args)
+        results = [None] * len(keys)
+        groups = list(group_keys(keys, key_slot).values())
+        values = await asyncio.gather(*[self.execute_command('MGET', *slot_keys) for slot_keys, _ in groups])
+        for (_, positions), slot_values in zip(groups, values):
+            for pos, value in zip(positions, slot_values):
+                results[pos] = value
+        return results
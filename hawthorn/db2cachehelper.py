@@ -4,54 +4,332 @@
 import redis
 import logging
 import datetime
+import time
+import asyncio
 import tornado.gen
+import tornado.locks
 import aredis
 
-from .modelutils import model_columns, format_mongo_value, DEFAULT_SKIP_FIELDS
+from .modelutils import model_columns, format_mongo_value, get_model_skip_response_fields, DEFAULT_SKIP_FIELDS
 from .dbproxy import DbProxy
 from .cacheproxy import CacheProxy
 
 LOG = logging.getLogger('components.db2cachehelper')
 
+LOAD_PAGE_SIZE = 5000
+CACHE_WRITE_BATCH_SIZE = 500
+CACHE_WRITE_CONCURRENCY = 4
+
+class CacheBulkWriter(object):
+    """Buffers cache writes and flushes them by batches through a batch writer
+    coroutine, keeping at most ``concurrency`` batches in flight at once.
+    """
+
+    def __init__(self, batch_writer, batch_size=CACHE_WRITE_BATCH_SIZE, concurrency=CACHE_WRITE_CONCURRENCY):
+        """
+        :param callable batch_writer: coroutine function which accepts a list of buffered elements
+        :param int batch_size: elements count of each flushed batch
+        :param int concurrency: max batches being written at the same time
+        """
+        self.batch_writer = batch_writer
+        self.batch_size = max(1, int(batch_size))
+        self.concurrency = max(1, int(concurrency))
+        self.written = 0
+        self._buffer = []
+        self._semaphore = tornado.locks.Semaphore(self.concurrency)
+        self._inflights = set()
+        self._error = None
+
+    @tornado.gen.coroutine
+    def add(self, element):
+        """Buffers an element, flushes the buffer once it reaches the batch size.
+        It waits while there were too many batches in flight.
+        """
+        self._buffer.append(element)
+        if len(self._buffer) >= self.batch_size:
+            yield self.flush()
+
+    @tornado.gen.coroutine
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if not self._buffer:
+            return
+        batch = self._buffer
+        self._buffer = []
+        yield self._semaphore.acquire()
+        fut = asyncio.ensure_future(self._write(batch))
+        self._inflights.add(fut)
+        fut.add_done_callback(self._inflights.discard)
+
+    @tornado.gen.coroutine
+    def join(self):
+        """Flushes buffered elements and waits until all in flight batches were written"""
+        yield self.flush()
+        if self._inflights:
+            yield list(self._inflights)
+        if self._error is not None:
+            raise self._error
+
+    @tornado.gen.coroutine
+    def _write(self, batch):
+        try:
+            yield self.batch_writer(batch)
+            self.written += len(batch)
+        except Exception as e:
+            LOG.error('writing %d elements into cache failed with error:%s', len(batch), str(e))
+            if self._error is None:
+                self._error = e
+        finally:
+            self._semaphore.release()
+
+@tornado.gen.coroutine
+def _get_checkpoint(cacheproxy, checkpoint_key):
+    if not checkpoint_key:
+        return None
+    val = yield cacheproxy.get(checkpoint_key)
+    if isinstance(val, bytes):
+        val = val.decode()
+    return val if val else None
+
+@tornado.gen.coroutine
+def _prepare_loading_target(cacheproxy, keyPrefix, clearcache, checkpoint_key):
+    """Decides the key prefix that a loader writes into. A clearing load of a
+    prefix registered as versioned writes into a new generation of keyPrefix which
+    is switched on atomically once the load finished, so that readers keep reading
+    the previous generation meanwhile. Other prefixes were cleared before loading.
+
+    :return tuple: (target key prefix, generation, resuming start id)
+    """
+    generation = None
+    start_id = None
+    checkpoint = yield _get_checkpoint(cacheproxy, checkpoint_key)
+    if checkpoint:
+        generation, _, start_id = checkpoint.partition('|')
+        generation = generation or None
+        start_id = start_id or None
+    elif clearcache and cacheproxy.is_versioned_prefix(keyPrefix):
+        generation, _ = cacheproxy.begin_generation(keyPrefix)
+    elif clearcache:
+        yield cacheproxy.clear_by_key_prefix(keyPrefix)
+    if generation:
+        return cacheproxy.generation_key_prefix(keyPrefix, generation), generation, start_id
+    target_prefix = yield cacheproxy.resolve_key(keyPrefix)
+    return target_prefix, None, start_id
+
 @tornado.gen.coroutine
-def load_mongo_data_to_cache(model, keyPrefix, pk, filters=None, excachecb=None, clearcache=True):
+def load_mongo_data_to_cache(model, keyPrefix, pk, filters=None, excachecb=None, clearcache=True,
+                             batch_size=CACHE_WRITE_BATCH_SIZE, concurrency=CACHE_WRITE_CONCURRENCY, checkpoint_key=None):
+    """Loads mongo documents into cache objects keyed by keyPrefix + pk value
+
+    :param bool clearcache: reloads into a new generation of keyPrefix which replaces
+        the current one atomically when finished if keyPrefix were registered as
+        versioned, or clears keyPrefix before loading, otherwise updates the current one
+    :param checkpoint_key: cache key that records the last loaded id, the loading
+        resumes from that id when the key exists
+    :return dict: loading statistics
+    """
     cacheproxy = CacheProxy()
     check_uniques = {}
-    @tornado.gen.coroutine
-    def _load_cache_pk(item):
-        cache_key = keyPrefix + cacheproxy.get_index_key_value(item, pk)
-        if cache_key in check_uniques:
-            LOG.warning('loadToCache by key:%s that already exists.', cache_key)
-        check_uniques[cache_key] = 1
-        yield cacheproxy.set_object(cache_key, item)
-        if callable(excachecb):
-            yield excachecb(item, cacheproxy.async_redis_conn)
-
-    if clearcache:
-        yield cacheproxy.clear_by_key_prefix(keyPrefix)
-    yield load_data_from_mongodb(model, _load_cache_pk, filters=filters)
+
+    def _make_writer(target_prefix):
+        @tornado.gen.coroutine
+        def _write_batch(items):
+            yield cacheproxy.set_objects([(target_prefix + cacheproxy.get_index_key_value(item, pk), item) for item in items])
+            if callable(excachecb):
+                for item in items:
+                    yield excachecb(item, cacheproxy.cache_inst)
+        return CacheBulkWriter(_write_batch, batch_size, concurrency)
+
+    def _make_cb(writer):
+        @tornado.gen.coroutine
+        def _load_cache_pk(item):
+            cache_key = keyPrefix + cacheproxy.get_index_key_value(item, pk)
+            if cache_key in check_uniques:
+                LOG.warning('loadToCache by key:%s that already exists.', cache_key)
+            check_uniques[cache_key] = 1
+            yield writer.add(item)
+        return _load_cache_pk
+
+    def _load(cb, start_id, page_cb):
+        return load_data_from_mongodb(model, cb, filters=filters, start_id=start_id, page_cb=page_cb)
+
+    stats = yield _load_data_by_writer(cacheproxy, keyPrefix, _make_writer, _make_cb, _load, clearcache, checkpoint_key)
+    return stats
 
 @tornado.gen.coroutine
-def load_mongo_data_to_cache_indexed_to_many(model, keyPrefix, indexKey, pk, filters=None, orderby=None, clearcache=True):
+def load_mongo_data_to_cache_indexed_to_many(model, keyPrefix, indexKey, pk, filters=None, orderby=None, clearcache=True,
+                                             batch_size=CACHE_WRITE_BATCH_SIZE, concurrency=CACHE_WRITE_CONCURRENCY, checkpoint_key=None):
     cacheproxy = CacheProxy()
+
+    def _make_writer(target_prefix):
+        @tornado.gen.coroutine
+        def _write_batch(items):
+            yield cacheproxy.add_objects_to_cache_indexed_to_many(items, target_prefix, indexKey, pk)
+        return CacheBulkWriter(_write_batch, batch_size, concurrency)
+
+    def _load(cb, start_id, page_cb):
+        return load_data_from_mongodb(model, cb, filters=filters, orderby=orderby, start_id=start_id, page_cb=page_cb)
+
+    stats = yield _load_data_by_writer(cacheproxy, keyPrefix, _make_writer, lambda writer: writer.add, _load, clearcache, checkpoint_key)
+    return stats
+
+@tornado.gen.coroutine
+def load_rdbms_data_to_cache(model, keyPrefix, pk=None, filters=None, excachecb=None, clearcache=True,
+                             batch_size=CACHE_WRITE_BATCH_SIZE, concurrency=CACHE_WRITE_CONCURRENCY, checkpoint_key=None,
+                             watermark_key=None, watermark_column='updated_at', watermark_overlap=0):
+    """Loads rdbms rows into cache objects keyed by keyPrefix + pk value
+
+    :param pk: cache key column(s), defaults to the primary key of model
+    :param bool clearcache: reloads into a new generation of keyPrefix which replaces
+        the current one atomically when finished if keyPrefix were registered as
+        versioned, or clears keyPrefix before loading, otherwise updates the current one
+    :param checkpoint_key: cache key that records the last loaded key value, the
+        loading resumes from that value when the key exists
+    :param watermark_key: cache key that records the max ``watermark_column`` value
+        loaded, once recorded the later loadings only refresh rows updated at or
+        after it, the rows at the watermark itself were loaded again so that rows
+        committed later with the same value were not missed
+    :param watermark_overlap: seconds, or units of a numeric column, the refreshing
+        starts before the watermark, covering rows whose transactions committed
+        later than rows with a greater value
+    :return dict: loading statistics
+    """
+    cacheproxy = CacheProxy()
+    _, model_pk = model_columns(model)
+    pk = pk or model_pk
+
+    def _make_writer(target_prefix):
+        @tornado.gen.coroutine
+        def _write_batch(items):
+            yield cacheproxy.set_objects([(target_prefix + cacheproxy.get_index_key_value(item, pk), item) for item in items])
+            if callable(excachecb):
+                for item in items:
+                    yield excachecb(item, cacheproxy.cache_inst)
+        return CacheBulkWriter(_write_batch, batch_size, concurrency)
+
+    stats = yield _load_rdbms_data_by_writer(cacheproxy, model, keyPrefix, _make_writer, filters, clearcache,
+                                             checkpoint_key, watermark_key, watermark_column, watermark_overlap)
+    return stats
+
+@tornado.gen.coroutine
+def load_rdbms_data_to_cache_indexed_to_many(model, keyPrefix, indexKey, pk=None, filters=None, clearcache=True,
+                                             batch_size=CACHE_WRITE_BATCH_SIZE, concurrency=CACHE_WRITE_CONCURRENCY, checkpoint_key=None,
+                                             watermark_key=None, watermark_column='updated_at', watermark_overlap=0):
+    cacheproxy = CacheProxy()
+    _, model_pk = model_columns(model)
+    pk = pk or model_pk
+
+    def _make_writer(target_prefix):
+        @tornado.gen.coroutine
+        def _write_batch(items):
+            yield cacheproxy.add_objects_to_cache_indexed_to_many(items, target_prefix, indexKey, pk)
+        return CacheBulkWriter(_write_batch, batch_size, concurrency)
+
+    stats = yield _load_rdbms_data_by_writer(cacheproxy, model, keyPrefix, _make_writer, filters, clearcache,
+                                             checkpoint_key, watermark_key, watermark_column, watermark_overlap)
+    return stats
+
+@tornado.gen.coroutine
+def _load_rdbms_data_by_writer(cacheproxy, model, keyPrefix, make_writer, filters, clearcache, checkpoint_key, watermark_key, watermark_column, watermark_overlap=0):
+    watermark = None
+    filters = list(filters) if filters else []
+    if watermark_key:
+        val = yield cacheproxy.get(watermark_key)
+        if isinstance(val, bytes):
+            val = val.decode()
+        if val:
+            watermark = _parse_watermark(model, watermark_column, val)
+            filters.append(getattr(model, watermark_column) >= _overlap_watermark(watermark, watermark_overlap))
+            # refreshing the updated rows into the current generation
+            clearcache = False
+            LOG.info('refreshing %s into cache %s updated after %s', model.__name__, keyPrefix, val)
+    max_watermark = [watermark]
+
+    def _make_cb(writer):
+        @tornado.gen.coroutine
+        def _load_cache_row(item):
+            if watermark_key:
+                v = item.get(watermark_column)
+                if v is not None and (max_watermark[0] is None or v > max_watermark[0]):
+                    max_watermark[0] = v
+            yield writer.add(item)
+        return _load_cache_row
+
+    def _load(cb, start_id, page_cb):
+        return load_data_from_rdbms(model, cb, filters=filters, start_after=start_id, page_cb=page_cb)
+
+    stats = yield _load_data_by_writer(cacheproxy, keyPrefix, make_writer, _make_cb, _load, clearcache, checkpoint_key)
+    if watermark_key and max_watermark[0] is not None:
+        yield cacheproxy.set(watermark_key, _format_watermark(max_watermark[0]))
+    return stats
+
+def _parse_watermark(model, column, val):
+    try:
+        python_type = getattr(model, column).type.python_type
+    except NotImplementedError:
+        return val
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(val)
+    elif python_type is datetime.date:
+        return datetime.date.fromisoformat(val)
+    return python_type(val)
+
+def _overlap_watermark(val, overlap):
+    if not overlap:
+        return val
+    if isinstance(val, (datetime.datetime, datetime.date)):
+        return val - datetime.timedelta(seconds=overlap)
+    if isinstance(val, (int, float)):
+        return val - overlap
+    return val
+
+def _format_watermark(val):
+    if isinstance(val, (datetime.datetime, datetime.date)):
+        return val.isoformat()
+    return str(val)
+
+@tornado.gen.coroutine
+def _load_data_by_writer(cacheproxy, keyPrefix, make_writer, make_cb, load_func, clearcache, checkpoint_key):
+    target_prefix, generation, start_id = yield _prepare_loading_target(cacheproxy, keyPrefix, clearcache, checkpoint_key)
+    if start_id:
+        LOG.info('resuming loading into cache %s after key:%s', target_prefix, start_id)
+    writer = make_writer(target_prefix)
+
     @tornado.gen.coroutine
-    def _load_cache_index(item):
-        yield cacheproxy.add_to_cache_indexed_to_many(item, keyPrefix, indexKey, pk)
-    if clearcache:
-        yield cacheproxy.clear_by_key_prefix(keyPrefix)
-    yield load_data_from_mongodb(model, _load_cache_index, filters=filters, orderby=orderby)
+    def _on_page_loaded(last_id, nrows):
+        # the checkpoint were recorded once the rows before it were written
+        yield writer.join()
+        yield cacheproxy.set(checkpoint_key, '%s|%s' % (generation or '', str(last_id)))
+
+    # without a checkpoint the batches in flight were not waited for page by page
+    stats = yield load_func(make_cb(writer), start_id, _on_page_loaded if checkpoint_key else None)
+    yield writer.join()
+    if generation:
+        yield cacheproxy.commit_generation(keyPrefix, generation)
+    if checkpoint_key:
+        yield cacheproxy.delete(checkpoint_key)
+    return stats
 
 @tornado.gen.coroutine
-def load_data_from_mongodb(model, cb, filters=None, orderby=None):
+def load_data_from_mongodb(model, cb, filters=None, orderby=None, start_id=None, page_size=LOAD_PAGE_SIZE, page_cb=None):
+    """Iterates mongo documents by id paging, the next page would be prefetched
+    while the current one is handled by ``cb``
+
+    :param callable cb: callback(item) invoked for each document
+    :param start_id: resumes the iterating after the id
+    :param int page_size: documents count of each page
+    :param callable page_cb: callback(last_id, nrows) invoked after each page handled
+    :return dict: {'rows': loaded rows, 'last_id': last loaded id, 'elapsed': seconds}
+    """
     dbproxy = DbProxy()
-    limit = 5000
+    limit = page_size
     offset = 0
-    nrows = limit
     modelName = str(model.__name__)
     LOG.info("loading %s from db begining", modelName)
     qfilters = []
     kwfilters = {}
-    curId = None
+    curId = start_id
     if isinstance(filters, tuple):
         for f in filters:
             if isinstance(f, dict):
@@ -61,28 +339,102 @@ def load_data_from_mongodb(model, cb, filters=None, orderby=None):
                 for v in f:
                     qfilters.append(v)
     elif isinstance(filters, dict):
-        kwfilters = filters
+        kwfilters = dict(filters)
     elif isinstance(filters, list):
         qfilters = filters
-    while nrows >= limit:
-        if curId:
-            kwfilters['id__gt'] = curId
-        rows = yield dbproxy.query_all_mongo(model, (qfilters, kwfilters), limit)
-        nrows = 0
+
+    def _query_page(after_id):
+        page_filters = dict(kwfilters)
+        if after_id:
+            page_filters['id__gt'] = after_id
+        # paging by id requires the documents ordered by id
+        return asyncio.ensure_future(dbproxy.query_all_mongo(model, (qfilters, page_filters), limit, sort='_id', direction='asc'))
+
+    t0 = time.time()
+    pending = _query_page(curId)
+    while pending is not None:
+        rows = yield pending
+        nrows = len(rows)
+        pending = None
+        if nrows >= limit:
+            # prefetch the next page while handling the current one
+            pending = _query_page(rows[-1].get('id'))
+        t1 = time.time()
         for row in rows:
-            nrows += 1
             curId = row.get('id')
             item = {}
             for k in row:
                 if k in DEFAULT_SKIP_FIELDS:
                     continue
                 item[k] = format_mongo_value(row.get(k))
-            if tornado.gen.is_coroutine_function(cb):
+            if tornado.gen.is_coroutine_function(cb) or asyncio.iscoroutinefunction(cb):
+                yield cb(item)
+            else:
+                cb(item)
+        if nrows and callable(page_cb):
+            yield page_cb(curId, nrows)
+        offset += nrows
+        t2 = time.time()
+        LOG.info("loading %s from db offset:%d rows:%d page:%.2fs rate:%.1f rows/s", modelName, offset, nrows,
+                 t2 - t1, offset / max(t2 - t0, 0.001))
+
+    elapsed = time.time() - t0
+    LOG.info("loading %s from db finished, %d rows in %.2fs (%.1f rows/s)", modelName, offset, elapsed, offset / max(elapsed, 0.001))
+    return {'rows': offset, 'last_id': curId, 'elapsed': elapsed}
+
+@tornado.gen.coroutine
+def load_data_from_rdbms(model, cb, filters=None, start_after=None, page_size=LOAD_PAGE_SIZE, page_cb=None, key=None):
+    """Iterates rdbms rows by keyset paging over the ``key`` column, the next page
+    would be prefetched while the current one is handled by ``cb``. The selected
+    columns are projected from the model metadata without the skipped response fields.
+
+    :param callable cb: callback(item) invoked for each row
+    :param start_after: resumes the iterating after the key value
+    :param int page_size: rows count of each page
+    :param callable page_cb: callback(last_key, nrows) invoked after each page handled
+    :param str key: unique keyset column, defaults to the primary key of model
+    :return dict: {'rows': loaded rows, 'last_id': last loaded key value, 'elapsed': seconds}
+    """
+    dbproxy = DbProxy()
+    columns, pk = model_columns(model)
+    key = key or pk or columns[0]
+    skip_fields = get_model_skip_response_fields(model)
+    selections = [k for k in columns if k not in skip_fields]
+    if key not in selections:
+        selections.append(key)
+    modelName = model.__name__
+    LOG.info("loading %s from db begining", modelName)
+
+    def _query_page(after):
+        return asyncio.ensure_future(dbproxy.query_list_after(model, filters, page_size, after=after, key=key, selections=selections))
+
+    if start_after is not None:
+        start_after = _parse_watermark(model, key, str(start_after))
+    offset = 0
+    curKey = start_after
+    t0 = time.time()
+    pending = _query_page(curKey)
+    while pending is not None:
+        rows = yield pending
+        nrows = len(rows)
+        pending = None
+        if nrows >= page_size:
+            # prefetch the next page while handling the current one
+            pending = _query_page(rows[-1].get(key))
+        t1 = time.time()
+        for item in rows:
+            curKey = item.get(key)
+            if tornado.gen.is_coroutine_function(cb) or asyncio.iscoroutinefunction(cb):
                 yield cb(item)
             else:
                 cb(item)
+        if nrows and callable(page_cb):
+            yield page_cb(curKey, nrows)
         offset += nrows
-        LOG.info("loading %s from db offset:%d rows:%d", modelName, offset, nrows)
-    
-    LOG.info("loading %s from db finished", modelName)
+        t2 = time.time()
+        LOG.info("loading %s from db offset:%d rows:%d page:%.2fs rate:%.1f rows/s", modelName, offset, nrows,
+                 t2 - t1, offset / max(t2 - t0, 0.001))
 
+    elapsed = time.time() - t0
+    LOG.info("loading %s from db finished, %d rows in %.2fs (%.1f rows/s)", modelName, offset, elapsed, offset / max(elapsed, 0.001))
+    return {'rows': offset, 'last_id': curKey, 'elapsed': elapsed}
@@ -552,7 +552,41 @@ class DbProxy(object):
                     _selections.append(col)
             qry = qry.with_entities(*_selections)
         rows = await self._execute_rdbms_result(dbinstance, qry, fetch_all=True)
+        items = self._format_rdbms_items(model, rows, columns, selections)
+        return items, total
 
+    async def query_list_after(self, model, filters, limit, after=None, key=None, selections=None, joins=None):
+        """RDBMS keyset paging query by orm model, it fetches rows ordered by the ``key``
+        column whose values are greater than ``after``, which avoids the total counting
+        and offset scanning of query_list while walking through large tables
+        :param model:modelutils.ModelBase sqlalchemy.ext.declarative.declarative_base implemented rdbms orm model
+        :param filters:list filter conditions
+        :param limit:int returning rows limit
+        :param after:any the last key value of previous page, None for the first page
+        :param key:str unique keyset column, defaults to the primary key of model
+        :param selections:list select fields instead of all model fields, it should contain the key column
+        :param joins:list multi table join condition
+        :return :list returns list of current queried rows
+        """
+        columns, pk = model_columns(model)
+        key = key or pk or columns[0]
+        filters = list(filters) if filters else []
+        if after is not None:
+            filters.append(getattr(model, key) > after)
+        qry, dbinstance, columns, _ = self._format_rdbms_query(model, filters, key, 'asc', joins=joins)
+        qry = qry.limit(limit)
+        if selections:
+            _selections = []
+            for col in selections:
+                if isinstance(col, str):
+                    _selections.append(getattr(model, col))
+                else:
+                    _selections.append(col)
+            qry = qry.with_entities(*_selections)
+        rows = await self._execute_rdbms_result(dbinstance, qry, fetch_all=True)
+        return self._format_rdbms_items(model, rows, columns, selections)
+
+    def _format_rdbms_items(self, model, rows, columns, selections=None):
         items = []
         if selections:
             for row in rows:
@@ -570,8 +604,7 @@ class DbProxy(object):
                         continue
                     item[k] = row._data[row._keymap[getattr(model, k).expression._label][1]]
                 items.append(item)
-
-        return items, total
+        return items
 
     def _format_rdbms_query(self, model, filters, sort, direction, joins=None):
         columns,pk = model_columns(model)
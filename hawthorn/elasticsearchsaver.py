@@ -1,25 +1,58 @@
 #!/usr/bin/python
 #-*- coding:utf-8 -*-
 
+import os
 import json
-from typing import Union
+import atexit
+from typing import Union, Optional, List, Dict, Any
 import logging
 import time
 import threading
-import queue
+import collections
 import elasticsearch
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import JSONSerializer
 
-from .supports import singleton
+from .supports import singleton, Constant
 
 LOG = logging.getLogger('common.elasticsearch_saver')
 
-_elastic_save_helper_queue_mutex = threading.Lock()
-_elastic_save_helper_queue = queue.Queue()
+_SERIALIZER = JSONSerializer()
+
+class _OverflowPolicy(Constant):
+    """What save does with a document while the pending queue were full,
+    spill appends it to the spill file, or drops it without a spill file
+    """
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    SPILL = 'spill'
+
+OVERFLOW_POLICY = _OverflowPolicy()
+
+class _ElasticSaverDefaults(Constant):
+    """
+    """
+    # documents pending at most, and per bulk request at most
+    QUEUE_LIMIT = 10000
+    BULK_MAX_ITEMS = 500
+    # bytes of a bulk request body at most, and bulk requests sent at once
+    BULK_MAX_BYTES = 5 * 1024 * 1024
+    BULK_WORKERS = 2
+    # statuses of bulk items and requests worth retrying, others were rejected
+    RETRYABLE_STATUSES = (408, 429, 502, 503, 504)
+    # seconds of the first retry after a failed bulk, doubled up to the max
+    RETRY_BACKOFF = 1
+    RETRY_BACKOFF_MAX = 60
+    # seconds waiting for the pending documents to be saved at exit
+    CLOSE_TIMEOUT = 5
+
+ELASTIC_SAVER_DEFAULTS = _ElasticSaverDefaults()
 
 @singleton
 class ElasticSearchSaver(object):
-    """ElasticSearch saver
+    """ElasticSearch saver, documents were queued and saved in bulk by
+    worker threads started on the first save, once SAVE_THRESHOLD documents
+    were pending or every SAVE_INTERVAL_SECONDS
     """
 
     def __init__(self):
@@ -27,8 +60,26 @@ class ElasticSearchSaver(object):
         self.SAVE_THRESHOLD = 10
         self.SAVE_INTERVAL_SECONDS = 2
         self.es_instance = Elasticsearch()
-        self.pendings = []
-        self.queue_mutex = threading.Lock()
+        self.queue_limit = ELASTIC_SAVER_DEFAULTS.QUEUE_LIMIT
+        self.overflow_policy = OVERFLOW_POLICY.DROP_OLDEST
+        self.spill_path = None
+        self.bulk_max_items = ELASTIC_SAVER_DEFAULTS.BULK_MAX_ITEMS
+        self.bulk_max_bytes = ELASTIC_SAVER_DEFAULTS.BULK_MAX_BYTES
+        self.bulk_workers = ELASTIC_SAVER_DEFAULTS.BULK_WORKERS
+        self.retry_backoff = ELASTIC_SAVER_DEFAULTS.RETRY_BACKOFF
+        self.retry_backoff_max = ELASTIC_SAVER_DEFAULTS.RETRY_BACKOFF_MAX
+        self.pendings = collections.deque()
+        self.queue_condition = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._spill_offset = 0
+        self._spill_replaying = False
+        self._workers = []
+        self._stopping = False
+        self._failures = 0
+        self._started_at = None
+        self._stats = {'queued': 0, 'saved': 0, 'failed_batches': 0, 'dropped': 0, 'spilled': 0, 'replayed': 0,
+                       'bulk_requests': 0, 'bulk_bytes': 0, 'bulk_time': 0.0, 'retried': 0, 'rejected': 0}
+        atexit.register(self.close)
 
     def configure(self, es_host: Union[str, list]) -> bool:
         if isinstance(es_host, str):
@@ -43,6 +94,52 @@ class ElasticSearchSaver(object):
             return False
         return True
 
+    def configure_pipeline(self, queue_limit: Optional[int] = None, overflow_policy: Optional[str] = None, spill_path: Optional[str] = None,
+                           save_threshold: Optional[int] = None, save_interval: Optional[float] = None, bulk_max_items: Optional[int] = None,
+                           bulk_max_bytes: Optional[int] = None, bulk_workers: Optional[int] = None,
+                           retry_backoff: Optional[float] = None, retry_backoff_max: Optional[float] = None):
+        """Configures the pending queue and the bulk saving, parameters left
+        None were kept as they were
+
+        :param int queue_limit: documents pending at most
+        :param str overflow_policy: OVERFLOW_POLICY.DROP_NEWEST, DROP_OLDEST or SPILL
+        :param str spill_path: file the documents were appended to as json lines
+            while elasticsearch failed, and replayed from once it recovered, an
+            empty path disables spilling
+        :param int save_threshold: pending documents triggering a bulk save
+        :param float save_interval: seconds between bulk saves at most
+        :param int bulk_max_items: documents taken by a worker at once
+        :param int bulk_max_bytes: bytes of a bulk request body at most, the
+            documents taken were split into several requests beyond it
+        :param int bulk_workers: bulk requests sent at once, workers added
+            were started on the next save
+        :param float retry_backoff: seconds before the first retry of a failed bulk
+        :param float retry_backoff_max: seconds between retries at most
+
+        """
+        with self.queue_condition:
+            if queue_limit is not None:
+                self.queue_limit = queue_limit
+            if overflow_policy is not None:
+                self.overflow_policy = overflow_policy
+            if spill_path is not None:
+                self.spill_path = spill_path
+            if save_threshold is not None:
+                self.SAVE_THRESHOLD = save_threshold
+            if save_interval is not None:
+                self.SAVE_INTERVAL_SECONDS = save_interval
+            if bulk_max_items is not None:
+                self.bulk_max_items = bulk_max_items
+            if bulk_max_bytes is not None:
+                self.bulk_max_bytes = bulk_max_bytes
+            if bulk_workers is not None:
+                self.bulk_workers = max(1, bulk_workers)
+            if retry_backoff is not None:
+                self.retry_backoff = retry_backoff
+            if retry_backoff_max is not None:
+                self.retry_backoff_max = retry_backoff_max
+            self.queue_condition.notify()
+
     def ensure_index(self, index: str, doc_type: str, mappings: dict = {}) -> bool:
         if self.es_instance:
             if doc_type and not mappings:
@@ -103,72 +200,285 @@ class ElasticSearchSaver(object):
         for param in (index, doc_type, body):
             if param in elasticsearch.client.SKIP_IN_PATH:
                 raise ValueError("Empty value passed for a required argument.")
-                return False
-        
-        _elastic_save_helper_queue_mutex.acquire()
-        _elastic_save_helper_queue.put_nowait({'action':'index', 'meta_data':{'_index':index, '_type':doc_type, '_id':id}, 'body':body})
-        # LOG.info(" put es object to queue, now queue size:%d", _elastic_save_helper_queue.qsize())
-        _elastic_save_helper_queue_mutex.release()
+
+        item = {'action':'index', 'meta_data':{'_index':index, '_type':doc_type, '_id':id}, 'body':body}
+        with self.queue_condition:
+            self._ensure_workers()
+            if len(self.pendings) >= self.queue_limit:
+                if self.overflow_policy == OVERFLOW_POLICY.SPILL and self.spill_path:
+                    return self._spill([item])
+                self._stats['dropped'] += 1
+                if self.overflow_policy != OVERFLOW_POLICY.DROP_OLDEST:
+                    return False
+                self.pendings.popleft()
+            self.pendings.append(item)
+            self._stats['queued'] += 1
+            if len(self.pendings) >= self.SAVE_THRESHOLD:
+                self.queue_condition.notify()
         return True
 
-    def _batch_save(self, item_queue: list) -> bool:
-        if not queue:
+    def stats(self) -> Dict[str, Any]:
+        """Returns the pending documents and the saving counters, the
+        indexing rate were the saved documents per second since the first
+        save, rejected were the documents elasticsearch refused for good
+        """
+        with self.queue_condition:
+            stats = dict(self._stats)
+            stats['pending'] = len(self.pendings)
+            stats['failures'] = self._failures
+            stats['workers'] = len(self._workers)
+        elapsed = (time.monotonic() - self._started_at) if self._started_at else 0.0
+        stats['indexing_rate'] = (stats['saved'] / elapsed) if elapsed > 0 else 0.0
+        stats['bulk_latency_avg'] = (stats['bulk_time'] / stats['bulk_requests']) if stats['bulk_requests'] else 0.0
+        return stats
+
+    def close(self, timeout: float = ELASTIC_SAVER_DEFAULTS.CLOSE_TIMEOUT):
+        """Stops the workers after a last bulk save of the pending documents,
+        documents left unsaved were spilled if the spill file were configured.
+        The workers start again on the next save.
+        """
+        with self.queue_condition:
+            workers = list(self._workers)
+            if not workers:
+                return
+            self._stopping = True
+            self.queue_condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+
+    def _ensure_workers(self):
+        # called holding queue_condition
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        while len(self._workers) < self.bulk_workers:
+            worker = threading.Thread(target=self._run_worker, name='elasticsearch-saver-%d' % len(self._workers), daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _take_batch(self) -> List[dict]:
+        """Waits for the pending documents reaching SAVE_THRESHOLD, or the
+        interval elapsed, then takes up to bulk_max_items of them
+        """
+        with self.queue_condition:
+            deadline = time.monotonic() + self.SAVE_INTERVAL_SECONDS
+            while not self._stopping and len(self.pendings) < self.SAVE_THRESHOLD:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.queue_condition.wait(remaining)
+            count = min(len(self.pendings), self.bulk_max_items)
+            return [self.pendings.popleft() for _ in range(count)]
+
+    def _run_worker(self):
+        while True:
+            batch = self._take_batch()
+            stopping = self._stopping
+            spilled_offset = None
+            if not batch and not stopping:
+                batch, spilled_offset = self._read_spilled(self.bulk_max_items)
+            if batch:
+                retries = self._batch_save(batch)
+                if spilled_offset is not None:
+                    if len(retries) == len(batch):
+                        # spilled documents failed again were still in the spill file
+                        self._commit_spilled(None, 0)
+                        self._on_batch_failed([], stopping)
+                        continue
+                    self._commit_spilled(spilled_offset, len(batch) - len(retries))
+                if retries:
+                    self._on_batch_failed(retries, stopping)
+                else:
+                    with self.queue_condition:
+                        self._failures = 0
+            if stopping:
+                with self.queue_condition:
+                    if not self.pendings or self._failures:
+                        if self.pendings and self.spill_path:
+                            self._spill(list(self.pendings))
+                            self.pendings.clear()
+                        self._workers.remove(threading.current_thread())
+                        if not self._workers:
+                            self._stopping = False
+                        break
+
+    def _on_batch_failed(self, batch: List[dict], stopping: bool):
+        """Spills the documents to be retried, or keeps them ahead of the
+        pending queue within the queue limit, then backs off before the next
+        bulk
+        """
+        with self.queue_condition:
+            self._failures += 1
+            self._stats['failed_batches'] += 1
+            backoff = min(self.retry_backoff_max, self.retry_backoff * (2 ** (self._failures - 1)))
+            if batch and not self.spill_path:
+                room = max(0, self.queue_limit - len(self.pendings))
+                if room < len(batch):
+                    self._stats['dropped'] += len(batch) - room
+                    batch = batch[:room]
+                self.pendings.extendleft(reversed(batch))
+        if batch and self.spill_path:
+            self._spill(batch)
+        if stopping:
+            return
+        LOG.warning('elasticsearch saver retries bulk save in %.1f seconds after %d failures', backoff, self._failures)
+        with self.queue_condition:
+            # save and configure_pipeline were not waking the worker before the backoff elapsed
+            deadline = time.monotonic() + backoff
+            while not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.queue_condition.wait(remaining)
+
+    def _spill(self, items: List[dict]) -> bool:
+        try:
+            with self._spill_lock:
+                path_name, _ = os.path.split(self.spill_path)
+                if path_name and not os.path.exists(path_name):
+                    os.makedirs(path_name, 0o777)
+                with open(self.spill_path, 'a') as f:
+                    f.write(''.join(_SERIALIZER.dumps(item) + '\n' for item in items))
+        except Exception as e:
+            LOG.error('elasticsearch saver spill %d items into %s failed with error:%s', len(items), self.spill_path, str(e))
+            self._count(dropped=len(items))
             return False
+        self._count(spilled=len(items))
+        return True
+
+    def _read_spilled(self, limit: int):
+        """Reads up to limit spilled documents from the committed offset,
+        returns them with the offset after them. Only one worker replays at
+        a time, until it commits the offset by _commit_spilled, so that the
+        same documents were not replayed twice.
+        """
+        if not self.spill_path:
+            return [], None
         items = []
+        with self._spill_lock:
+            if self._spill_replaying:
+                return [], None
+            if not os.path.exists(self.spill_path):
+                self._spill_offset = 0
+                return [], None
+            try:
+                with open(self.spill_path, 'r') as f:
+                    f.seek(self._spill_offset)
+                    while len(items) < limit:
+                        line = f.readline()
+                        if not line:
+                            break
+                        if line.strip():
+                            items.append(json.loads(line))
+                    offset = f.tell()
+            except Exception as e:
+                LOG.error('elasticsearch saver read spilled items from %s failed with error:%s', self.spill_path, str(e))
+                return [], None
+            if not items:
+                # nothing but blank lines were left
+                self._remove_spilled()
+                return [], None
+            self._spill_replaying = True
+            return items, offset
+
+    def _commit_spilled(self, offset: Optional[int], count: int):
+        """Moves the offset past the saved documents, or keeps it when offset
+        were None, then lets the next replay start. The spill file were
+        removed once all of them were saved.
+        """
+        self._count(replayed=count)
+        with self._spill_lock:
+            self._spill_replaying = False
+            if offset is None:
+                return
+            self._spill_offset = offset
+            try:
+                if offset >= os.path.getsize(self.spill_path):
+                    self._remove_spilled()
+            except OSError as e:
+                LOG.error('elasticsearch saver remove spill file %s failed with error:%s', self.spill_path, str(e))
+
+    def _remove_spilled(self):
+        # called holding _spill_lock
+        os.remove(self.spill_path)
+        self._spill_offset = 0
+
+    def _bulk_chunks(self, item_queue: List[dict]):
+        """Serializes the documents into bulk request bodies of at most
+        bulk_max_bytes, yields the documents with their body
+        """
+        chunk = []
+        lines = []
+        size = 0
         for item in item_queue:
             meta_data = {}
             for k,v in item['meta_data'].items():
                 if v is not None:
                     meta_data[k] = v
-            action_and_meta_data = {}
-            action_and_meta_data[item['action']] = meta_data
-            items.append(action_and_meta_data)
-            items.append(item['body'])
-        
-        try:
-            if not self.es_instance.bulk(items):
-                LOG.error('elasticsearch batch save item failed')
-        except Exception as e:
-            LOG.error(" elasticsearch batch save %d items failed with error:%s", len(item_queue), str(e))
-            return False
-        LOG.info(" elasticsearch batch saved %d items.", len(item_queue))
-        return True
+            try:
+                line = _SERIALIZER.dumps({item['action']: meta_data}) + '\n' + _SERIALIZER.dumps(item['body']) + '\n'
+            except Exception as e:
+                LOG.error('elasticsearch saver serialize document of index:%s failed with error:%s', str(meta_data.get('_index')), str(e))
+                self._count(rejected=1)
+                continue
+            line = line.encode('utf-8')
+            if chunk and size + len(line) > self.bulk_max_bytes:
+                yield chunk, b''.join(lines)
+                chunk, lines, size = [], [], 0
+            chunk.append(item)
+            lines.append(line)
+            size += len(line)
+        if chunk:
+            yield chunk, b''.join(lines)
 
-ELASTICSEARCH_SAVER = ElasticSearchSaver()
+    def _batch_save(self, item_queue: List[dict]) -> List[dict]:
+        """Saves the documents in bulk requests, returns the documents to be
+        retried, which were those of the failed requests and the items failed
+        with a retryable status, other failed items were rejected
+        """
+        retries = []
+        for chunk, body in self._bulk_chunks(item_queue):
+            started = time.monotonic()
+            try:
+                resp = self.es_instance.bulk(body=body)
+            except Exception as e:
+                status = getattr(e, 'status_code', None)
+                self._count(bulk_requests=1, bulk_time=time.monotonic() - started)
+                if isinstance(status, int) and status not in ELASTIC_SAVER_DEFAULTS.RETRYABLE_STATUSES:
+                    LOG.error(" elasticsearch batch save %d items rejected with error:%s", len(chunk), str(e))
+                    self._count(rejected=len(chunk))
+                    continue
+                LOG.error(" elasticsearch batch save %d items failed with error:%s", len(chunk), str(e))
+                retries.extend(chunk)
+                continue
+            self._count(bulk_requests=1, bulk_bytes=len(body), bulk_time=time.monotonic() - started)
+            if not resp.get('errors'):
+                self._count(saved=len(chunk))
+                continue
+            saved = 0
+            rejected = 0
+            retried = 0
+            reason = None
+            for item, result in zip(chunk, resp.get('items', [])):
+                result = next(iter(result.values()), {})
+                status = result.get('status', 500)
+                if status < 300:
+                    saved += 1
+                elif status in ELASTIC_SAVER_DEFAULTS.RETRYABLE_STATUSES:
+                    retried += 1
+                    retries.append(item)
+                else:
+                    rejected += 1
+                    reason = reason or result.get('error')
+            if rejected:
+                LOG.error(" elasticsearch batch save rejected %d of %d items, the first with error:%s", rejected, len(chunk), str(reason))
+            self._count(saved=saved, rejected=rejected, retried=retried)
+        LOG.debug(" elasticsearch batch saved %d items, %d to be retried.", len(item_queue), len(retries))
+        return retries
 
-def _elastic_save_helper_worker():
-    tmp_queue = []
-    tmp_queue_len = 0
-    tmp_cur_time = 0
-    last_looping_time = time.time()
-    while True:
-        _elastic_save_helper_queue_mutex.acquire()
-        tmp_queue_len = _elastic_save_helper_queue.qsize()
-        tmp_cur_time = time.time()
-        tmp_queue = None
-        if (tmp_queue_len >= ELASTICSEARCH_SAVER.SAVE_THRESHOLD) or (tmp_cur_time - last_looping_time >= ELASTICSEARCH_SAVER.SAVE_INTERVAL_SECONDS):
-            if tmp_queue_len:
-                LOG.debug(" elasticsearch save helper triggered batch save objects, queue size:%d", tmp_queue_len)
-                tmp_queue = []
-                while not _elastic_save_helper_queue.empty():
-                    item = _elastic_save_helper_queue.get_nowait()
-                    _elastic_save_helper_queue.task_done()
-                    if item:
-                        tmp_queue.append(item)
-            else:
-                tmp_queue = None
-            last_looping_time = tmp_cur_time
-
-        _elastic_save_helper_queue_mutex.release()
-        
-        if tmp_queue:
-            if not ELASTICSEARCH_SAVER._batch_save(tmp_queue):
-                _elastic_save_helper_queue_mutex.acquire()
-                for item in tmp_queue:
-                    _elastic_save_helper_queue.put_nowait(item)
-                _elastic_save_helper_queue_mutex.release()
-
-        time.sleep(0.1)
-
-_elastic_saver_thread = threading.Thread(target=_elastic_save_helper_worker)
-_elastic_saver_thread.start()
+    def _count(self, **deltas):
+        with self.queue_condition:
+            for key, delta in deltas.items():
+                self._stats[key] += delta
+
+ELASTICSEARCH_SAVER = ElasticSearchSaver()
@@ -4,106 +4,483 @@
 import os
 import secrets
 import json
+import time
+import heapq
+import atexit
+import collections
+import logging
+import asyncio
+import functools
+import threading
+import redis
 import tornado.web
+from concurrent.futures import ThreadPoolExecutor
 from .utilities import singleton
-from .cacheproxy import CacheProxy
 
-_all_user_session_info = {}
+LOG = logging.getLogger('components.session')
+
+SESSION_KEY = '__session__'
+SESSION_TTL = 86400
+SESSION_JOURNAL_FLUSH_INTERVAL = 1.0
+SESSION_MAX_SESSIONS = 100000
+SESSION_JOURNAL_COMPACT_RATIO = 4
+SESSION_JOURNAL_COMPACT_MIN_LINES = 10000
+SESSION_IO_WORKERS = 4
+
+class SessionBackend(object):
+    """Storage of session data, the data of a session were loaded once per request
+    and only the changed fields were saved, backends doing network I/O set
+    ``blocking`` so that requests load and save their sessions on an executor
+    rather than on the ioloop
+    """
+    blocking = False
+
+    def load(self, sid: str):
+        """Loads the data of session ``sid``, returns None if it does not exist"""
+        raise NotImplementedError
+
+    def save(self, sid: str, changed: dict, removed=None):
+        """Saves the changed fields of session ``sid`` and removes the fields of ``removed``"""
+        raise NotImplementedError
+
+    def delete(self, sid: str):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class RedisSessionBackend(SessionBackend):
+    """Stores each session as a redis hash of json encoded fields, the expiry of
+    the hash slides by ``ttl`` seconds on every load and save
+    """
+    blocking = True
+
+    def __init__(self, conf: dict):
+        self.key_prefix = conf.get('key_prefix', 'session:')
+        self.ttl = int(conf.get('ttl', SESSION_TTL))
+        self.client = redis.StrictRedis(host=conf.get('host', 'localhost'), port=conf.get('port', 6379),
+            db=conf.get('db', 0), password=conf.get('password', None))
+
+    def load(self, sid: str):
+        key = self.key_prefix + sid
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hgetall(key)
+        pipe.expire(key, self.ttl)
+        values, _ = pipe.execute()
+        if not values:
+            return None
+        return {(k.decode() if isinstance(k, bytes) else k): json.loads(v) for k, v in values.items()}
+
+    def save(self, sid: str, changed: dict, removed=None):
+        key = self.key_prefix + sid
+        pipe = self.client.pipeline(transaction=False)
+        if changed:
+            pipe.hset(key, mapping={k: json.dumps(v) for k, v in changed.items()})
+        if removed:
+            pipe.hdel(key, *removed)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def delete(self, sid: str):
+        self.client.delete(self.key_prefix + sid)
+
+class MemorySessionBackend(SessionBackend):
+    """Keeps sessions in process memory, the changes were appended to a journal
+    file by a background thread every ``flush_interval`` seconds and replayed
+    on start, instead of rewriting all sessions on every change.
+
+    Sessions expire ``ttl`` seconds after their last access by a heap of expiry
+    times, at most ``max_sessions`` sessions were kept by evicting the least
+    recently used ones, and the journal were compacted into a snapshot of the
+    live sessions once it has ``compact_ratio`` times more lines than sessions.
+    """
+
+    def __init__(self, conf: dict = {}):
+        self.path = conf.get('path', 'data/session-data.log')
+        self.flush_interval = float(conf.get('flush_interval', SESSION_JOURNAL_FLUSH_INTERVAL))
+        self.ttl = float(conf.get('ttl', SESSION_TTL))
+        self.max_sessions = int(conf.get('max_sessions', SESSION_MAX_SESSIONS))
+        self.compact_ratio = float(conf.get('compact_ratio', SESSION_JOURNAL_COMPACT_RATIO))
+        # the time source of the expiries
+        self.clock = time.time
+        self.sessions = collections.OrderedDict()
+        self._expiries = {}
+        self._journaled_expiries = {}
+        self._expiry_heap = []
+        self._journal_lines = 0
+        self._pending = []
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        legacy_path = conf.get('legacy_path', 'data/session-data.bin')
+        if os.path.exists(self.path):
+            self.replay()
+            if self._need_compact():
+                self.compact()
+        elif legacy_path and os.path.exists(legacy_path):
+            self.import_legacy(legacy_path)
+        atexit.register(self.flush)
+
+    def replay(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                self._journal_lines += 1
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # a partial line of an interrupted write
+                    LOG.warning('skips broken session journal line of %s', self.path)
+                    continue
+                self._apply(op)
+        self._rebuild_heap()
+        self.expire_sessions()
+        LOG.info('replayed %d sessions from %d lines of %s', len(self.sessions), self._journal_lines, self.path)
+
+    def import_legacy(self, legacy_path):
+        """Imports the sessions of the json file written by previous versions"""
+        with open(legacy_path, 'r') as f:
+            data = json.loads(f.read() or '{}')
+        for sid, fields in data.items():
+            self.save(sid, fields)
+        self.flush()
+
+    def _apply(self, op):
+        sid = op.get('sid')
+        if op.get('op') == 'del':
+            self._remove(sid)
+            return
+        if op.get('op') == 'set':
+            data = self.sessions.setdefault(sid, {})
+            data.update(op.get('changed', {}))
+            for k in op.get('removed', []):
+                data.pop(k, None)
+        elif sid not in self.sessions:
+            return
+        self.sessions.move_to_end(sid)
+        expiry = op.get('exp') or self.clock() + self.ttl
+        self._expiries[sid] = expiry
+        self._journaled_expiries[sid] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, sid))
+
+    def _remove(self, sid):
+        self.sessions.pop(sid, None)
+        self._expiries.pop(sid, None)
+        self._journaled_expiries.pop(sid, None)
+
+    def _touch(self, sid):
+        """Slides the expiry of session ``sid``, the expiry is journaled only when
+        it moved by more than a tenth of ttl, so that reads rarely write
+        """
+        self.sessions.move_to_end(sid)
+        expiry = self.clock() + self.ttl
+        self._expiries[sid] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, sid))
+        if expiry - self._journaled_expiries.get(sid, 0) > self.ttl / 10:
+            self._journaled_expiries[sid] = expiry
+            self._append({'op': 'touch', 'sid': sid, 'exp': expiry})
+        if len(self._expiry_heap) > 2 * len(self.sessions) + 1024:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        # drops heap entries of slid expiries
+        self._expiry_heap = [(exp, k) for k, exp in self._expiries.items()]
+        heapq.heapify(self._expiry_heap)
+
+    def expire_sessions(self):
+        """Removes expired sessions and the least recently used sessions beyond max_sessions
+
+        :return int: count of removed sessions
+        """
+        now = self.clock()
+        count = 0
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expiry, sid = heapq.heappop(self._expiry_heap)
+                if self._expiries.get(sid) == expiry:
+                    self._remove(sid)
+                    self._append({'op': 'del', 'sid': sid})
+                    count += 1
+            while len(self.sessions) > self.max_sessions:
+                sid, _ = self.sessions.popitem(last=False)
+                self._remove(sid)
+                self._append({'op': 'del', 'sid': sid})
+                count += 1
+        return count
+
+    def load(self, sid: str):
+        with self._lock:
+            self.expire_sessions()
+            data = self.sessions.get(sid)
+            if data is None:
+                return None
+            self._touch(sid)
+            return dict(data)
+
+    def save(self, sid: str, changed: dict, removed=None):
+        op = {'op': 'set', 'sid': sid, 'changed': changed, 'exp': self.clock() + self.ttl}
+        if removed:
+            op['removed'] = list(removed)
+        with self._lock:
+            self._apply(op)
+            self._append(op)
+            self.expire_sessions()
+
+    def delete(self, sid: str):
+        op = {'op': 'del', 'sid': sid}
+        with self._lock:
+            self._apply(op)
+            self._append(op)
+
+    def _append(self, op):
+        with self._lock:
+            self._pending.append(json.dumps(op))
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name='session-journal', daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.expire_sessions()
+                self.flush()
+            except Exception as e:
+                LOG.error('flush session journal %s failed with error:%s', self.path, str(e))
+
+    def _need_compact(self):
+        return self._journal_lines > max(SESSION_JOURNAL_COMPACT_MIN_LINES, self.compact_ratio * len(self.sessions))
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            self._journal_lines += len(pending)
+            if self._need_compact():
+                self.compact()
+                return
+            self._ensure_path()
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(pending) + '\n')
+
+    def compact(self):
+        """Rewrites the journal into one line per live session, the snapshot were
+        written into a temporary file which then replaces the journal atomically
+        """
+        with self._lock:
+            self.expire_sessions()
+            # the snapshot covers the pending changes
+            self._pending = []
+            lines = [json.dumps({'op': 'set', 'sid': sid, 'changed': data, 'exp': self._expiries.get(sid)})
+                for sid, data in self.sessions.items()]
+        self._ensure_path()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if lines:
+                f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        LOG.info('compacted session journal %s from %d lines into %d', self.path, self._journal_lines, len(lines))
+        self._journal_lines = len(lines)
+
+    def _ensure_path(self):
+        path_name, _ = os.path.split(self.path)
+        if path_name and not os.path.exists(path_name):
+            os.makedirs(path_name, 0o777)
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+
+_SESSION_BACKENDS = {
+    'redis': RedisSessionBackend,
+    'memory': MemorySessionBackend,
+}
 
 @singleton
 class HandlerSessionDataManager():
-    
+
     def __init__(self):
-        self.session_data_map = {}
-        self.cache_path = 'data/session-data.bin'
-        if os.path.exists(self.cache_path):
-            with open(self.cache_path, 'r+') as f:
-                cont = f.read()
-                data = json.loads(cont)
-                for k, value in data.items():
-                    self.session_data_map[k] = value
-                f.close()
+        self.backend = None
+        self._executor = None
+
+    def configure(self, conf: dict):
+        """Configures session backend like {'type': 'redis', 'host': 'localhost', 'port': 6379, 'ttl': 86400}
+        or {'type': 'memory', 'path': 'data/session-data.log'}
+        """
+        typ = conf.get('type', 'memory')
+        if typ not in _SESSION_BACKENDS:
+            LOG.error('configure session with configure:%s failed with unknown session backend type', str(conf))
+            return False
+        self.backend = _SESSION_BACKENDS[typ](conf)
+        return True
+
+    def get_backend(self) -> SessionBackend:
+        if self.backend is None:
+            self.backend = MemorySessionBackend()
+        return self.backend
+
+    def is_blocking(self):
+        return self.get_backend().blocking
+
+    async def _run(self, func, *args):
+        """Runs the backend call on the executor if the backend were blocking"""
+        if not self.get_backend().blocking:
+            return func(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=SESSION_IO_WORKERS, thread_name_prefix='session-io')
+        return await asyncio.get_event_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    def load(self, key: str):
+        return self.get_backend().load(key)
+
+    def save(self, key: str, changed: dict, removed=None):
+        self.get_backend().save(key, changed, removed)
+
+    async def load_async(self, key: str):
+        return await self._run(self.get_backend().load, key)
+
+    async def save_async(self, key: str, changed: dict, removed=None):
+        await self._run(self.get_backend().save, key, changed, removed)
+
+    async def delete_async(self, key: str):
+        await self._run(self.get_backend().delete, key)
 
     def set_item(self, key: str, name: str, value: any):
-        # CacheProxy().
-        if key not in self.session_data_map:
-            self.session_data_map[key] = {}
-        self.session_data_map[key][name] = value
-        self.save_to_cache()
-    
+        self.save(key, {name: value})
+
     def get_item(self, key: str, name: str):
-        data = self.session_data_map.get(key, None)
+        data = self.load(key)
         if data:
             return data.get(name, None)
         return None
-    
+
     def key_exists(self, key: str):
-        return self.session_data_map.get(key, None)
-    
+        return self.load(key)
+
     def delete(self, key: str):
-        if key in self.session_data_map:
-            del self.session_data_map[key]
-        self.save_to_cache()
-
-    def save_to_cache(self):
-        data = json.dumps(self.session_data_map)
-        if not os.path.exists(self.cache_path):
-            path_name, _ = os.path.split(self.cache_path)
-            if not os.path.exists(path_name):
-                os.makedirs(path_name, 0o777)
-        with open(self.cache_path, 'w+') as f:
-            f.write(data)
-            f.close()
+        self.get_backend().delete(key)
 
 _session_manager = HandlerSessionDataManager()
 
-SESSION_KEY = '__session__'
-
 class TornadoSession(object):
+    """Session of a request, the signed cookie were decoded once at the first
+    access of the session, the session data were loaded once by the first read,
+    and the changes were saved once by flush when the request finished
+    """
     def __init__(self, handler: tornado.web.RequestHandler):
         self.handler = handler
         self.random_index_str = None
+        self._cookie_decoded = False
+        self._cookie_set = False
+        self._data = None
+        self._changed = {}
+        self._removed = set()
+        self._deleted_sid = None
 
     def __get_random_str(self):
         return secrets.token_urlsafe()
 
-    def __setitem__(self, key, value):
-        if not self.random_index_str:
+    def _get_session_id(self):
+        if not self._cookie_decoded:
+            self._cookie_decoded = True
             random_index_str = self.handler.get_secure_cookie(SESSION_KEY, None)
             if random_index_str:
-                if not _session_manager.key_exists(random_index_str):
-                    self.random_index_str = self.__get_random_str()
-            else:
-                self.random_index_str = self.__get_random_str()
-                self.handler.set_secure_cookie(SESSION_KEY, self.random_index_str)
-        _session_manager.set_item(self.random_index_str, key, value)
-        # if not self.random_index_str:
-        #     random_index_str = self.handler.get_secure_cookie(SESSION_KEY, None)
-        #     if random_index_str:
-        #         if random_index_str not in _all_user_session_info:
-        #             self.random_index_str = self.__get_random_str()
-        #             _all_user_session_info[self.random_index_str] = {}
-        #     else:
-        #         self.random_index_str = self.__get_random_str()
-        #         self.handler.set_secure_cookie(SESSION_KEY, self.random_index_str)
-        #         _all_user_session_info[self.random_index_str] = {}
-        # _all_user_session_info[self.random_index_str][key] = value
-        self.handler.set_secure_cookie(SESSION_KEY, self.random_index_str)
+                self.random_index_str = str(random_index_str, encoding='utf-8')
+        return self.random_index_str
+
+    async def preload(self):
+        """Loads the session data ahead of the first read, so that a blocking
+        backend were not called on the ioloop
+        """
+        if self._data is None:
+            sid = self._get_session_id()
+            self._data = (await _session_manager.load_async(sid) if sid else None) or {}
+
+    def _get_data(self):
+        if self._data is None:
+            sid = self._get_session_id()
+            if sid and _session_manager.is_blocking():
+                raise RuntimeError('session of a blocking session backend were read before loaded, '
+                                   'await handler.load_session() or enable preload_session of the handler')
+            self._data = (_session_manager.load(sid) if sid else None) or {}
+        return self._data
+
+    def __setitem__(self, key, value):
+        if not self._get_session_id() or not self._get_data():
+            # starts a new session rather than adopting an unknown session id
+            self.random_index_str = self.__get_random_str()
+            self._data = {}
+            self._cookie_set = False
+        self._data[key] = value
+        self._changed[key] = value
+        self._removed.discard(key)
+        if not self._cookie_set:
+            self._cookie_set = True
+            self.handler.set_secure_cookie(SESSION_KEY, self.random_index_str)
 
     def __getitem__(self, key):
-        self.random_index_str = self.handler.get_secure_cookie(SESSION_KEY, None)
-        if self.random_index_str:
-            self.random_index_str = str(self.random_index_str, encoding='utf-8')
-            return _session_manager.get_item(self.random_index_str, key)
-            # current_info = _all_user_session_info.get(self.random_index_str, None)
-            # if current_info:
-            #     return current_info.get(key, None)
-        return None
+        if not self._get_session_id():
+            return None
+        return self._get_data().get(key, None)
+
+    def __delitem__(self, key):
+        if self[key] is not None or key in self._changed:
+            self._data.pop(key, None)
+            self._changed.pop(key, None)
+            self._removed.add(key)
+
+    def is_dirty(self):
+        return bool(self._changed or self._removed or self._deleted_sid)
+
+    def flush(self):
+        """Saves the changed fields of the session, does nothing if unchanged,
+        sessions of a blocking backend were saved by flush_async only
+        """
+        if _session_manager.is_blocking():
+            raise RuntimeError('sessions of a blocking session backend were saved by flush_async')
+        if not self.random_index_str or not self.is_dirty():
+            return
+        _session_manager.save(self.random_index_str, self._changed, self._removed)
+        self._changed = {}
+        self._removed = set()
+
+    async def flush_async(self):
+        """Saves the changed fields of the session like flush, and deletes the
+        session deleted by the request, on the executor if the backend were blocking
+        """
+        if self._deleted_sid:
+            sid, self._deleted_sid = self._deleted_sid, None
+            await _session_manager.delete_async(sid)
+        if not self.random_index_str or not self.is_dirty():
+            return
+        changed, removed = self._changed, self._removed
+        self._changed = {}
+        self._removed = set()
+        await _session_manager.save_async(self.random_index_str, changed, removed)
 
     def delete(self):
-        self.random_index_str = self.handler.get_secure_cookie(SESSION_KEY, None)
-        if self.random_index_str:
-            self.random_index_str = str(self.random_index_str, encoding='utf-8')
-            _session_manager.delete(self.random_index_str)
-            # if self.random_index_str in _all_user_session_info:
-            #     del _all_user_session_info[self.random_index_str]
+        """Deletes the session, the deleting of a blocking backend were deferred
+        to flush_async, which the handler awaits before finishing the response
+        """
+        if self._get_session_id():
+            if _session_manager.is_blocking():
+                self._deleted_sid = self.random_index_str
+            else:
+                _session_manager.delete(self.random_index_str)
+        self._reset()
+
+    async def delete_async(self):
+        if self._get_session_id():
+            await _session_manager.delete_async(self.random_index_str)
+        self._reset()
+
+    def _reset(self):
+        self._data = {}
+        self._changed = {}
+        self._removed = set()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+
+def is_compression_supported(method: str) -> bool:
+    if method == COMPRESSION_ZSTD:
+        return zstandard is not None
+    return method in (COMPRESSION_GZIP, COMPRESSION_ZLIB)
+
+def compress(data: bytes, method: str, level: int = None) -> bytes:
+    """Compresses data by method of gzip, zlib or zstd, zstd requires zstandard package"""
+    if method == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd compression requires zstandard package')
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    elif method == COMPRESSION_GZIP:
+        return gzip.compress(data, compresslevel=6 if level is None else level)
+    elif method == COMPRESSION_ZLIB:
+        return zlib.compress(data, 6 if level is None else level)
+    raise ValueError('unsupported compression method:%s' % str(method))
+
+def decompress(data: bytes, method: str) -> bytes:
+    if method == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd decompression requires zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif method == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    elif method == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    raise ValueError('unsupported compression method:%s' % str(method))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hashed timer wheel for large numbers of short timeouts, adding and cancelling
+a timer were O(1) and a single ioloop timer drives the whole wheel, so that
+thousands of pending timeouts do not each hold an ioloop timer.
+"""
+
+import math
+import time
+import logging
+from tornado.ioloop import IOLoop
+
+LOG = logging.getLogger('utilities.timerwheel')
+
+class WheelTimer(object):
+    """A timer scheduled by TimerWheel.add
+    """
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'active')
+
+    def __init__(self, wheel, slot: int, rounds: int, callback: callable):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.active = True
+
+    def cancel(self):
+        """Cancels the timer, cancelling a fired or cancelled timer does nothing
+        """
+        if self.active:
+            self.active = False
+            self.wheel._remove(self)
+
+class TimerWheel(object):
+    """Timer wheel with resolution seconds per slot, timers were fired at most
+    one resolution late, the timers longer than the wheel span wait for
+    several rounds
+    """
+
+    def __init__(self, resolution: float = 0.1, slots: int = 512):
+        """Constructs a timer wheel
+
+        :param float resolution: Seconds per slot
+        :param int slots: Slots count of the wheel
+
+        """
+        self.resolution = resolution
+        self._slots = [set() for _ in range(max(1, slots))]
+        self._cursor = 0
+        self._tick_at = 0.0
+        self._count = 0
+        self._ioloop = None
+        self._handle = None
+        self._ticking = False
+
+    def __len__(self):
+        return self._count
+
+    def add(self, delay: float, callback: callable) -> WheelTimer:
+        """Schedules callback() after delay seconds, must be called on the
+        ioloop thread which drives the wheel
+
+        :param float delay: Seconds to wait
+        :param callable callback: Called without arguments once expired
+
+        :return WheelTimer the handle to cancel the timer
+
+        """
+        now = time.monotonic()
+        if self._handle is None and not self._ticking:
+            self._tick_at = now
+            self._ioloop = IOLoop.current()
+            self._handle = self._ioloop.call_later(self.resolution, self._tick)
+        n = len(self._slots)
+        ticks = max(1, int(math.ceil((now + delay - self._tick_at) / self.resolution)))
+        slot = (self._cursor + ticks) % n
+        timer = WheelTimer(self, slot, (ticks - 1) // n, callback)
+        self._slots[slot].add(timer)
+        self._count += 1
+        return timer
+
+    def _remove(self, timer: WheelTimer):
+        self._slots[timer.slot].discard(timer)
+        self._count -= 1
+        if not self._count and self._handle is not None and not self._ticking:
+            self._ioloop.remove_timeout(self._handle)
+            self._handle = None
+
+    def _tick(self):
+        self._handle = None
+        self._ticking = True
+        now = time.monotonic()
+        n = len(self._slots)
+        # catches up the slots passed while the ioloop were busy
+        while self._count and self._tick_at + self.resolution <= now:
+            self._tick_at += self.resolution
+            self._cursor = (self._cursor + 1) % n
+            bucket = self._slots[self._cursor]
+            if not bucket:
+                continue
+            expired = []
+            for timer in bucket:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    expired.append(timer)
+            for timer in expired:
+                bucket.discard(timer)
+                self._count -= 1
+                timer.active = False
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    LOG.error('Timer callback %s failed with error:%s', str(timer.callback), str(e))
+        self._ticking = False
+        if self._count:
+            delay = max(0, self._tick_at + self.resolution - time.monotonic())
+            self._handle = self._ioloop.call_later(delay, self._tick)
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process stand-in of a RabbitMQ broker speaking the pika channel API used by
+hawthorn.amqplib, injected by RabbitMQWorker(connection_class=StandinConnection)
+or by the 'connection_class' connection configuration, so that amqplib could be
+tested and benchmarked without a live broker.
+
+The stand-in routes by direct, topic and fanout exchanges, round-robins the
+consumers of a queue within their prefetch counts, requeues the unacked
+messages of closed channels and supports publisher confirms and returns. The
+frames were delivered by the ioloop callbacks just as pika does.
+"""
+
+import functools
+import itertools
+from collections import deque, OrderedDict
+from typing import Dict, List, Optional
+import pika
+import pika.frame
+import pika.spec
+import pika.exceptions
+from tornado.ioloop import IOLoop
+
+# deliveries per ioloop callback of a queue
+PUMP_BATCH = 500
+
+class StandinMessage(object):
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body', 'redelivered')
+
+    def __init__(self, exchange: str, routing_key: str, properties: pika.BasicProperties, body: bytes):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+
+class StandinConsumer(object):
+    __slots__ = ('tag', 'channel', 'queue', 'callback', 'auto_ack', 'prefetch_count', 'unacked')
+
+    def __init__(self, tag: str, channel: 'StandinChannel', queue: 'StandinQueue', callback: callable, auto_ack: bool, prefetch_count: int):
+        self.tag = tag
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.auto_ack = auto_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    def has_capacity(self) -> bool:
+        return self.auto_ack or not self.prefetch_count or self.unacked < self.prefetch_count
+
+class StandinQueue(object):
+
+    def __init__(self, name: str, durable: bool = False, auto_delete: bool = False):
+        self.name = name
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.messages: deque = deque()
+        self.consumers: List[StandinConsumer] = []
+        self.cursor = 0
+        self.pumping = False
+
+def _words_match(pattern: List[str], words: List[str]) -> bool:
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_words_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return (pattern[0] == '*' or pattern[0] == words[0]) and _words_match(pattern[1:], words[1:])
+
+@functools.lru_cache(maxsize=4096)
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    return _words_match(pattern.split('.'), routing_key.split('.') if routing_key else [])
+
+class StandinBroker(object):
+    """A virtual host of the stand-in broker
+    """
+    _brokers: Dict[str, 'StandinBroker'] = {}
+
+    def __init__(self):
+        self.exchanges: Dict[str, str] = {'': 'direct'}
+        self.queues: Dict[str, StandinQueue] = {}
+        self.bindings: Dict[str, List[tuple]] = {}
+        self._names = itertools.count(1)
+        self.stats = {
+            'published': 0,
+            'routed': 0,
+            'unroutable': 0,
+            'delivered': 0,
+            'acked': 0,
+            'nacked': 0,
+            'requeued': 0,
+        }
+
+    @classmethod
+    def of(cls, virtual_host: str) -> 'StandinBroker':
+        broker = cls._brokers.get(virtual_host)
+        if broker is None:
+            broker = cls._brokers[virtual_host] = cls()
+        return broker
+
+    @classmethod
+    def reset(cls):
+        cls._brokers = {}
+
+    def declare_queue(self, name: str, durable: bool, auto_delete: bool) -> StandinQueue:
+        if not name:
+            name = 'amq.gen-%d' % next(self._names)
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = StandinQueue(name, durable, auto_delete)
+        return queue
+
+    def delete_queue(self, queue: StandinQueue):
+        self.queues.pop(queue.name, None)
+        for exchange, bindings in self.bindings.items():
+            self.bindings[exchange] = [b for b in bindings if b[0] is not queue]
+
+    def bind(self, queue: StandinQueue, exchange: str, routing_key: str):
+        bindings = self.bindings.setdefault(exchange, [])
+        if not any(b[0] is queue and b[1] == routing_key for b in bindings):
+            bindings.append((queue, routing_key))
+
+    def route(self, exchange: str, routing_key: str) -> List[StandinQueue]:
+        if not exchange:
+            queue = self.queues.get(routing_key)
+            return [queue] if queue is not None else []
+        exchange_type = self.exchanges.get(exchange)
+        queues = []
+        for queue, binding_key in self.bindings.get(exchange, ()):
+            if exchange_type == 'fanout':
+                matched = True
+            elif exchange_type == 'topic':
+                matched = topic_matches(binding_key, routing_key)
+            else:
+                matched = binding_key == routing_key
+            if matched and queue not in queues:
+                queues.append(queue)
+        return queues
+
+    def enqueue(self, queue: StandinQueue, message: StandinMessage, front: bool = False):
+        if front:
+            queue.messages.appendleft(message)
+        else:
+            queue.messages.append(message)
+        self.schedule(queue)
+
+    def publish(self, exchange: str, routing_key: str, properties: pika.BasicProperties, body: bytes) -> bool:
+        self.stats['published'] += 1
+        queues = self.route(exchange, routing_key)
+        if not queues:
+            self.stats['unroutable'] += 1
+            return False
+        self.stats['routed'] += 1
+        message = StandinMessage(exchange, routing_key, properties, body)
+        for queue in queues:
+            self.enqueue(queue, message if len(queues) == 1 else StandinMessage(exchange, routing_key, properties, body))
+        return True
+
+    def schedule(self, queue: StandinQueue):
+        if not queue.pumping and queue.consumers and queue.messages:
+            queue.pumping = True
+            IOLoop.current().add_callback(self._pump, queue)
+
+    def _pump(self, queue: StandinQueue):
+        queue.pumping = False
+        messages = queue.messages
+        consumers = queue.consumers
+        budget = PUMP_BATCH
+        while messages and consumers:
+            if not budget:
+                # yields to the ioloop between batches like a socket read
+                self.schedule(queue)
+                return
+            budget -= 1
+            consumer = None
+            for i in range(len(consumers)):
+                candidate = consumers[(queue.cursor + i) % len(consumers)]
+                if candidate.has_capacity() and candidate.channel.is_open:
+                    consumer = candidate
+                    queue.cursor = (queue.cursor + i + 1) % len(consumers)
+                    break
+            if consumer is None:
+                return
+            message = messages.popleft()
+            self.stats['delivered'] += 1
+            consumer.channel._deliver(consumer, message)
+
+class StandinIOLoop(object):
+    """The ioloop of a stand-in connection, stopping it does not stop the
+    hosting ioloop shared with the code under test
+    """
+
+    def __init__(self):
+        self._ioloop = IOLoop.current()
+        self.stopped = False
+
+    def add_callback(self, callback, *args, **kwargs):
+        return self._ioloop.add_callback(callback, *args, **kwargs)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self._ioloop.call_later(delay, callback, *args, **kwargs)
+
+    def remove_timeout(self, timeout):
+        return self._ioloop.remove_timeout(timeout)
+
+    def time(self):
+        return self._ioloop.time()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+class StandinChannel(object):
+
+    def __init__(self, connection: 'StandinConnection', channel_number: int):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self.is_closed = False
+        self.is_closing = False
+        self.prefetch_count = 0
+        self.consumers: Dict[str, StandinConsumer] = {}
+        self._delivery_tag = 0
+        self._unacked: OrderedDict = OrderedDict()
+        self._close_callbacks = []
+        self._cancel_callbacks = []
+        self._return_callbacks = []
+        self._confirm_callback = None
+        self._publish_seq = 0
+        self._confirmed_seq = 0
+        self._returns = []
+        self._confirm_scheduled = False
+
+    def __int__(self):
+        return self.channel_number
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            self.connection.ioloop.add_callback(callback, pika.frame.Method(self.channel_number, method))
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._cancel_callbacks.append(callback)
+
+    def add_on_return_callback(self, callback):
+        self._return_callbacks.append(callback)
+
+    def confirm_delivery(self, ack_nack_callback, callback=None):
+        self._confirm_callback = ack_nack_callback
+        self._reply(callback, pika.spec.Confirm.SelectOk())
+
+    def exchange_declare(self, exchange, exchange_type='direct', passive=False, durable=False, auto_delete=False, internal=False, arguments=None, callback=None):
+        self.broker.exchanges.setdefault(exchange, str(exchange_type))
+        self._reply(callback, pika.spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False, auto_delete=False, arguments=None, callback=None):
+        declared = self.broker.declare_queue(queue, durable, auto_delete or exclusive)
+        self._reply(callback, pika.spec.Queue.DeclareOk(declared.name, len(declared.messages), len(declared.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None, callback=None):
+        self.broker.bind(self.broker.declare_queue(queue, False, False), exchange, routing_key or '')
+        self._reply(callback, pika.spec.Queue.BindOk())
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False, callback=None):
+        self.prefetch_count = prefetch_count
+        self._reply(callback, pika.spec.Basic.QosOk())
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False, consumer_tag=None, arguments=None, callback=None):
+        amqp_queue = self.broker.queues.get(queue)
+        if amqp_queue is None:
+            raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND - no queue '%s'" % queue)
+        consumer_tag = consumer_tag or 'ctag%d.%d' % (self.channel_number, next(self.broker._names))
+        consumer = StandinConsumer(consumer_tag, self, amqp_queue, on_message_callback, auto_ack, self.prefetch_count)
+        self.consumers[consumer_tag] = consumer
+        amqp_queue.consumers.append(consumer)
+        self._reply(callback, pika.spec.Basic.ConsumeOk(consumer_tag))
+        self.broker.schedule(amqp_queue)
+        return consumer_tag
+
+    def _remove_consumer(self, consumer: StandinConsumer):
+        queue = consumer.queue
+        if consumer in queue.consumers:
+            queue.consumers.remove(consumer)
+        if queue.auto_delete and not queue.consumers:
+            self.broker.delete_queue(queue)
+
+    def basic_cancel(self, consumer_tag='', callback=None):
+        consumer = self.consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self._remove_consumer(consumer)
+        self._reply(callback, pika.spec.Basic.CancelOk(consumer_tag))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError('Channel is closed.')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if exchange and exchange not in self.broker.exchanges:
+            self.connection.ioloop.add_callback(self._close_by_broker, 404, "NOT_FOUND - no exchange '%s'" % exchange)
+            return
+        routed = self.broker.publish(exchange, routing_key, properties or pika.BasicProperties(), body)
+        if not routed and mandatory and self._return_callbacks:
+            self._returns.append((pika.spec.Basic.Return(312, 'NO_ROUTE', exchange, routing_key), properties, body))
+        if self._confirm_callback is not None:
+            self._publish_seq += 1
+            if not self._confirm_scheduled:
+                self._confirm_scheduled = True
+                self.connection.ioloop.add_callback(self._confirm)
+        elif self._returns and not self._confirm_scheduled:
+            self._confirm_scheduled = True
+            self.connection.ioloop.add_callback(self._confirm)
+
+    def _confirm(self):
+        # returns were sent before the acks of the same messages
+        self._confirm_scheduled = False
+        if not self.is_open:
+            return
+        returns, self._returns = self._returns, []
+        for method, properties, body in returns:
+            for callback in self._return_callbacks:
+                callback(self, method, properties, body)
+        if self._confirm_callback is not None and self._publish_seq > self._confirmed_seq:
+            self._confirmed_seq = self._publish_seq
+            self._confirm_callback(pika.frame.Method(self.channel_number, pika.spec.Basic.Ack(self._publish_seq, True)))
+
+    def _deliver(self, consumer: StandinConsumer, message: StandinMessage):
+        self._delivery_tag += 1
+        tag = self._delivery_tag
+        if not consumer.auto_ack:
+            consumer.unacked += 1
+            self._unacked[tag] = (consumer, message)
+        method = pika.spec.Basic.Deliver(consumer.tag, tag, message.redelivered, message.exchange, message.routing_key)
+        consumer.callback(self, method, message.properties, message.body)
+
+    def _settle(self, delivery_tag, multiple, requeue=None):
+        if multiple:
+            tags = [t for t in self._unacked if t <= delivery_tag] if delivery_tag else list(self._unacked)
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+        stats = self.broker.stats
+        queues = set()
+        for tag in tags:
+            consumer, message = self._unacked.pop(tag)
+            consumer.unacked -= 1
+            queues.add(consumer.queue)
+            if requeue is None:
+                stats['acked'] += 1
+            else:
+                stats['nacked'] += 1
+                if requeue:
+                    stats['requeued'] += 1
+                    message.redelivered = True
+                    self.broker.enqueue(consumer.queue, message, front=True)
+        for queue in queues:
+            self.broker.schedule(queue)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._settle(delivery_tag, multiple, requeue)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._settle(delivery_tag, False, requeue)
+
+    def _close_by_broker(self, reply_code, reply_text):
+        self._close(pika.exceptions.ChannelClosedByBroker(reply_code, reply_text))
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self.is_open:
+            self.is_closing = True
+            self.connection.ioloop.add_callback(self._close, pika.exceptions.ChannelClosedByClient(reply_code, reply_text))
+
+    def _close(self, reason):
+        if self.is_closed:
+            return
+        self.is_open = False
+        self.is_closing = False
+        self.is_closed = True
+        for consumer in list(self.consumers.values()):
+            self._remove_consumer(consumer)
+        self.consumers = {}
+        # the unacked messages were requeued as redelivered
+        for consumer, message in reversed(list(self._unacked.values())):
+            message.redelivered = True
+            self.broker.stats['requeued'] += 1
+            self.broker.enqueue(consumer.queue, message, front=True)
+        self._unacked.clear()
+        self.connection._channels.pop(self.channel_number, None)
+        for callback in self._close_callbacks:
+            callback(self, reason)
+
+class StandinConnection(object):
+    """Stand-in of pika.adapters.tornado_connection.TornadoConnection
+    """
+
+    def __init__(self, parameters=None, on_open_callback=None, on_open_error_callback=None, on_close_callback=None, custom_ioloop=None, internal_connection_workflow=True):
+        self.parameters = parameters
+        self.broker = StandinBroker.of(parameters.virtual_host if parameters is not None else '/')
+        self.ioloop = StandinIOLoop()
+        self.is_open = False
+        self.is_closing = False
+        self.is_closed = False
+        self._channels: Dict[int, StandinChannel] = {}
+        self._channel_numbers = itertools.count(1)
+        self._on_close_callback = on_close_callback
+        self.ioloop.add_callback(self._open, on_open_callback)
+
+    def _open(self, on_open_callback):
+        self.is_open = True
+        if on_open_callback is not None:
+            on_open_callback(self)
+
+    def channel(self, channel_number=None, on_open_callback=None) -> StandinChannel:
+        channel = StandinChannel(self, channel_number or next(self._channel_numbers))
+        self._channels[channel.channel_number] = channel
+        if on_open_callback is not None:
+            self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self.is_closed or self.is_closing:
+            return
+        self.is_closing = True
+        self.ioloop.add_callback(self._close, pika.exceptions.ConnectionClosedByClient(reply_code, reply_text))
+
+    def drop(self):
+        """Simulates a connection lost, the channels were closed by the broker"""
+        self._close(pika.exceptions.StreamLostError('Stream connection lost'))
+
+    def _close(self, reason):
+        if self.is_closed:
+            return
+        for channel in list(self._channels.values()):
+            channel._close(reason)
+        self.is_open = False
+        self.is_closing = False
+        self.is_closed = True
+        if self._on_close_callback is not None:
+            self._on_close_callback(self, reason)
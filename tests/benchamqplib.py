@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks amqplib publish throughput, consume throughput, rpc round trip
+percentiles and memory growth under a sustained backlog, against the in-process
+broker stand-in by default or against a live broker when its host were given
+
+    python -m tests.benchamqplib [messages] [host]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tracemalloc
+from hawthorn.amqplib import RabbitMQWorker
+from tests.amqpstandin import StandinConnection
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+async def wait_for(predicate, timeout=60.0, interval=0.005):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(interval)
+
+async def start_worker(host):
+    if host:
+        worker = RabbitMQWorker(host=host)
+    else:
+        worker = RabbitMQWorker(connection_class=StandinConnection)
+    worker.set_using_outside_ioloop(True)
+    return worker
+
+async def bench_publish(worker, messages):
+    worker.initialize_publisher('ex.bench', 'direct', 'publish', 'bench.publish', False)
+    await asyncio.sleep(0.2)
+    base = worker.publish_stats()['published']
+    body = b'x' * 256
+    started = time.perf_counter()
+    for _ in range(messages):
+        await worker.publish_async('ex.bench', 'publish', body)
+    await wait_for(lambda: worker.publish_stats()['published'] - base >= messages)
+    elapsed = time.perf_counter() - started
+    print('publish  messages:%7d  %9.1f msg/s' % (messages, messages / elapsed))
+
+async def bench_consume(worker, messages):
+    received = [0]
+
+    def on_message(ch, basic_deliver, properties, body):
+        received[0] += 1
+
+    # the queue were declared and filled by the publisher before consuming,
+    # the consumer registers the same queue by another binding key
+    worker.initialize_publisher('ex.bench', 'direct', 'consume', 'bench.consume', False)
+    await asyncio.sleep(0.2)
+    base = worker.publish_stats()['published']
+    for _ in range(messages):
+        await worker.publish_async('ex.bench', 'consume', b'x' * 256)
+    await wait_for(lambda: worker.publish_stats()['published'] - base >= messages)
+    started = time.perf_counter()
+    worker.consume('ex.bench', 'direct', 'consume.all', 'bench.consume', False, on_message, prefetch_count=500)
+    await wait_for(lambda: received[0] >= messages)
+    elapsed = time.perf_counter() - started
+    print('consume  messages:%7d  %9.1f msg/s' % (messages, messages / elapsed))
+
+async def bench_rpc(worker, queries, concurrency=16):
+    def on_query(ch, basic_deliver, properties, body):
+        return body
+
+    worker.consume('ex.bench', 'direct', 'rpc', 'bench.rpc', False, on_query, prefetch_count=100)
+    await asyncio.sleep(0.2)
+    latencies = []
+    remaining = [queries]
+
+    async def client():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            await worker.query('ex.bench', 'rpc', b'ping', timeout=10)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    print('rpc      queries:%8d  %9.1f rtt/s  p50:%7.2fms  p95:%7.2fms  p99:%7.2fms' % (
+        queries, queries / elapsed, percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.95) * 1e3, percentile(latencies, 0.99) * 1e3))
+
+async def bench_backlog(worker, seconds=5.0, handling=0.001):
+    """Publishes faster than a slow consumer handles, memory allocated by
+    hawthorn should level off by the bounded publishing queue and prefetch
+    """
+    handled = [0]
+
+    async def on_message(ch, basic_deliver, properties, body):
+        await asyncio.sleep(handling)
+        handled[0] += 1
+
+    worker.consume('ex.bench', 'direct', 'backlog', 'bench.backlog', False, on_message, prefetch_count=50)
+    await asyncio.sleep(0.2)
+    hawthorn_only = [tracemalloc.Filter(True, '*hawthorn*')]
+    tracemalloc.start()
+    body = b'x' * 1024
+    started = time.monotonic()
+    next_sample = started
+    baseline = None
+    published = 0
+    while time.monotonic() - started < seconds:
+        for _ in range(100):
+            await worker.publish_async('ex.bench', 'backlog', body)
+            published += 1
+        await asyncio.sleep(0)
+        if time.monotonic() >= next_sample:
+            next_sample += 1.0
+            current = sum(stat.size for stat in tracemalloc.take_snapshot().filter_traces(hawthorn_only).statistics('filename'))
+            if baseline is None:
+                baseline = current
+            print('backlog  t:%4.1fs  published:%8d  handled:%7d  queued:%6d  hawthorn memory:%8.1fKB  growth:%8.1fKB' % (
+                time.monotonic() - started, published, handled[0], worker.publish_stats()['queued'], current / 1024.0, (current - baseline) / 1024.0))
+    tracemalloc.stop()
+
+async def main(messages=20000, host=None):
+    worker = await start_worker(host)
+    worker.run()
+    await asyncio.sleep(0.2)
+    await bench_publish(worker, messages)
+    await bench_consume(worker, messages)
+    await bench_rpc(worker, max(100, messages // 10))
+    await bench_backlog(worker)
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, sys.argv[2] if len(sys.argv) > 2 else None))
+    # the worker keeps its connection open
+    os._exit(0)
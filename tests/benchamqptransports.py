@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks messages/s and per-message latency of the pika TornadoConnection
+transport and the asyncio-native aio_pika transport against a local broker
+
+    python -m tests.benchamqptransports [messages] [host]
+"""
+
+import os
+import sys
+import time
+import asyncio
+from hawthorn.amqplib import RabbitMQWorker
+from hawthorn.aioamqplib import AioRabbitMQWorker, aio_pika
+
+EXCHANGE = 'ex.bench'
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def report(name, messages, elapsed, latencies):
+    print('%-8s messages:%7d  %9.1f msg/s  latency p50:%7.2fms  p99:%7.2fms  max:%7.2fms' % (
+        name, messages, messages / elapsed if elapsed else 0.0,
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3, max(latencies or [0.0]) * 1e3))
+
+class Receiver(object):
+    """Collects the latencies from the send time carried by the message body
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.done = asyncio.Event()
+
+    def on_message(self, ch, basic_deliver, properties, body):
+        self.latencies.append(time.perf_counter() - float(body))
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+async def bench_pika(messages, host):
+    worker = RabbitMQWorker(host=host)
+    worker.set_using_outside_ioloop(True)
+    queue = 'bench.pika'
+    warmup = Receiver(1)
+    receiver = Receiver(messages)
+    current = [warmup]
+    worker.consume(EXCHANGE, 'direct', queue, queue, False, lambda *args: current[0].on_message(*args), prefetch_count=200)
+    worker.run()
+    worker.publish(EXCHANGE, queue, b'%f' % time.perf_counter())
+    await warmup.done.wait()
+    current[0] = receiver
+    started = time.perf_counter()
+    for _ in range(messages):
+        await worker.publish_async(EXCHANGE, queue, b'%f' % time.perf_counter())
+    await receiver.done.wait()
+    report('pika', messages, time.perf_counter() - started, receiver.latencies)
+
+async def bench_aio(messages, host):
+    worker = AioRabbitMQWorker(host=host, publisher_confirms=False)
+    queue = 'bench.aio'
+    warmup = Receiver(1)
+    receiver = Receiver(messages)
+    current = [warmup]
+    worker.consume(EXCHANGE, 'direct', queue, queue, False, lambda *args: current[0].on_message(*args), prefetch_count=200)
+    await worker.connect()
+    await worker.publish(EXCHANGE, queue, b'%f' % time.perf_counter())
+    await warmup.done.wait()
+    current[0] = receiver
+    started = time.perf_counter()
+    for _ in range(messages):
+        await worker.publish(EXCHANGE, queue, b'%f' % time.perf_counter())
+    await receiver.done.wait()
+    report('aio_pika', messages, time.perf_counter() - started, receiver.latencies)
+    await worker.close()
+
+async def main(messages=20000, host='127.0.0.1'):
+    await bench_pika(messages, host)
+    if aio_pika is None:
+        print('aio_pika were not installed, skipped the asyncio-native transport')
+    else:
+        await bench_aio(messages, host)
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'))
+    # the pika worker keeps its connection open
+    os._exit(0)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks encoding and decoding CPU time and memory footprint of cache codecs
+
+    python -m tests.benchcachecodecs [rounds]
+"""
+
+import sys
+import time
+import tracemalloc
+from hawthorn.cacher.codecs import CacheCodec, MsgpackCodec, SchemaCodec, msgpack
+from hawthorn.utilities.compression import is_compression_supported
+
+def make_object(width=40):
+    obj = {'id': 123456, 'code': 'C-000123', 'name': 'example object name', 'created_at': 1690000000000, 'obsoleted': 0}
+    for i in range(width):
+        obj['field_%02d' % i] = ('value text %d ' % i) * (1 + i % 5) if i % 3 else i * 1.5
+    return obj
+
+def hash_fields_size(obj):
+    # approximate payload of the one hash field per object field layout
+    return sum(len(str(k)) + len('' if v is None else str(v)) for k, v in obj.items())
+
+def bench_codec(name, codec, obj, rounds):
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        encoded = codec.encode(obj)
+    t2 = time.perf_counter()
+    for _ in range(rounds):
+        codec.decode(encoded)
+    t3 = time.perf_counter()
+    tracemalloc.start()
+    values = [codec.encode(obj) for _ in range(1000)]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del values
+    print('%-18s size:%6dB  encode:%7.2fus  decode:%7.2fus  1k values peak:%8.1fKB' % (
+        name, len(encoded), (t2 - t1) * 1e6 / rounds, (t3 - t2) * 1e6 / rounds, peak / 1024.0))
+
+def bench_hash_fields(obj, rounds):
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        mapping = {k: ('' if v is None else v) for k, v in obj.items()}
+    t2 = time.perf_counter()
+    fields = {k.encode(): str(v).encode() for k, v in mapping.items()}
+    for _ in range(rounds):
+        {k.decode(): v.decode() for k, v in fields.items()}
+    t3 = time.perf_counter()
+    print('%-18s size:%6dB  encode:%7.2fus  decode:%7.2fus  fields:%d' % (
+        'hash-fields', hash_fields_size(obj), (t2 - t1) * 1e6 / rounds, (t3 - t2) * 1e6 / rounds, len(obj)))
+
+def main(rounds=20000):
+    obj = make_object()
+    columns = list(obj.keys())
+    bench_hash_fields(obj, rounds)
+    codecs = [('json', CacheCodec()), ('json+zlib', CacheCodec(compression='zlib', compress_threshold=256))]
+    if msgpack is not None:
+        codecs.append(('msgpack', MsgpackCodec()))
+    codecs.append(('schema', SchemaCodec(columns)))
+    if is_compression_supported('zstd'):
+        codecs.append(('schema+zstd', SchemaCodec(columns, compression='zstd', compress_threshold=256)))
+    for name, codec in codecs:
+        bench_codec(name, codec, obj, rounds)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks per call overhead of native coroutines of CacheProxy against the
+tornado.gen.coroutine generator wrappers it used before, on a memory backend
+so that only the coroutine machinery were measured, and FileCache round trips
+
+    python -m tests.benchcacheproxy [rounds]
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import tornado.gen
+from hawthorn.cacheproxy import CacheProxy
+from hawthorn.cacher.filecache import FileCache
+
+class MemoryBackend(object):
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def hmget(self, key, fields):
+        values = self.data.get(key) or {}
+        return [values.get(f) for f in fields]
+
+class GeneratorBackend(object):
+    def __init__(self):
+        self.data = {}
+
+    @tornado.gen.coroutine
+    def get(self, key):
+        return self.data.get(key)
+
+    @tornado.gen.coroutine
+    def hmget(self, key, fields):
+        values = self.data.get(key) or {}
+        return [values.get(f) for f in fields]
+
+class GeneratorProxy(object):
+    """Mirrors the previous generator based CacheProxy.get and get_object"""
+    def __init__(self, cache_inst):
+        self.cache_inst = cache_inst
+
+    @tornado.gen.coroutine
+    def resolve_key(self, key):
+        return key
+
+    @tornado.gen.coroutine
+    def get(self, key):
+        key = yield self.resolve_key(key)
+        val = yield self.cache_inst.get(key)
+        return val
+
+    @tornado.gen.coroutine
+    def get_object(self, key, keys):
+        key = yield self.resolve_key(key)
+        res = yield self.cache_inst.hmget(key, keys)
+        return dict(zip(keys, res))
+
+async def bench(name, proxy, rounds):
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        await proxy.get('bench:key')
+    t2 = time.perf_counter()
+    for _ in range(rounds):
+        await proxy.get_object('bench:obj', ['id', 'name'])
+    t3 = time.perf_counter()
+    print('%-28s get %8.2fus/call  get_object %8.2fus/call' % (name, (t2 - t1) * 1e6 / rounds, (t3 - t2) * 1e6 / rounds))
+
+async def bench_filecache(rounds):
+    cache_dir = tempfile.mkdtemp()
+    proxy = CacheProxy()
+    proxy.cache_inst = FileCache(os.path.join(cache_dir, 'cache.db'))
+    try:
+        await proxy.set_object('bench:obj', {'id': 1, 'name': 'bench'})
+        await bench('native filecache (executor)', proxy, rounds)
+        items = [('bench:obj:%d' % i, {'id': i, 'name': 'bench'}) for i in range(rounds)]
+        t1 = time.perf_counter()
+        await proxy.set_objects(items)
+        t2 = time.perf_counter()
+        print('%-28s set_objects %8.2fus/object' % ('native filecache pipeline', (t2 - t1) * 1e6 / rounds))
+    finally:
+        proxy.cache_inst.close()
+        proxy.cache_inst = None
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+async def main(rounds):
+    native = CacheProxy()
+    native.cache_inst = MemoryBackend()
+    generator = GeneratorProxy(GeneratorBackend())
+    for proxy in (native, generator):
+        proxy.cache_inst.data['bench:key'] = b'value'
+        proxy.cache_inst.data['bench:obj'] = {'id': b'1', 'name': b'bench'}
+    await bench('tornado.gen.coroutine', generator, rounds)
+    await bench('native async def', native, rounds)
+    native.cache_inst = None
+    await bench_filecache(min(rounds, 2000))
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import unittest
+from hawthorn.amqplib import PublishNacked
+from hawthorn.aioamqplib import aio_pika, AioRabbitMQWorker, AioRabbitMQFactory, AioWorkerDelegate, AioChannelAdapter
+
+class FakeChannel(object):
+    is_closed = False
+
+class FakeIncomingMessage(object):
+    """Records the settlements of an incoming message the way aio_pika settles
+    by coroutines
+    """
+    def __init__(self, delivery_tag, settlements):
+        self.delivery_tag = delivery_tag
+        self.consumer_tag = 'ctag'
+        self.exchange = 'ex.test'
+        self.routing_key = 'test'
+        self.body = b'message'
+        self.reply_to = None
+        self.correlation_id = None
+        self.settlements = settlements
+
+    async def ack(self, multiple=False):
+        self.settlements.append(('ack', self.delivery_tag, multiple))
+
+    async def nack(self, multiple=False, requeue=True):
+        self.settlements.append(('nack', self.delivery_tag, multiple, requeue))
+
+    async def reject(self, requeue=True):
+        self.settlements.append(('reject', self.delivery_tag, requeue))
+
+class FailingWorker(AioRabbitMQWorker):
+    """Fails the publishing by the routing key without connecting
+    """
+    async def publish(self, exchange, routing_key, message, properties=None, mandatory=False):
+        if routing_key == 'nacked':
+            self._publish_stats['nacked'] += 1
+            raise PublishNacked('nacked')
+        raise ConnectionError('disconnected')
+
+    async def close(self):
+        self.closed = True
+
+@unittest.skipIf(aio_pika is None, 'aio_pika is not installed')
+class TestAioAmqplib(unittest.TestCase):
+    """
+    """
+    def handle(self, callback, auto_ack, messages=1):
+        settlements = []
+
+        async def run():
+            worker = AioRabbitMQWorker()
+            spec = AioWorkerDelegate('ex.test', 'direct', 'test', 'test.queue', False, False, callback, auto_ack=auto_ack)
+            adapter = AioChannelAdapter(FakeChannel())
+            await asyncio.gather(*[worker._handle(spec, adapter, FakeIncomingMessage(tag, settlements), asyncio.Semaphore(messages))
+                                   for tag in range(1, messages + 1)])
+            await asyncio.sleep(0)
+            return spec
+        spec = asyncio.run(run())
+        return spec, settlements
+
+    def testCallbackAcksByChannel(self):
+        def on_message(ch, basic_deliver, properties, body):
+            self.assertTrue(ch.is_open)
+            ch.basic_ack(basic_deliver.delivery_tag)
+
+        spec, settlements = self.handle(on_message, auto_ack=False)
+        self.assertEqual(settlements, [('ack', 1, False)])
+        self.assertEqual((spec.processed, spec.failed), (1, 0))
+
+    def testAutoAckOnceAfterCallbackSettled(self):
+        def on_message(ch, basic_deliver, properties, body):
+            if basic_deliver.delivery_tag == 1:
+                ch.basic_nack(basic_deliver.delivery_tag, requeue=False)
+
+        spec, settlements = self.handle(on_message, auto_ack=True, messages=2)
+        self.assertEqual(sorted(settlements), [('ack', 2, False), ('nack', 1, False, False)])
+
+    def testSettleMultiple(self):
+        settlements = []
+
+        async def run():
+            adapter = AioChannelAdapter(FakeChannel())
+            for tag in range(1, 4):
+                adapter.hold(FakeIncomingMessage(tag, settlements))
+            adapter.basic_ack(2, multiple=True)
+            adapter.basic_reject(2)
+            await asyncio.sleep(0)
+            return [adapter.release(FakeIncomingMessage(tag, settlements)) for tag in range(1, 4)]
+
+        self.assertEqual(asyncio.run(run()), [False, False, True])
+        self.assertEqual(settlements, [('ack', 2, True)])
+
+    def testUnawaitedPublishFailuresRecorded(self):
+        factory = AioRabbitMQFactory()
+        worker = FailingWorker(virtual_host='testing')
+        factory._instances['testing'] = worker
+
+        async def run():
+            published = [factory.publish('testing', 'ex.test', key, b'message') for key in ['nacked', 'test']]
+            await asyncio.sleep(0.01)
+            stopping = factory.stop()
+            await stopping
+            return published
+
+        try:
+            with self.assertLogs('components.aioamqplib', 'ERROR') as logs:
+                self.assertEqual(asyncio.run(run()), [True, True])
+        finally:
+            factory._instances.pop('testing', None)
+        self.assertEqual(len(logs.records), 2)
+        stats = worker.publish_stats()
+        self.assertEqual((stats['nacked'], stats['failed']), (1, 1))
+        self.assertTrue(worker.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from hawthorn.amqpcodecs import MessageCodecs, CodecStats, CONTENT_TYPE_JSON
+
+class TestAmqpCodecs(unittest.TestCase):
+    """
+    """
+    def testObjectsRoundTrip(self):
+        codecs = MessageCodecs(compression='zlib', compress_threshold=64)
+        message = {'id': 1, 'text': 'x' * 256}
+        body, content_type, content_encoding = codecs.encode(message)
+        self.assertEqual((content_type, content_encoding), (CONTENT_TYPE_JSON, 'zlib'))
+        self.assertLess(len(body), 128)
+        self.assertEqual(codecs.decode(body, content_type, content_encoding, deserialize=True), message)
+        # callbacks without deserializing got the decompressed bytes
+        self.assertEqual(codecs.decode(body, content_type, content_encoding), b'{"id":1,"text":"' + b'x' * 256 + b'"}')
+
+    def testPayloadsKeptAsTheyWere(self):
+        codecs = MessageCodecs(compression='zlib', compress_threshold=4)
+        self.assertEqual(codecs.encode('short text', content_encoding='br'), (b'short text', None, None))
+        self.assertEqual(MessageCodecs().encode(b'raw'), (b'raw', None, None))
+        self.assertEqual(codecs.decode(b'raw', 'application/octet-stream', None, deserialize=True), b'raw')
+
+    def testStats(self):
+        codecs = MessageCodecs(compression='gzip', compress_threshold=16)
+        stats = CodecStats()
+        body, _, encoding = codecs.encode(b'a' * 1000, stats=stats)
+        codecs.decode(body, None, encoding, stats=stats)
+        result = stats.stats()
+        self.assertEqual((result['messages'], result['compressed'], result['plain_bytes']), (2, 2, 2000))
+        self.assertLess(result['compression_ratio'], 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import threading
+import unittest
+from hawthorn.amqplib import RabbitMQWorker, PublishReturned, EXECUTION_MODE
+from tests.amqpstandin import StandinConnection, StandinBroker
+
+def reply_pid(ch, basic_deliver, properties, body):
+    # runs in the process pool, so it were picklable by module level
+    return b'%d' % os.getpid()
+
+class TestAmqplib(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        StandinBroker.reset()
+
+    def run_worker(self, scenario):
+        async def run():
+            worker = RabbitMQWorker(connection_class=StandinConnection)
+            worker.set_using_outside_ioloop(True)
+            try:
+                await scenario(worker)
+            finally:
+                worker.stop()
+        asyncio.run(run())
+
+    def testConsumeAndQuery(self):
+        received = []
+
+        def on_message(ch, basic_deliver, properties, body):
+            received.append(body)
+            return b'reply:' + body
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'topic', 'test.*', 'test.queue', False, on_message)
+            worker.run()
+            await asyncio.sleep(0.05)
+            worker.publish('ex.test', 'test.publish', b'message')
+            response = await worker.query('ex.test', 'test.query', b'query', timeout=2)
+            self.assertEqual(response.body, b'reply:query')
+            self.assertEqual(received, [b'message', b'query'])
+        self.run_worker(scenario)
+
+    def testConsumeBatch(self):
+        batches = []
+
+        def on_batch(ch, messages):
+            batches.append([message.body for message in messages])
+            return [0]
+
+        async def scenario(worker):
+            worker.consume_batch('ex.test', 'direct', 'batch', 'test.batch', False, on_batch, max_batch=5, max_wait_ms=20, requeue_failed=False)
+            worker.run()
+            await asyncio.sleep(0.05)
+            for i in range(7):
+                worker.publish('ex.test', 'batch', b'%d' % i)
+            await asyncio.sleep(0.2)
+            self.assertEqual(batches, [[b'0', b'1', b'2', b'3', b'4'], [b'5', b'6']])
+            stats = StandinBroker.of('/').stats
+            self.assertEqual((stats['acked'], stats['nacked']), (5, 2))
+        self.run_worker(scenario)
+
+    def testPublishConfirmed(self):
+        async def scenario(worker):
+            worker.initialize_publisher('ex.test', 'direct', 'confirm', 'test.confirm', False)
+            worker.run()
+            await asyncio.sleep(0.05)
+            self.assertTrue(await worker.publish_confirmed('ex.test', 'confirm', b'message', timeout=2))
+            with self.assertRaises(PublishReturned):
+                await worker.publish_confirmed('ex.test', 'unbound', b'message', timeout=2)
+        self.run_worker(scenario)
+
+    def testAcknowledgeOnConsumerChannel(self):
+        deliveries = []
+
+        def on_message(ch, basic_deliver, properties, body):
+            deliveries.append(basic_deliver)
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'manual', 'test.manual', False, on_message, auto_ack=False)
+            worker.run()
+            await asyncio.sleep(0.05)
+            worker.publish('ex.test', 'manual', b'message')
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(deliveries), 1)
+            worker.acknowledge_message(deliveries[0].delivery_tag, deliveries[0].consumer_tag)
+            await asyncio.sleep(0.01)
+            self.assertEqual(StandinBroker.of('/').stats['acked'], 1)
+        self.run_worker(scenario)
+
+    def testQueryTimeoutAndLateReply(self):
+        async def on_query(ch, basic_deliver, properties, body):
+            await asyncio.sleep(0.3)
+            return b'reply:' + body
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'slow', 'test.slow', False, on_query)
+            worker.run()
+            await asyncio.sleep(0.05)
+            with self.assertRaises(asyncio.TimeoutError):
+                await worker.query('ex.test', 'slow', b'query', timeout=0.1)
+            self.assertEqual(worker.rpc_stats()['pending'], 0)
+            await asyncio.sleep(0.4)
+            stats = worker.rpc_stats()
+            self.assertEqual((stats['timeouts'], stats['late_replies'], stats['replies']), (1, 1, 0))
+            self.assertEqual(stats['timers'], 0)
+        self.run_worker(scenario)
+
+    def testQueryCancelled(self):
+        async def on_query(ch, basic_deliver, properties, body):
+            await asyncio.sleep(0.1)
+            return b'reply:' + body
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'cancel', 'test.cancel', False, on_query)
+            worker.run()
+            await asyncio.sleep(0.05)
+            future = worker.query('ex.test', 'cancel', b'query', timeout=2)
+            await asyncio.sleep(0.01)
+            self.assertEqual(worker.rpc_stats()['pending'], 1)
+            future.cancel()
+            await asyncio.sleep(0)
+            stats = worker.rpc_stats()
+            # the cancelled rpc were forgotten together with its timer
+            self.assertEqual((stats['pending'], stats['timers'], stats['cancelled']), (0, 0, 1))
+            await asyncio.sleep(0.2)
+            stats = worker.rpc_stats()
+            self.assertEqual((stats['late_replies'], stats['timeouts']), (1, 0))
+            response = await worker.query('ex.test', 'cancel', b'again', timeout=2)
+            self.assertEqual(response.body, b'reply:again')
+        self.run_worker(scenario)
+
+    def testDrain(self):
+        handled = []
+
+        async def on_message(ch, basic_deliver, properties, body):
+            await asyncio.sleep(0.1)
+            handled.append(body)
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'drain', 'test.drain', False, on_message)
+            worker.run()
+            await asyncio.sleep(0.05)
+            for i in range(3):
+                worker.publish('ex.test', 'drain', b'%d' % i)
+            await asyncio.sleep(0.05)
+            self.assertTrue(await worker.drain(timeout=1))
+            self.assertEqual(sorted(handled), [b'0', b'1', b'2'])
+            self.assertEqual(StandinBroker.of('/').stats['acked'], 3)
+            # the consumer were cancelled, later messages stay in the queue
+            worker.publish('ex.test', 'drain', b'3')
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(handled), 3)
+        self.run_worker(scenario)
+
+    def testStopAfterDraining(self):
+        handled = []
+
+        async def on_message(ch, basic_deliver, properties, body):
+            await asyncio.sleep(0.1)
+            handled.append(body)
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'stopping', 'test.stopping', False, on_message)
+            worker.run()
+            await asyncio.sleep(0.05)
+            worker.publish('ex.test', 'stopping', b'message')
+            await asyncio.sleep(0.02)
+            worker.stop(drain_timeout=1)
+            self.assertEqual(handled, [])
+            await asyncio.sleep(0.2)
+            # the message in process were finished and acked before closing
+            self.assertEqual(handled, [b'message'])
+            self.assertEqual(StandinBroker.of('/').stats['acked'], 1)
+            self.assertTrue(worker._connection.is_closed)
+        self.run_worker(scenario)
+
+    def testPooledExecutionModes(self):
+        threads = []
+
+        def on_message(ch, basic_deliver, properties, body):
+            threads.append(threading.current_thread())
+            return b'reply:' + body
+
+        async def scenario(worker):
+            worker.consume('ex.test', 'direct', 'thread', 'test.thread', False, on_message, execution_mode=EXECUTION_MODE.THREAD, pool_size=2)
+            worker.consume('ex.test', 'direct', 'process', 'test.process', False, reply_pid, execution_mode=EXECUTION_MODE.PROCESS, pool_size=1)
+            worker.run()
+            await asyncio.sleep(0.05)
+            response = await worker.query('ex.test', 'thread', b'query', timeout=2)
+            self.assertEqual(response.body, b'reply:query')
+            self.assertNotIn(threading.main_thread(), threads)
+            response = await worker.query('ex.test', 'process', b'query', timeout=5)
+            self.assertNotEqual(int(response.body), os.getpid())
+            modes = worker.execution_stats()
+            self.assertEqual((modes[EXECUTION_MODE.THREAD]['count'], modes[EXECUTION_MODE.PROCESS]['count']), (1, 1))
+            with self.assertRaises(ValueError):
+                worker.consume('ex.test', 'direct', 'manual', 'test.manual', False, on_message, auto_ack=False, execution_mode=EXECUTION_MODE.THREAD)
+        self.run_worker(scenario)
+
+if __name__ == '__main__':
+    unittest.main()
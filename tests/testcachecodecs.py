@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from hawthorn.cacher.codecs import CacheCodec, SchemaCodec, create_codec
+from hawthorn.utilities.compression import is_compression_supported
+
+class TestCacheCodecs(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.mapping = {'id': 1, 'name': 'foo-bar', 'score': 1.5, 'flag': None, 'tags': ['a', 'b']}
+
+    def testJsonCodecKeepsTypes(self):
+        codec = CacheCodec()
+        self.assertEqual(codec.decode(codec.encode(self.mapping)), self.mapping)
+
+    def testSchemaCodec(self):
+        codec = SchemaCodec(['id', 'name', 'score', 'flag'])
+        decoded = codec.decode(codec.encode(self.mapping))
+        self.assertEqual(decoded, self.mapping)
+        other = SchemaCodec(['id', 'name'])
+        self.assertIsNone(other.decode(codec.encode(self.mapping)))
+
+    def testCompression(self):
+        codec = CacheCodec(compression='zlib', compress_threshold=16)
+        mapping = {'text': 'x' * 4096}
+        encoded = codec.encode(mapping)
+        self.assertLess(len(encoded), 1024)
+        self.assertEqual(codec.decode(encoded), mapping)
+        if is_compression_supported('zstd'):
+            codec = create_codec({'codec': 'json', 'compression': 'zstd', 'compress_threshold': 16})
+            self.assertEqual(codec.decode(codec.encode(mapping)), mapping)
+
+    def testUndecodableValues(self):
+        codec = CacheCodec()
+        self.assertIsNone(codec.decode(None))
+        self.assertIsNone(codec.decode(b'plain text'))
+        self.assertIsNone(create_codec('hash'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+import fakeredis
+import fakeredis.aioredis
+from hawthorn.cacheproxy import CacheProxy, LOADING_LOCK_SUFFIX
+from hawthorn.cacher.filecache import FileCache
+
+class FakeScript(object):
+    def __init__(self, script, calls):
+        self.script = script
+        self.calls = calls
+
+    async def execute(self, keys=[], args=[]):
+        self.calls.append(keys)
+        return await self.script(keys=keys, args=args)
+
+class FakeAsyncRedis(fakeredis.aioredis.FakeRedis):
+    """fakeredis running lua scripts, called like aredis
+    """
+    script_calls = None
+
+    async def pipeline(self, transaction=False):
+        return super().pipeline(transaction=transaction)
+
+    def register_script(self, script):
+        if self.script_calls is None:
+            self.script_calls = []
+        return FakeScript(super().register_script(script), self.script_calls)
+
+class LegacyHashTests(object):
+    """reading the objects cached as hash before a codec were configured,
+    shared by the backends
+    """
+    def testCodecReadsLegacyHash(self):
+        async def run():
+            # cached as hash before the codec of the prefix were configured
+            await self.cacheproxy.set_object('legacy:1', {'id': 1, 'name': 'hash'})
+            self.cacheproxy.set_codec('json', key_prefix='legacy:')
+            await self.cacheproxy.set_object('legacy:2', {'id': 2, 'name': 'encoded'})
+            return await self.cacheproxy.get_object('legacy:1', ['name']), await self.cacheproxy.get_object('legacy:2', ['name'])
+
+        self.assertEqual(asyncio.run(run()), ({'name': 'hash'}, {'name': 'encoded'}))
+
+class TestCacheProxy(LegacyHashTests, unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cacheproxy = CacheProxy()
+        self.cacheproxy.cache_inst = FileCache(os.path.join(self.cache_dir, 'cache.db'))
+
+    def tearDown(self):
+        self.cacheproxy._prefix_codecs.pop('legacy:', None)
+        self.cacheproxy.cache_inst.close()
+        self.cacheproxy.cache_inst = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def testGetOrLoadSingleFlight(self):
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {'count': len(calls)}
+
+        async def run():
+            results = await asyncio.gather(*[self.cacheproxy.get_or_load('single-flight', loader, 10) for _ in range(10)])
+            cached = await self.cacheproxy.get_or_load('single-flight', loader, 10)
+            return results, cached
+
+        results, cached = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        for res in results:
+            self.assertEqual(res, {'count': 1})
+        self.assertEqual(cached, {'count': 1})
+
+    def testGetOrLoadServesStale(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return len(calls)
+
+        async def run():
+            first = await self.cacheproxy.get_or_load('stale', loader, 0.01, stale_ttl=10, beta=0)
+            await asyncio.sleep(0.05)
+            stale = await self.cacheproxy.get_or_load('stale', loader, 10, beta=0)
+            await asyncio.sleep(0.05)
+            refreshed = await self.cacheproxy.get_or_load('stale', loader, 10, beta=0)
+            return first, stale, refreshed
+
+        self.assertEqual(asyncio.run(run()), (1, 1, 2))
+
+    def testColdMissNotJoiningRefresh(self):
+        async def failing():
+            await asyncio.sleep(0.05)
+            raise ValueError('refreshing failed')
+
+        async def run():
+            await self.cacheproxy.get_or_load('refreshing', lambda: 'stale', 0.01, stale_ttl=10, beta=0)
+            await asyncio.sleep(0.05)
+            stale = await self.cacheproxy.get_or_load('refreshing', failing, 10, beta=0)
+            # the stale value expired while refreshing
+            await self.cacheproxy.cache_inst.delete('refreshing')
+            loaded = await self.cacheproxy.get_or_load('refreshing', lambda: 'loaded', 10, beta=0)
+            return stale, loaded
+
+        with self.assertLogs('components.cacheproxy', 'WARNING'):
+            self.assertEqual(asyncio.run(run()), ('stale', 'loaded'))
+
+    def testVerifyIndexedToMany(self):
+        items = [{'id': i, 'group': 'g%d' % (i % 2), 'name': 'item %d' % i} for i in range(6)]
+
+        async def run():
+            await self.cacheproxy.add_objects_to_cache_indexed_to_many(items, 'items:', 'group', 'id')
+            await self.cacheproxy.del_from_cache_indexed_to_many(items[0], 'items:', 'group', 'id')
+            await self.cacheproxy.cache_inst.sadd('items:g0', '100')
+            await self.cacheproxy.cache_inst.srem('items:g1', '1')
+            found = await self.cacheproxy.verify_cache_indexed_to_many('items:', repair=True)
+            verified = await self.cacheproxy.verify_cache_indexed_to_many('items:')
+            rows = await self.cacheproxy.get_objects('items:g1', ['id', 'name'])
+            return found, verified, rows
+
+        found, verified, rows = asyncio.run(run())
+        self.assertEqual(found, {'dangling': {'items:g0': ['100']}, 'orphans': ['items:g1:1']})
+        self.assertEqual(verified, {'dangling': {}, 'orphans': []})
+        self.assertEqual(sorted(row['id'] for row in rows), [3, 5])
+
+    def testGenerationPointerFlip(self):
+        async def run():
+            proxy = self.cacheproxy
+            await proxy.set('generations:1', 'plain')
+            proxy.register_versioned_prefix('generations:')
+            # the plain keys were read until the first generation were committed
+            before = await proxy.get('generations:1')
+            for generation, value in (('1', 'first'), ('2', 'second'), ('3', 'third')):
+                await proxy.cache_inst.set(proxy.generation_key_prefix('generations:', generation) + '1', value)
+                await proxy.commit_generation('generations:', generation)
+                self.assertEqual(await proxy.get('generations:1'), value)
+            # the previous generation were kept for in flight readers, the older collected
+            collected = await proxy.cache_inst.exists(proxy.generation_key_prefix('generations:', '1') + '1')
+            kept = await proxy.cache_inst.exists(proxy.generation_key_prefix('generations:', '2') + '1')
+            plain_kept = await proxy.cache_inst.get('generations:1')
+            await proxy.clear_unversioned_keys('generations:')
+            plain_cleared = await proxy.cache_inst.exists('generations:1')
+            return before, collected, kept, plain_kept, plain_cleared, await proxy.get('generations:1')
+
+        before, collected, kept, plain_kept, plain_cleared, current = asyncio.run(run())
+        self.assertEqual(before, 'plain')
+        self.assertFalse(collected)
+        self.assertTrue(kept)
+        # readers not resolving the pointer keep reading the plain keys
+        self.assertEqual(plain_kept, 'plain')
+        self.assertFalse(plain_cleared)
+        self.assertEqual(current, 'third')
+
+    def testAccessorsUnderCommittedGeneration(self):
+        async def run():
+            proxy = self.cacheproxy
+            proxy.register_versioned_prefix('versioned:')
+            await proxy.commit_generation('versioned:', '1')
+            await proxy.set('versioned:value', 'value')
+            await proxy.incr('versioned:counter')
+            await proxy.zadd('versioned:zset', {'a': 1, 'b': 2})
+            await proxy.set_objects([('versioned:object', {'name': 'object'})])
+            await proxy.add_sets_values('versioned:set', 'member')
+            namespace = proxy.generation_key_prefix('versioned:', '1')
+            return ([await proxy.get('versioned:value'), await proxy.get('versioned:counter'),
+                     await proxy.zrange('versioned:zset', 0, -1), await proxy.get_object('versioned:object', ['name']),
+                     await proxy.get_sets_values('versioned:set')],
+                    [await proxy.cache_inst.exists(namespace + k) for k in ('value', 'counter', 'zset', 'object', 'set')])
+
+        values, written = asyncio.run(run())
+        values = [v.decode() if isinstance(v, bytes) else v for v in values]
+        self.assertEqual((values[0], str(values[1])), ('value', '1'))
+        self.assertEqual([v.decode() if isinstance(v, bytes) else v for v in values[2]], ['a', 'b'])
+        self.assertEqual(values[3:], [{'name': 'object'}, ['member']])
+        # the writes landed in the namespace of the committed generation
+        self.assertTrue(all(written))
+
+    def testSortedSetsPaging(self):
+        async def run():
+            await self.cacheproxy.zadd('scores', {'m%02d' % i: i // 3 for i in range(20)})
+            window = await self.cacheproxy.zrangebyscore('scores', 2, '(4', offset=1, limit=3)
+            top = await self.cacheproxy.zrevrange('scores', 0, 1, withscores=True)
+            rows, cursor = await self.cacheproxy.get_sorted_sets_page('scores', 4, min=1, max=5)
+            # members added before the cursor do not shift the next page
+            await self.cacheproxy.zadd('scores', {'new': 1})
+            next_rows, _ = await self.cacheproxy.get_sorted_sets_page('scores', 4, cursor, min=1, max=5)
+            members = [m async for m, _ in self.cacheproxy.iter_sorted_sets_values('scores', page_size=3, desc=True)]
+            return window, top, rows, next_rows, members
+
+        window, top, rows, next_rows, members = asyncio.run(run())
+        self.assertEqual(window, ['m07', 'm08', 'm09'])
+        self.assertEqual(top, [('m19', 6.0), ('m18', 6.0)])
+        self.assertEqual([m for m, _ in rows], ['m03', 'm04', 'm05', 'm06'])
+        self.assertEqual([m for m, _ in next_rows], ['m07', 'm08', 'm09', 'm10'])
+        self.assertEqual(len(members), 21)
+        self.assertEqual(members[:3], ['m19', 'm18', 'm17'])
+
+    def testDecodedSortedSetsBounded(self):
+        cache_inst = self.cacheproxy.cache_inst
+        cache_inst.zset_cache_size = 2
+
+        async def run():
+            for i in range(3):
+                await self.cacheproxy.zadd('bounded:%d' % i, {'m%d' % j: j for j in range(3)})
+            # the least recently used one were evicted and read from the file
+            first = await self.cacheproxy.zrange('bounded:0', 0, -1)
+            await self.cacheproxy.zrange('bounded:2', 0, -1)
+            await self.cacheproxy.delete('bounded:2')
+            return first
+
+        self.assertEqual(asyncio.run(run()), ['m0', 'm1', 'm2'])
+        self.assertEqual(list(cache_inst._zsets), [cache_inst.get_cache_key('bounded:0')])
+
+class TestCacheProxyRedis(LegacyHashTests, unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.cacheproxy = CacheProxy()
+        self.cacheproxy.cache_inst = FakeAsyncRedis(server=fakeredis.FakeServer())
+
+    def tearDown(self):
+        self.cacheproxy._prefix_codecs.pop('legacy:', None)
+        self.cacheproxy._prefix_codecs.pop('encoded:', None)
+        self.cacheproxy.cache_inst = None
+
+    def testLoadingLockReleasedByHolderOnly(self):
+        async def run():
+            async def loader():
+                # the lock expired during the loading and were taken by another loader
+                await self.cacheproxy.cache_inst.set('loading' + LOADING_LOCK_SUFFIX, 'other')
+                return 'loaded'
+            value = await self.cacheproxy.get_or_load('loading', loader, 60)
+            held = await self.cacheproxy.cache_inst.get('loading' + LOADING_LOCK_SUFFIX)
+            value2 = await self.cacheproxy.get_or_load('released', lambda: 'loaded', 60)
+            released = await self.cacheproxy.cache_inst.exists('released' + LOADING_LOCK_SUFFIX)
+            return value, held, value2, released
+
+        self.assertEqual(asyncio.run(run()), ('loaded', b'other', 'loaded', 0))
+        self.assertEqual(self.cacheproxy.cache_inst.script_calls, [['loading' + LOADING_LOCK_SUFFIX], ['released' + LOADING_LOCK_SUFFIX]])
+
+    def testIndexScriptsWithCompositePks(self):
+        items = [{'group': 'g%d' % (i % 2), 'id': i, 'seq': 'a', 'name': 'item %d' % i} for i in range(4)]
+        self.cacheproxy.set_codec('json', key_prefix='encoded:')
+
+        async def run():
+            for key_prefix in ['items:', 'encoded:']:
+                await self.cacheproxy.add_objects_to_cache_indexed_to_many(items, key_prefix, 'group', ['id', 'seq'])
+            await self.cacheproxy.del_objects_from_cache_indexed_to_many(items[:1], 'items:', 'group', ['id', 'seq'])
+            # an object left by a failed removal
+            await self.cacheproxy.cache_inst.hset('items:g1:9:a', 'name', 'item 9')
+            found = await self.cacheproxy.verify_cache_indexed_to_many('items:', repair=True)
+            rows = await self.cacheproxy.get_objects('items:g1', ['id', 'name'])
+            encoded = await self.cacheproxy.get_objects('encoded:g0', ['id', 'name'])
+            return found, rows, encoded, await self.cacheproxy.cache_inst.exists('items:g1:9:a')
+
+        found, rows, encoded, orphan_exists = asyncio.run(run())
+        self.assertEqual(len(self.cacheproxy.cache_inst.script_calls), 3)
+        # the objects of composite pks were kept by the repair
+        self.assertEqual(found, {'dangling': {}, 'orphans': ['items:g1:9:a']})
+        self.assertEqual(sorted((row['id'], row['name']) for row in rows), [('1', 'item 1'), ('3', 'item 3')])
+        self.assertEqual(sorted((row['id'], row['name']) for row in encoded), [(0, 'item 0'), (2, 'item 2')])
+        self.assertFalse(orphan_exists)
+
+if __name__ == '__main__':
+    unittest.main()
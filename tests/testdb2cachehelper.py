@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import asyncio
+import datetime
+import functools
+import tempfile
+import unittest
+from unittest import mock
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, DateTime
+from hawthorn.dbproxy import DbProxy, _DbInstance
+from hawthorn.modelutils import ModelBase, set_model_dbinstance
+from hawthorn.cacheproxy import CacheProxy
+from hawthorn.cacher.filecache import FileCache
+from hawthorn import db2cachehelper
+
+class LoadingModelDemo(ModelBase):
+    __tablename__ = '_t_loading_model_demo'
+    id = Column('id', Integer, primary_key=True)
+    name = Column('name', String(50))
+    updated_at = Column('updated_at', DateTime)
+
+UPDATED_AT = datetime.datetime(2024, 1, 1, 8, 0, 0)
+
+class TestDb2CacheHelper(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(self.tmp_dir, 'loading.db')
+        self.engine = sqlalchemy.create_engine('sqlite:///' + db_path)
+        ModelBase.metadata.create_all(self.engine, tables=[LoadingModelDemo.__table__])
+        self.insert_rows([(i, UPDATED_AT) for i in range(1, 8)])
+        # connected by run_db within its loop instead of a loop never running
+        with mock.patch.object(_DbInstance, '_start_connect'):
+            DbProxy().setup_rdbms({'testing_loading': {'connector': 'sqlite', 'host': db_path, 'db': 'main'}})
+        set_model_dbinstance({'LoadingModelDemo': 'testing_loading'})
+        self.cacheproxy = CacheProxy()
+        self.cacheproxy.cache_inst = FileCache(os.path.join(self.tmp_dir, 'cache.db'))
+
+    def tearDown(self):
+        self.cacheproxy.cache_inst.close()
+        self.cacheproxy.cache_inst = None
+        self.engine.dispose()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def insert_rows(self, rows):
+        with self.engine.begin() as conn:
+            for pk, updated_at in rows:
+                conn.execute(LoadingModelDemo.__table__.insert().values(id=pk, name='name %d' % pk, updated_at=updated_at))
+
+    def run_db(self, coro_func):
+        async def run():
+            try:
+                await DbProxy().db_instances['testing_loading'].manual_connect()
+                return await coro_func()
+            finally:
+                # the connection kept by the db instance were closed within its loop
+                db_inst = DbProxy().db_instances.pop('testing_loading')
+                if db_inst.conn is not None:
+                    await db_inst.conn.close()
+                await db_inst.engine.dispose()
+        return asyncio.run(run())
+
+    def testQueryListAfter(self):
+        async def run():
+            pages = []
+            after = None
+            while True:
+                rows = await DbProxy().query_list_after(LoadingModelDemo, None, 3, after=after, selections=['id', 'name'])
+                if not rows:
+                    return pages
+                pages.append([row['id'] for row in rows])
+                after = rows[-1]['id']
+
+        self.assertEqual(self.run_db(run), [[1, 2, 3], [4, 5, 6], [7]])
+
+    def testLoadAndRefreshByWatermark(self):
+        async def run():
+            stats = await db2cachehelper.load_rdbms_data_to_cache(LoadingModelDemo, 'loading:', batch_size=2, watermark_key='loading-watermark')
+            self.assertEqual(stats['rows'], 7)
+            self.assertEqual(await self.cacheproxy.get_object('loading:5', ['name']), {'name': 'name 5'})
+            watermark = await self.cacheproxy.get('loading-watermark')
+            # rows committed after the load with the same and a later update time
+            self.insert_rows([(8, UPDATED_AT), (9, UPDATED_AT + datetime.timedelta(seconds=1))])
+            refreshed = await db2cachehelper.load_rdbms_data_to_cache(LoadingModelDemo, 'loading:', batch_size=2, watermark_key='loading-watermark')
+            return watermark, refreshed, await self.cacheproxy.get_object('loading:8', ['name']), await self.cacheproxy.get('loading-watermark')
+
+        watermark, refreshed, row, refreshed_watermark = self.run_db(run)
+        self.assertEqual(watermark, UPDATED_AT.isoformat())
+        # the rows at the watermark were loaded again
+        self.assertEqual(refreshed['rows'], 9)
+        self.assertEqual(row, {'name': 'name 8'})
+        self.assertEqual(refreshed_watermark, (UPDATED_AT + datetime.timedelta(seconds=1)).isoformat())
+
+    def testResumeFromCheckpoint(self):
+        self.cacheproxy.register_versioned_prefix('resuming:')
+
+        async def run():
+            # a load into generation 100 were interrupted after the row 4
+            await self.cacheproxy.set('resuming-checkpoint', '100|4')
+            stats = await db2cachehelper.load_rdbms_data_to_cache(LoadingModelDemo, 'resuming:', batch_size=2, checkpoint_key='resuming-checkpoint')
+            generation = await self.cacheproxy.get_current_generation('resuming:', refresh=True)
+            return (stats, generation, await self.cacheproxy.get_object('resuming:5', ['name']),
+                    await self.cacheproxy.get_object('resuming:3', ['name']), await self.cacheproxy.get('resuming-checkpoint'))
+
+        stats, generation, resumed, skipped, checkpoint = self.run_db(run)
+        self.assertEqual((stats['rows'], stats['last_id']), (3, 7))
+        self.assertEqual(generation, '100')
+        self.assertEqual(resumed, {'name': 'name 5'})
+        # the rows before the checkpoint were not loaded again
+        self.assertFalse(skipped)
+        self.assertIsNone(checkpoint)
+
+class MongoModelDemo(object):
+    pass
+
+class TestCacheBulkWriting(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cacheproxy = CacheProxy()
+        self.cacheproxy.cache_inst = FileCache(os.path.join(self.tmp_dir, 'cache.db'))
+        self.events = []
+        self.documents = [{'id': i, 'name': 'name %d' % i} for i in range(1, 8)]
+        DbProxy().query_all_mongo = self.query_all_mongo
+        self.load_data_from_mongodb = db2cachehelper.load_data_from_mongodb
+        db2cachehelper.load_data_from_mongodb = functools.partial(self.load_data_from_mongodb, page_size=3)
+
+    def tearDown(self):
+        db2cachehelper.load_data_from_mongodb = self.load_data_from_mongodb
+        del DbProxy().query_all_mongo
+        self.cacheproxy.cache_inst.close()
+        self.cacheproxy.cache_inst = None
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    async def query_all_mongo(self, model, filters, limit=100, sort=None, **kwargs):
+        after_id = filters[1].get('id__gt', 0)
+        self.events.append('query:%d' % after_id)
+        await asyncio.sleep(0.01)
+        return [dict(doc) for doc in self.documents if doc['id'] > after_id][:limit]
+
+    def testBulkWriterConcurrency(self):
+        batches = []
+        inflights = [0, 0]
+
+        async def write_batch(batch):
+            inflights[0] += 1
+            inflights[1] = max(inflights[1], inflights[0])
+            await asyncio.sleep(0.01)
+            inflights[0] -= 1
+            batches.append(batch)
+
+        async def failing_batch(batch):
+            raise ValueError('cache unavailable')
+
+        async def run():
+            writer = db2cachehelper.CacheBulkWriter(write_batch, batch_size=3, concurrency=2)
+            for i in range(10):
+                await writer.add(i)
+            await writer.join()
+            failing = db2cachehelper.CacheBulkWriter(failing_batch, batch_size=3)
+            await failing.add(1)
+            with self.assertRaises(ValueError):
+                await failing.join()
+            return writer.written
+
+        self.assertEqual(asyncio.run(run()), 10)
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(10)))
+        self.assertEqual(sorted(len(batch) for batch in batches), [1, 3, 3, 3])
+        self.assertEqual(inflights[1], 2)
+
+    def testMongoLoadingPrefetched(self):
+        async def on_item(item):
+            self.events.append('item:%d' % item['id'])
+            await asyncio.sleep(0)
+
+        async def run():
+            return await db2cachehelper.load_data_from_mongodb(MongoModelDemo, on_item)
+
+        stats = asyncio.run(run())
+        self.assertEqual((stats['rows'], stats['last_id']), (7, 7))
+        # the next page were queried before the items of the current one were handled
+        self.assertEqual(self.events[:3], ['query:0', 'query:3', 'item:1'])
+        self.assertEqual([e for e in self.events if e.startswith('item')], ['item:%d' % i for i in range(1, 8)])
+
+    def testMongoLoadingToCache(self):
+        batches = []
+        set_objects = self.cacheproxy.set_objects
+
+        async def counting_set_objects(items):
+            batches.append(len(items))
+            return await set_objects(items)
+
+        async def run():
+            self.cacheproxy.set_objects = counting_set_objects
+            try:
+                stats = await db2cachehelper.load_mongo_data_to_cache(MongoModelDemo, 'mongo:', 'id', batch_size=5)
+                resumed = await db2cachehelper.load_mongo_data_to_cache(MongoModelDemo, 'mongo:', 'id', batch_size=5, checkpoint_key='mongo-checkpoint')
+            finally:
+                del self.cacheproxy.set_objects
+            return stats, resumed, await self.cacheproxy.get_object('mongo:7', ['name'])
+
+        stats, resumed, row = asyncio.run(run())
+        self.assertEqual((stats['rows'], resumed['rows']), (7, 7))
+        self.assertEqual(row, {'name': 'name 7'})
+        # the batches span pages unless a checkpoint were recorded after each page
+        self.assertEqual(batches, [5, 2, 3, 3, 1])
+
+if __name__ == '__main__':
+    unittest.main()
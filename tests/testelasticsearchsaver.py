@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import tempfile
+import unittest
+from hawthorn.elasticsearchsaver import ElasticSearchSaver, OVERFLOW_POLICY, ELASTIC_SAVER_DEFAULTS
+
+class FakeElasticsearch(object):
+    """Records the documents of bulk requests, raises while unavailable,
+    responds the statuses of statuses in turn to the documents, each bulk
+    takes delay seconds
+    """
+    def __init__(self):
+        self.available = True
+        self.documents = []
+        self.requests = []
+        self.statuses = []
+        self.delay = 0
+
+    def bulk(self, body):
+        if not self.available:
+            raise ConnectionError('elasticsearch unavailable')
+        if self.delay:
+            time.sleep(self.delay)
+        self.requests.append(len(body))
+        documents = [json.loads(line) for line in body.decode('utf-8').splitlines()[1::2]]
+        items = []
+        for document in documents:
+            status = self.statuses.pop(0) if self.statuses else 201
+            if status < 300:
+                self.documents.append(document)
+            items.append({'index': {'status': status, 'error': None if status < 300 else {'type': 'error'}}})
+        return {'errors': any(item['index']['status'] >= 300 for item in items), 'items': items}
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+class TestElasticSearchSaver(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.saver = ElasticSearchSaver()
+        self.saver.close()
+        self.es = FakeElasticsearch()
+        self.saver.es_instance = self.es
+        self.spill_path = os.path.join(tempfile.mkdtemp(), 'es-spill.log')
+
+    def tearDown(self):
+        self.saver.close()
+        self.saver.configure_pipeline(overflow_policy=OVERFLOW_POLICY.DROP_OLDEST, spill_path='',
+            bulk_max_items=ELASTIC_SAVER_DEFAULTS.BULK_MAX_ITEMS, bulk_max_bytes=ELASTIC_SAVER_DEFAULTS.BULK_MAX_BYTES, bulk_workers=ELASTIC_SAVER_DEFAULTS.BULK_WORKERS)
+
+    def testFlushBySizeAndInterval(self):
+        self.saver.configure_pipeline(queue_limit=100, save_threshold=5, save_interval=0.3, retry_backoff=0.01)
+        for i in range(5):
+            self.saver.save('test', 'doc', {'n': i})
+        self.assertTrue(wait_until(lambda: len(self.es.documents) == 5, timeout=0.2))
+        self.saver.save('test', 'doc', {'n': 5})
+        self.assertTrue(wait_until(lambda: len(self.es.documents) == 6))
+        self.assertEqual(sorted(doc['n'] for doc in self.es.documents), list(range(6)))
+
+    def testBoundedWhileUnavailable(self):
+        self.saver.configure_pipeline(queue_limit=10, overflow_policy=OVERFLOW_POLICY.DROP_OLDEST, save_threshold=5, save_interval=0.05, retry_backoff=0.05)
+        dropped = self.saver.stats()['dropped']
+        self.es.available = False
+        for i in range(50):
+            self.saver.save('test', 'doc', {'n': i})
+        self.assertLessEqual(self.saver.stats()['pending'], 10)
+        self.es.available = True
+        # documents taken by the workers were beyond the queue limit while their bulk failed
+        self.assertTrue(wait_until(lambda: self.saver.stats()['pending'] == 0 and len(self.es.documents) + self.saver.stats()['dropped'] - dropped == 50))
+        self.assertLessEqual(len(self.es.documents), 10 + 2 * 5)
+        self.assertIn(49, [doc['n'] for doc in self.es.documents])
+
+    def testSpillAndReplay(self):
+        self.saver.configure_pipeline(queue_limit=3, overflow_policy=OVERFLOW_POLICY.SPILL, spill_path=self.spill_path, save_threshold=3, save_interval=0.05, retry_backoff=0.05)
+        self.es.available = False
+        for i in range(8):
+            self.saver.save('test', 'doc', {'n': i})
+        self.assertTrue(wait_until(lambda: self.saver.stats()['failed_batches'] > 0))
+        self.es.available = True
+        self.assertTrue(wait_until(lambda: len(self.es.documents) == 8 and not os.path.exists(self.spill_path)))
+        self.assertEqual(sorted(doc['n'] for doc in self.es.documents), list(range(8)))
+
+    def testReplayByWorkersNotDuplicated(self):
+        with open(self.spill_path, 'w') as f:
+            for i in range(40):
+                f.write(json.dumps({'action': 'index', 'meta_data': {'_index': 'test', '_type': 'doc', '_id': None}, 'body': {'n': i}}) + '\n')
+        self.saver.configure_pipeline(spill_path=self.spill_path, save_threshold=5, save_interval=0.02, bulk_max_items=5, bulk_workers=4)
+        # the workers replaying at once overlap their bulk requests
+        self.es.delay = 0.05
+        stats = self.saver.stats()
+        self.saver.save('test', 'doc', {'n': 40})
+        self.assertTrue(wait_until(lambda: not os.path.exists(self.spill_path) and len(self.es.documents) >= 41))
+        time.sleep(0.1)
+        self.assertEqual(sorted(doc['n'] for doc in self.es.documents), list(range(41)))
+        self.assertEqual(self.saver.stats()['replayed'] - stats['replayed'], 40)
+
+    def testRetryRetryableItems(self):
+        self.saver.configure_pipeline(queue_limit=100, save_threshold=4, save_interval=0.5, bulk_max_bytes=200, bulk_workers=3, retry_backoff=0.01)
+        stats = self.saver.stats()
+        # the second is rejected by mapping and the third by a busy cluster
+        self.es.statuses = [201, 400, 429, 201]
+        for i in range(4):
+            self.saver.save('test', 'doc', {'n': i, 'text': 'x' * 40})
+        self.assertTrue(wait_until(lambda: len(self.es.documents) == 3))
+        self.assertEqual(sorted(doc['n'] for doc in self.es.documents), [0, 2, 3])
+        self.assertTrue(max(self.es.requests) <= 200 and len(self.es.requests) > 2)
+        result = self.saver.stats()
+        self.assertEqual((result['rejected'] - stats['rejected'], result['retried'] - stats['retried']), (1, 1))
+        self.assertEqual(result['workers'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
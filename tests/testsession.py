@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import shutil
+import tempfile
+import asyncio
+import threading
+import time
+import fakeredis
+import tornado.web
+import tornado.testing
+from hawthorn.asynchttphandler import GeneralTornadoHandler
+from hawthorn.session import TornadoSession, HandlerSessionDataManager, MemorySessionBackend, RedisSessionBackend, SESSION_JOURNAL_COMPACT_MIN_LINES
+
+class FakeHandler(object):
+    def __init__(self, cookie=None):
+        self.cookie = cookie
+        self.cookies_set = []
+        self.cookies_read = 0
+
+    def get_secure_cookie(self, name, value=None):
+        self.cookies_read += 1
+        return self.cookie
+
+    def set_secure_cookie(self, name, value):
+        self.cookies_set.append(value)
+
+class TestSession(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.data_dir, 'session-data.log')
+        self.manager = HandlerSessionDataManager()
+        self.manager.backend = MemorySessionBackend({'path': self.journal_path, 'legacy_path': None})
+
+    def tearDown(self):
+        self.manager.backend.close()
+        self.manager.backend = None
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def testMemoryJournalReplay(self):
+        handler = FakeHandler()
+        session = TornadoSession(handler)
+        session['uid'] = 1
+        session['name'] = 'name'
+        session.flush()
+        sid = handler.cookies_set[-1]
+
+        session = TornadoSession(FakeHandler(sid.encode()))
+        self.assertEqual(session['uid'], 1)
+        del session['name']
+        session['role'] = 'admin'
+        self.assertTrue(session.is_dirty())
+        session.flush()
+        self.assertFalse(session.is_dirty())
+        self.manager.backend.flush()
+
+        replayed = MemorySessionBackend({'path': self.journal_path, 'legacy_path': None})
+        self.assertEqual(replayed.load(sid), {'uid': 1, 'role': 'admin'})
+        replayed.close()
+
+    def testUnknownSessionId(self):
+        handler = FakeHandler(b'unknown')
+        session = TornadoSession(handler)
+        session['uid'] = 1
+        self.assertNotEqual(handler.cookies_set[-1], 'unknown')
+
+    def testCookieDecodedAndSetOnce(self):
+        handler = FakeHandler()
+        session = TornadoSession(handler)
+        self.assertIsNone(session['uid'])
+        session['uid'] = 1
+        session['name'] = 'name'
+        self.assertEqual(session['uid'], 1)
+        self.assertEqual(handler.cookies_read, 1)
+        self.assertEqual(len(handler.cookies_set), 1)
+
+    def testRedisBackendOffTheLoop(self):
+        backend = RedisSessionBackend({'ttl': 60})
+        backend.client = fakeredis.FakeStrictRedis()
+        self.manager.backend.close()
+        self.manager.backend = backend
+        threads = []
+        load, save = backend.load, backend.save
+
+        def recording(func):
+            def call(*args):
+                threads.append(threading.current_thread())
+                return func(*args)
+            return call
+        backend.load, backend.save = recording(load), recording(save)
+
+        async def run():
+            handler = FakeHandler()
+            session = TornadoSession(handler)
+            session['uid'] = 1
+            with self.assertRaises(RuntimeError):
+                session.flush()
+            await session.flush_async()
+            session = TornadoSession(FakeHandler(handler.cookies_set[-1].encode()))
+            await session.preload()
+            return session['uid'], session.is_dirty()
+
+        self.assertEqual(asyncio.run(run()), (1, False))
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def testExpiryAndEviction(self):
+        backend = MemorySessionBackend({'path': self.journal_path, 'legacy_path': None, 'ttl': 50, 'max_sessions': 3})
+        now = [1000.0]
+        backend.clock = lambda: now[0]
+        for i in range(5):
+            backend.save('s%d' % i, {'uid': i})
+        self.assertEqual(list(backend.sessions.keys()), ['s2', 's3', 's4'])
+        now[0] += 30
+        self.assertEqual(backend.load('s2'), {'uid': 2})
+        now[0] += 30
+        self.assertEqual(backend.expire_sessions(), 2)
+        self.assertEqual(list(backend.sessions.keys()), ['s2'])
+        backend.close()
+
+    def testJournalCompaction(self):
+        backend = MemorySessionBackend({'path': self.journal_path, 'legacy_path': None})
+        for i in range(SESSION_JOURNAL_COMPACT_MIN_LINES + 10):
+            backend.save('s%d' % (i % 5), {'count': i})
+        backend.flush()
+        with open(self.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        backend.save('s0', {'name': 'name'})
+        backend.close()
+        replayed = MemorySessionBackend({'path': self.journal_path, 'legacy_path': None})
+        self.assertEqual(len(replayed.sessions), 5)
+        self.assertEqual(replayed.load('s0'), {'count': SESSION_JOURNAL_COMPACT_MIN_LINES + 5, 'name': 'name'})
+        replayed.close()
+
+class SlowRedisSessionBackend(RedisSessionBackend):
+    """Saves and deletes slowly, or fails saving while failing were set
+    """
+    failing = False
+
+    def save(self, sid, changed, removed=None):
+        time.sleep(0.05)
+        if self.failing:
+            raise ConnectionError('redis unavailable')
+        super().save(sid, changed, removed)
+
+    def delete(self, sid):
+        time.sleep(0.05)
+        super().delete(sid)
+
+def login(handler, request):
+    handler.session['uid'] = 1
+    handler.redirect('/profile')
+
+def logout(handler, request):
+    handler.session.delete()
+    return 'bye'
+
+def profile(handler, request):
+    return 'uid:%s' % handler.session['uid']
+
+async def account(handler, request):
+    session = await handler.load_session()
+    return 'uid:%s' % session['uid']
+
+def ping(handler, request):
+    return 'pong'
+
+class TestSessionHandler(tornado.testing.AsyncHTTPTestCase):
+    """
+    """
+    def setUp(self):
+        self.manager = HandlerSessionDataManager()
+        self.backend = SlowRedisSessionBackend({'ttl': 60})
+        self.backend.client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        self.manager.backend = self.backend
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.manager.backend = None
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/login', GeneralTornadoHandler, {'callback': login, 'methods': ['GET']}),
+            (r'/logout', GeneralTornadoHandler, {'callback': logout, 'methods': ['GET']}),
+            (r'/profile', GeneralTornadoHandler, {'callback': profile, 'methods': ['GET'], 'preload_session': True}),
+            (r'/unloaded', GeneralTornadoHandler, {'callback': profile, 'methods': ['GET']}),
+            (r'/account', GeneralTornadoHandler, {'callback': account, 'methods': ['GET']}),
+            (r'/ping', GeneralTornadoHandler, {'callback': ping, 'methods': ['GET']}),
+        ], cookie_secret='secret')
+
+    def session_keys(self):
+        return [k.decode() for k in self.backend.client.keys('session:*')]
+
+    def testSavedBeforeResponse(self):
+        response = self.fetch('/login', follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        # the session were saved once the redirect reached the client
+        self.assertEqual(len(self.session_keys()), 1)
+        response = self.fetch('/logout', headers={'Cookie': response.headers['Set-Cookie'].split(';')[0]})
+        self.assertEqual(response.body, b'bye')
+        self.assertEqual(self.session_keys(), [])
+
+    def testLoadedOnDemand(self):
+        loads = []
+        load = self.backend.load
+        self.backend.load = lambda sid: loads.append(sid) or load(sid)
+        cookie = self.fetch('/login', follow_redirects=False).headers['Set-Cookie'].split(';')[0]
+        self.assertEqual(self.fetch('/ping', headers={'Cookie': cookie}).body, b'pong')
+        # the endpoints not reading the session loaded nothing
+        self.assertEqual(loads, [])
+        self.assertEqual(self.fetch('/profile', headers={'Cookie': cookie}).body, b'uid:1')
+        self.assertEqual(self.fetch('/account', headers={'Cookie': cookie}).body, b'uid:1')
+        self.assertEqual(len(loads), 2)
+        # reading an unloaded session of a blocking backend fails rather than blocking the ioloop
+        self.assertEqual(self.fetch('/unloaded', headers={'Cookie': cookie}).code, 500)
+        self.assertEqual(len(loads), 2)
+
+    def testFailedSaveResponded(self):
+        self.backend.failing = True
+        response = self.fetch('/login', follow_redirects=False)
+        self.assertEqual(response.code, 500)
+        self.assertEqual(self.session_keys(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from hawthorn.cacher.shardedredis import HashRing, key_hash_tag, key_slot
+
+class TestShardedRedis(unittest.TestCase):
+    """
+    """
+    def testKeyHashTag(self):
+        self.assertEqual(key_hash_tag('orders:{user1}:1001'), b'user1')
+        self.assertEqual(key_hash_tag('orders:{}:1001'), b'orders:{}:1001')
+        self.assertEqual(key_slot('orders:{user1}'), key_slot('orders:{user1}:1001'))
+
+    def testHashRingMovesFewKeys(self):
+        keys = ['key:%d' % i for i in range(10000)]
+        ring = HashRing(['a', 'b', 'c'])
+        counts = [0, 0, 0]
+        for k in keys:
+            counts[ring.get_node_index(k)] += 1
+        for count in counts:
+            self.assertGreater(count, 2500)
+        grown = HashRing(['a', 'b', 'c', 'd'])
+        moved = sum(1 for k in keys if ring.get_node_index(k) != grown.get_node_index(k))
+        self.assertLess(moved, 3500)
+        self.assertEqual(ring.get_node_index('p:{x}'), ring.get_node_index('p:{x}:1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import asyncio
+from hawthorn.utilities.timerwheel import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+    """
+    """
+    def testFiresAndCancels(self):
+        fired = []
+
+        async def run():
+            wheel = TimerWheel(resolution=0.01, slots=4)
+            # longer than the wheel span, waits for several rounds
+            wheel.add(0.1, lambda: fired.append('long'))
+            wheel.add(0.02, lambda: fired.append('short'))
+            wheel.add(0.03, lambda: fired.append('cancelled')).cancel()
+            await asyncio.sleep(0.05)
+            pending = len(wheel)
+            await asyncio.sleep(0.1)
+            return pending, len(wheel)
+
+        self.assertEqual(asyncio.run(run()), (1, 0))
+        self.assertEqual(fired, ['short', 'long'])
+
+if __name__ == '__main__':
+    unittest.main()